@@ -0,0 +1,107 @@
+# baking.py
+
+import time
+import logging
+from PyQt5.QtWidgets import QGraphicsItem
+from PyQt5.QtGui import QPicture, QPainter, QPixmapCache
+from PyQt5.QtCore import QObject, QRectF, QTimer
+from chunks import ITEM_LAYER, chunk_rect, item_bounds
+from tile_cache import render_items
+from instrumentation import log, metrics
+
+BAKE_DELAY = 2.0  # Сколько секунд чанк не должен меняться, чтобы его запечь
+BAKE_INTERVAL = 500  # Период проверки чанков (мс)
+BAKE_BUDGET = 0.01  # Время (с) на запекание за один шаг таймера
+MIN_BAKE_ITEMS = 16  # Чанки с меньшим числом элементов не стоит запекать
+PIXMAP_CACHE_LIMIT = 128 * 1024  # Предел QPixmapCache (КБ) для растрового кэша запеченных чанков
+
+
+def record_picture(items, rect):
+    # Записывает отрисовку элементов, обрезанную по прямоугольнику чанка
+    picture = QPicture()
+    painter = QPainter(picture)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setClipRect(rect)
+    render_items(painter, items)
+    painter.end()
+    return picture
+
+
+# Один статичный элемент сцены вместо всех элементов чанка: рисует записанную QPicture,
+# а растр в координатах устройства кэширует сам QGraphicsView
+class BakedChunkItem(QGraphicsItem):
+    def __init__(self, picture, rect):
+        super().__init__()
+        self.picture = picture
+        self.rect = rect
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        painter.drawPicture(0, 0, self.picture)
+
+
+def bake_chunk(chunk):
+    # Каждый слой чанка запекается отдельно: скрытие или прозрачность слоя не требуют перезапекания
+    layers = {}
+    for item in sorted(chunk.items, key=lambda item: item.zValue()):
+        layers.setdefault(item.data(ITEM_LAYER), []).append(item)
+    rect = chunk_rect(chunk.key)
+    baked = {}
+    for layer, items in layers.items():
+        bounds = QRectF()
+        for item in items:
+            bounds = bounds.united(item_bounds(item))
+        baked_item = BakedChunkItem(record_picture(items, rect), bounds.intersected(rect))
+        baked_item.setZValue(items[-1].zValue())
+        baked[layer] = baked_item
+    return baked
+
+
+# Запекает давно не менявшиеся чанки в фоне (по таймеру, с ограничением времени на шаг).
+# Хранилище само распекает чанки, когда в них добавляют, удаляют или меняют элементы
+class StrokeBaker(QObject):
+    def __init__(self, chunk_store, parent=None):
+        super().__init__(parent)
+        self.chunk_store = chunk_store
+        self.enabled = True
+        if QPixmapCache.cacheLimit() < PIXMAP_CACHE_LIMIT:
+            QPixmapCache.setCacheLimit(PIXMAP_CACHE_LIMIT)
+        self.timer = QTimer(self)
+        self.timer.setInterval(BAKE_INTERVAL)
+        self.timer.timeout.connect(self.bakeIdle)
+        self.timer.start()
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            for key in list(self.chunk_store.chunks):
+                self.chunk_store.unbake(key)
+
+    def bakeIdle(self):
+        if not self.enabled or self.chunk_store.suspended:
+            return
+        try:
+            started = time.perf_counter()
+            deadline = started + BAKE_BUDGET
+            idle_since = time.monotonic() - BAKE_DELAY
+            store = self.chunk_store
+            baked = 0
+            for key in list(store.loaded_keys):
+                chunk = store.chunks.get(key)
+                if chunk is None or chunk.baked is not None or len(chunk.items) < MIN_BAKE_ITEMS:
+                    continue
+                group = store.bake_group(key, idle_since)
+                if group is None:
+                    continue
+                store.bake({group_key: bake_chunk(store.chunks[group_key]) for group_key in group})
+                baked += len(group)
+                log.debug("StrokeBaker: Baked %s chunks around %s", len(group), key)
+                if time.perf_counter() >= deadline:
+                    break
+            if baked and metrics.enabled:
+                metrics.observe('bake', time.perf_counter() - started)
+        except Exception as e:
+            logging.exception("Exception in StrokeBaker bakeIdle:")
@@ -0,0 +1,354 @@
+# benchmark.py
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# Без дисплея окно рисуется в память
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication, QMessageBox
+from PyQt5.QtGui import QMouseEvent, QWheelEvent
+from PyQt5.QtCore import Qt, QEvent, QPoint, QPointF, QT_VERSION_STR, PYQT_VERSION_STR
+from canvas_view import CanvasWindow
+from ess_format import ItemRecord, KIND_PATH, KIND_POLYGON, record_to_item, write_ess
+from history import AddItemsCommand
+from instrumentation import metrics
+from journal import AUTOSAVE_DIR_ENV
+
+DEFAULT_SIZES = (0, 2000, 10000)  # Количество элементов на холсте перед сценариями
+VIEWPORT_SIZE = (1280, 800)
+FRAME_EVENTS = 4  # Сколько событий ввода приходится на один кадр
+LOAD_TIMEOUT = 600.0
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def memory_usage():
+    # Текущий и пиковый размер резидентной памяти процесса в байтах (0, если неизвестен)
+    rss = 0
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    peak = 0
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В Linux ru_maxrss в килобайтах, в macOS — в байтах
+        if sys.platform != 'darwin':
+            peak *= 1024
+    except ImportError:
+        pass
+    return rss, max(peak, rss)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def synthetic_records(count, seed):
+    # Случайный документ: штрихи-блуждания и залитые многоугольники на площади, растущей с числом элементов
+    rng = np.random.default_rng(seed)
+    extent = max(1000.0, math.sqrt(count) * 150.0)
+    records = []
+    for _ in range(count):
+        origin = rng.uniform(-extent, extent, 2)
+        rgba = int(rng.integers(0, 0xFFFFFF)) | 0xFF000000
+        if rng.random() < 0.1:
+            angles = np.sort(rng.uniform(0, 2 * math.pi, int(rng.integers(5, 40))))
+            radii = rng.uniform(20, 120, len(angles))
+            coords = origin + np.column_stack((np.cos(angles) * radii, np.sin(angles) * radii))
+            records.append(ItemRecord(KIND_POLYGON, rgba, 0.0, coords))
+        else:
+            steps = rng.normal(0, 6, (int(rng.integers(10, 80)), 2))
+            coords = origin + np.cumsum(steps, axis=0)
+            records.append(ItemRecord(KIND_PATH, rgba, float(rng.uniform(1, 12)), coords))
+    return records
+
+
+def spiral(center, turns, radius, count):
+    t = np.linspace(0, 1, count)
+    angle = t * turns * 2 * math.pi
+    return list(zip(center[0] + np.cos(angle) * radius * t, center[1] + np.sin(angle) * radius * t))
+
+
+def star(center, radius, count, spikes=24):
+    angle = np.linspace(0, 2 * math.pi, count, endpoint=False)
+    r = radius * (0.6 + 0.4 * np.cos(angle * spikes))
+    return list(zip(center[0] + np.cos(angle) * r, center[1] + np.sin(angle) * r))
+
+
+# Подает синтетические события в обработчики CanvasView и раз в несколько событий
+# синхронно перерисовывает окно, как это сделал бы цикл событий
+class EventDriver:
+    def __init__(self, app, window, frame_events=FRAME_EVENTS):
+        self.app = app
+        self.window = window
+        self.view = window.view
+        self.frame_events = frame_events
+        self.events = 0
+
+    def frame(self):
+        # Кадр: накопленные движения применяются к инструменту, затем холст перерисовывается
+        self.view.flushInput()
+        self.view.viewport().repaint()
+        self.app.processEvents()
+
+    def _dispatch(self, handler, event):
+        handler(event)
+        self.events += 1
+        if self.events % self.frame_events == 0:
+            self.frame()
+
+    def press(self, point, button=Qt.LeftButton):
+        self._dispatch(self.view.mousePressEvent,
+                       QMouseEvent(QEvent.MouseButtonPress, QPointF(*point), button, button, Qt.NoModifier))
+
+    def move(self, point, button=Qt.LeftButton):
+        self._dispatch(self.view.mouseMoveEvent,
+                       QMouseEvent(QEvent.MouseMove, QPointF(*point), Qt.NoButton, button, Qt.NoModifier))
+
+    def release(self, point, button=Qt.LeftButton):
+        self._dispatch(self.view.mouseReleaseEvent,
+                       QMouseEvent(QEvent.MouseButtonRelease, QPointF(*point), button, Qt.NoButton, Qt.NoModifier))
+
+    def drag(self, points, button=Qt.LeftButton):
+        self.press(points[0], button)
+        for point in points[1:]:
+            self.move(point, button)
+        self.release(points[-1], button)
+        self.frame()
+
+    def wheel(self, steps, point):
+        position = QPointF(*point)
+        event = QWheelEvent(position, position, QPoint(0, 0), QPoint(0, 120 * steps),
+                            Qt.NoButton, Qt.NoModifier, Qt.NoScrollPhase, False)
+        self._dispatch(self.view.wheelEvent, event)
+
+
+def scenario_long_stroke(driver, rng):
+    driver.window.selectBrushTool()
+    width, height = VIEWPORT_SIZE
+    driver.drag(spiral((width / 2, height / 2), 8, min(width, height) * 0.45, 3000))
+
+
+def scenario_dense_scribble(driver, rng):
+    driver.window.selectBrushTool()
+    width, height = VIEWPORT_SIZE
+    for _ in range(12):
+        x, y = rng.uniform(100, width - 100), rng.uniform(100, height - 100)
+        points = []
+        for _ in range(150):
+            x = min(max(x + rng.gauss(0, 8), 0), width)
+            y = min(max(y + rng.gauss(0, 8), 0), height)
+            points.append((x, y))
+        driver.drag(points)
+
+
+def scenario_lasso_fill(driver, rng):
+    driver.window.selectLassoFillTool()
+    width, height = VIEWPORT_SIZE
+    driver.drag(star((width / 2, height / 2), min(width, height) * 0.45, 1500))
+
+
+def scenario_lasso_erase(driver, rng):
+    driver.window.selectLassoEraseTool()
+    width, height = VIEWPORT_SIZE
+    driver.drag(star((width / 2, height / 2), min(width, height) * 0.3, 1000, spikes=8))
+
+
+def scenario_zoom_pan(driver, rng):
+    width, height = VIEWPORT_SIZE
+    center = (width / 2, height / 2)
+    # Отдаление до режима тайлов и обратно с панорамированием на каждом шаге
+    for direction in (-1, 1):
+        for _ in range(12):
+            driver.wheel(direction, center)
+            dx, dy = rng.uniform(-300, 300), rng.uniform(-200, 200)
+            driver.drag([(center[0] + dx * i / 20, center[1] + dy * i / 20) for i in range(21)],
+                        Qt.MiddleButton)
+
+
+SCENARIOS = {
+    'long_stroke': scenario_long_stroke,
+    'dense_scribble': scenario_dense_scribble,
+    'lasso_fill': scenario_lasso_fill,
+    'lasso_erase': scenario_lasso_erase,
+    'zoom_pan': scenario_zoom_pan,
+}
+
+
+def wait_for(app, condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise BenchmarkError("Timed out")
+        app.processEvents()
+
+
+def measure_io(app, window, records, directory):
+    # Запись подготовленного документа, фоновая загрузка через окно и повторное сохранение из окна
+    source = os.path.join(directory, 'source.ess')
+    started = time.perf_counter()
+    write_ess(source, records)
+    generate_time = time.perf_counter() - started
+    file_size = os.path.getsize(source)
+
+    finished = []
+    window.canvas_loader.finished.connect(finished.append)
+    started = time.perf_counter()
+    window.openCanvas(source)
+    wait_for(app, lambda: finished, LOAD_TIMEOUT)
+    load_time = time.perf_counter() - started
+    window.canvas_loader.finished.disconnect(finished.append)
+    if not finished[0]:
+        raise BenchmarkError("Loading was cancelled")
+
+    target = os.path.join(directory, 'saved.ess')
+    started = time.perf_counter()
+    window.writeCanvas(target)
+    save_time = time.perf_counter() - started
+
+    # Один новый штрих и повторное сохранение в тот же файл: переписываются только его страницы
+    item = record_to_item(ItemRecord(KIND_PATH, 0xff000000, 2.0, np.array([[0.0, 0.0], [10.0, 10.0]])))
+    window.view.chunk_store.add_item(item)
+    window.history.push(AddItemsCommand([item]))
+    started = time.perf_counter()
+    window.writeCanvas(target)
+    incremental_save_time = time.perf_counter() - started
+
+    megabytes = file_size / (1024 * 1024)
+    return {
+        'items': len(records),
+        'file_bytes': file_size,
+        'write_ess_seconds': generate_time,
+        'load_seconds': load_time,
+        'load_items_per_second': len(records) / load_time if load_time else 0.0,
+        'load_mb_per_second': megabytes / load_time if load_time else 0.0,
+        'save_seconds': save_time,
+        'save_items_per_second': len(records) / save_time if save_time else 0.0,
+        'save_mb_per_second': os.path.getsize(target) / (1024 * 1024) / save_time if save_time else 0.0,
+        'incremental_save_seconds': incremental_save_time,
+    }
+
+
+def run_scenario(app, window, name, seed, frame_events):
+    driver = EventDriver(app, window, frame_events)
+    rng = random.Random(seed)
+    metrics.reset()
+    rss_before, _ = memory_usage()
+    started = time.perf_counter()
+    SCENARIOS[name](driver, rng)
+    wall_time = time.perf_counter() - started
+    rss_after, peak = memory_usage()
+    snapshot = metrics.snapshot()
+    histograms = snapshot['histograms']
+    return {
+        'scenario': name,
+        'events': driver.events,
+        'wall_seconds': wall_time,
+        'events_per_second': driver.events / wall_time if wall_time else 0.0,
+        'latency': {key[len('event.'):]: value for key, value in histograms.items() if key.startswith('event.')},
+        'paint': histograms.get('paint'),
+        'event_to_paint': histograms.get('event_to_paint'),
+        'scene_update': histograms.get('scene.update_view'),
+        'counters': snapshot['counters'],
+        'items_after': len(window.view.chunk_store),
+        'memory': {'rss_bytes': rss_after, 'rss_delta_bytes': rss_after - rss_before, 'peak_rss_bytes': peak},
+    }
+
+
+def run_size(app, size, scenarios, seed, frame_events):
+    window = CanvasWindow()
+    window.resize(*VIEWPORT_SIZE)
+    window.show()
+    app.processEvents()
+    try:
+        with tempfile.TemporaryDirectory(prefix='endless_sketch_bench_') as directory:
+            io = measure_io(app, window, synthetic_records(size, seed), directory)
+            results = []
+            for name in scenarios:
+                print(f"  {name}...", file=sys.stderr)
+                results.append(run_scenario(app, window, name, seed, frame_events))
+        return {'canvas_size': size, 'io': io, 'scenarios': results}
+    finally:
+        window.close()
+        window.deleteLater()
+        app.processEvents()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности EndlessSketch без дисплея")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="размеры холста в элементах через запятую")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="сценарии через запятую: " + ', '.join(SCENARIOS))
+    parser.add_argument('--frame-events', type=int, default=FRAME_EVENTS,
+                        help="событий ввода на один кадр")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл для результатов в JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    app = QApplication(sys.argv)
+    # Журнал автосохранения пишется во временный каталог, чтобы не трогать сеансы пользователя
+    autosave = tempfile.TemporaryDirectory(prefix='endless_sketch_bench_autosave_')
+    os.environ[AUTOSAVE_DIR_ENV] = autosave.name
+
+    # Модальный диалог без дисплея повис бы навсегда — ошибка должна прервать замер
+    def critical(parent, title, text, *args, **kwargs):
+        raise BenchmarkError(text)
+    QMessageBox.critical = staticmethod(critical)
+
+    metrics.setEnabled(True)
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'pyqt': PYQT_VERSION_STR,
+            'platform': platform.platform(),
+            'qpa': app.platformName(),
+            'viewport': list(VIEWPORT_SIZE),
+            'frame_events': args.frame_events,
+            'seed': args.seed,
+        },
+        'results': [],
+    }
+    for size in sizes:
+        print(f"Canvas size {size}", file=sys.stderr)
+        report['results'].append(run_size(app, size, scenarios, args.seed, args.frame_events))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
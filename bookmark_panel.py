@@ -0,0 +1,96 @@
+# bookmark_panel.py
+
+import logging
+from PyQt5.QtWidgets import (
+    QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QListWidgetItem, QPushButton, QMessageBox
+)
+from PyQt5.QtCore import Qt, pyqtSignal
+
+
+# Панель закладок документа: двойной щелчок переходит к закладке, имя меняется на месте.
+# Первые девять закладок доступны по Ctrl+1..Ctrl+9
+class BookmarkPanel(QDockWidget):
+    addRequested = pyqtSignal()  # Добавить закладку на текущее место
+    jumpRequested = pyqtSignal(int)  # Перейти к закладке с номером
+
+    def __init__(self, bookmarks, parent=None):
+        super().__init__("Закладки", parent)
+        self.bookmarks = bookmarks
+        self.updating = False
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+
+        self.bookmark_list = QListWidget()
+        self.bookmark_list.itemActivated.connect(self.onItemActivated)
+        self.bookmark_list.itemChanged.connect(self.onItemChanged)
+        layout.addWidget(self.bookmark_list)
+
+        buttons_layout = QHBoxLayout()
+        for text, tip, slot in (("+", "Добавить закладку (Ctrl+D)", self.addRequested.emit),
+                                ("−", "Удалить закладку", self.removeBookmark),
+                                ("▲", "Выше", self.raiseBookmark),
+                                ("▼", "Ниже", self.lowerBookmark)):
+            button = QPushButton(text)
+            button.setToolTip(tip)
+            button.clicked.connect(slot)
+            buttons_layout.addWidget(button)
+        layout.addLayout(buttons_layout)
+
+        self.setWidget(widget)
+        self.bookmarks.listeners.append(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        self.updating = True
+        try:
+            # Как и у панели слоев, строки пересоздаются, только если их число изменилось
+            if self.bookmark_list.count() != len(self.bookmarks):
+                row = self.bookmark_list.currentRow()
+                self.bookmark_list.clear()
+                for _ in self.bookmarks:
+                    item = QListWidgetItem()
+                    item.setFlags(item.flags() | Qt.ItemIsEditable)
+                    self.bookmark_list.addItem(item)
+                self.bookmark_list.setCurrentRow(min(row, self.bookmark_list.count() - 1))
+            for index, bookmark in enumerate(self.bookmarks):
+                item = self.bookmark_list.item(index)
+                item.setText(bookmark['name'])
+                shortcut = f"Ctrl+{index + 1}, " if index < 9 else ""
+                item.setToolTip(f"{shortcut}x {bookmark['x']:.0f}, y {bookmark['y']:.0f}, "
+                                f"масштаб {bookmark['zoom_factor']:.3g}")
+        finally:
+            self.updating = False
+
+    def onItemActivated(self, item):
+        self.jumpRequested.emit(self.bookmark_list.row(item))
+
+    def onItemChanged(self, item):
+        if self.updating:
+            return
+        try:
+            index = self.bookmark_list.row(item)
+            if item.text() and item.text() != self.bookmarks[index]['name']:
+                self.bookmarks.rename(index, item.text())
+        except Exception as e:
+            logging.exception("Exception in BookmarkPanel onItemChanged:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при переименовании закладки:\n{e}")
+
+    def removeBookmark(self):
+        index = self.bookmark_list.currentRow()
+        if index >= 0:
+            self.bookmarks.remove(index)
+
+    def raiseBookmark(self):
+        self.moveCurrent(-1)
+
+    def lowerBookmark(self):
+        self.moveCurrent(1)
+
+    def moveCurrent(self, step):
+        index = self.bookmark_list.currentRow()
+        if index < 0:
+            return
+        position = max(0, min(index + step, len(self.bookmarks) - 1))
+        self.bookmarks.move(index, position)
+        self.bookmark_list.setCurrentRow(position)
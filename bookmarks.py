@@ -0,0 +1,63 @@
+# bookmarks.py
+
+
+def make_place(x, y, zoom_factor, name=None):
+    # Место на холсте в том же виде, что и файл места .esp; у закладки есть еще имя
+    place = {'x': float(x), 'y': float(y), 'zoom_factor': float(zoom_factor)}
+    if name is not None:
+        place['name'] = name
+    return place
+
+
+# Закладки документа - список мест с именами. Изменения сообщаются слушателям listener(),
+# а список целиком (state()) сохраняется в файл и журнал
+class BookmarkIndex:
+    def __init__(self):
+        self.bookmarks = []
+        self.listeners = []
+
+    def __iter__(self):
+        return iter(self.bookmarks)
+
+    def __len__(self):
+        return len(self.bookmarks)
+
+    def __getitem__(self, index):
+        return self.bookmarks[index]
+
+    def reset(self):
+        self.bookmarks = []
+        self._notify()
+
+    def add(self, place, name=None):
+        bookmark = dict(place)
+        bookmark['name'] = name or place.get('name') or f"Закладка {len(self.bookmarks) + 1}"
+        self.bookmarks.append(bookmark)
+        self._notify()
+        return len(self.bookmarks) - 1
+
+    def remove(self, index):
+        del self.bookmarks[index]
+        self._notify()
+
+    def rename(self, index, name):
+        self.bookmarks[index]['name'] = name
+        self._notify()
+
+    def move(self, index, position):
+        position = max(0, min(position, len(self.bookmarks) - 1))
+        self.bookmarks.insert(position, self.bookmarks.pop(index))
+        self._notify()
+
+    def state(self):
+        return [dict(bookmark) for bookmark in self.bookmarks]
+
+    def set_state(self, state):
+        self.bookmarks = [make_place(entry['x'], entry['y'], entry.get('zoom_factor', 1.0),
+                                     entry.get('name') or f"Закладка {index + 1}")
+                          for index, entry in enumerate(state)]
+        self._notify()
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
@@ -1,27 +1,62 @@
 # canvas_view.py
 
+import os
 import sys
+import time
 import logging
 from PyQt5.QtWidgets import (
     QMainWindow, QGraphicsView, QGraphicsScene, QToolBar, QAction,
     QColorDialog, QSlider, QLabel, QFileDialog, QGraphicsPathItem,
-    QMenu, QWidgetAction, QWidget, QVBoxLayout, QHBoxLayout, QStatusBar, QGraphicsPolygonItem, QMessageBox
+    QMenu, QWidgetAction, QWidget, QVBoxLayout, QHBoxLayout, QStatusBar, QGraphicsPolygonItem, QMessageBox,
+    QDoubleSpinBox, QProgressBar, QPushButton, QSpinBox, QProgressDialog, QApplication
 )
 from PyQt5.QtGui import (
-    QPainter, QMouseEvent, QWheelEvent, QPainterPath, QPen, QColor, QBrush, QPolygonF
+    QPainter, QMouseEvent, QWheelEvent, QPainterPath, QPen, QColor, QBrush, QPolygonF, QTransform, QImageReader
 )
-from PyQt5.QtCore import Qt, QEvent, QPointF
-from tools import BrushTool, LassoFillTool, LassoEraseTool, EyedropperTool
+from PyQt5.QtCore import Qt, QEvent, QPointF, QRectF, QTimer
+from tools import BrushTool, LassoFillTool, LassoEraseTool, EyedropperTool, editable_layer
 from settings import Settings
+from chunks import ChunkStore, CHUNK_SIZE, chunk_key
+from ess_format import is_paged_ess, encode_place, decode_place
+from loader import CanvasLoader
+from history import History, AddItemsCommand
+from instrumentation import log, metrics
+from tile_cache import TileCache, LOD_ZOOM_THRESHOLD
+from baking import StrokeBaker
+from document import DocumentPages
+from journal import Journal, orphan_sessions, discard_session
+from layer_panel import LayerPanel
+from bookmark_panel import BookmarkPanel
+from bookmarks import make_place
+from prefetch import PlacePrefetcher
+from image_item import ImageItem, image_pyramid, pyramid_signals
+from export import export_document, EXPORT_FORMATS
+from png_writer import MARGIN
+from input_recorder import InputRecorder, InputReplayer
 import json
 
+REBASE_PIXELS = 1 << 24  # Дальше этого (в пикселях вида) от начала координат сцены вид переносит начало к себе
+IMAGE_VIEW_FILL = 0.8  # Импортированное изображение занимает не больше этой доли вида
+
+
+def image_formats():
+    return {bytes(name).decode('ascii').lower() for name in QImageReader.supportedImageFormats()}
+
+
+def dropped_images(mime_data):
+    # Локальные файлы изображений из перетаскивания
+    if not mime_data.hasUrls():
+        return []
+    formats = image_formats()
+    return [url.toLocalFile() for url in mime_data.urls()
+            if url.isLocalFile() and os.path.splitext(url.toLocalFile())[1][1:].lower() in formats]
+
 class CanvasWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("EndlessSketch")
         self.setGeometry(100, 100, 800, 600)
         self.settings = Settings()
-        self.undo_stack = []  # Стек для отмены действий
         self.initUI()
 
     def initUI(self):
@@ -31,6 +66,33 @@ class CanvasWindow(QMainWindow):
             self.view = CanvasView(self.scene, self.settings)
             self.setCentralWidget(self.view)
 
+            # История действий для отмены и повтора
+            self.history = History(self.view.chunk_store,
+                                   memory_limit=self.settings.history_memory_limit_mb * 1024 * 1024)
+
+            # Страницы документа для сохранения только измененных областей
+            self.document = DocumentPages(self.view.chunk_store, self.history)
+
+            # Панель слоев
+            self.layer_panel = LayerPanel(self.view.chunk_store, self.history, self)
+            self.addDockWidget(Qt.RightDockWidgetArea, self.layer_panel)
+
+            # Панель закладок документа
+            self.bookmark_panel = BookmarkPanel(self.view.chunk_store.bookmarks, self)
+            self.bookmark_panel.addRequested.connect(self.addBookmark)
+            self.bookmark_panel.jumpRequested.connect(self.goToBookmark)
+            self.addDockWidget(Qt.RightDockWidgetArea, self.bookmark_panel)
+
+            # Журнал действий для восстановления после сбоя
+            self.journal = Journal(self.view.chunk_store, self.history, parent=self)
+            QTimer.singleShot(0, self.recoverAutosave)
+
+            # Фоновая загрузка холста
+            self.canvas_loader = CanvasLoader(self.view.chunk_store, self)
+            self.canvas_loader.progress.connect(self.onLoadProgress)
+            self.canvas_loader.finished.connect(self.onLoadFinished)
+            self.canvas_loader.failed.connect(self.onLoadFailed)
+
             # Создаем панель инструментов
             self.createToolBar()
 
@@ -104,6 +166,47 @@ class CanvasWindow(QMainWindow):
             self.brush_slider.setTickInterval(10)
             self.brush_slider.valueChanged.connect(self.changeBrushSize)
             status_bar.addPermanentWidget(self.brush_slider)
+
+            # Допуск упрощения линий (в пикселях экрана)
+            simplify_label = QLabel("Упрощение:")
+            status_bar.addPermanentWidget(simplify_label)
+
+            self.simplify_spin = QDoubleSpinBox()
+            self.simplify_spin.setRange(0.0, 10.0)
+            self.simplify_spin.setSingleStep(0.25)
+            self.simplify_spin.setSuffix(" px")
+            self.simplify_spin.setValue(self.settings.simplify_tolerance)
+            self.simplify_spin.valueChanged.connect(self.changeSimplifyTolerance)
+            status_bar.addPermanentWidget(self.simplify_spin)
+
+            # Размер области усреднения пипетки и образец цвета
+            sample_label = QLabel("Пипетка:")
+            status_bar.addPermanentWidget(sample_label)
+
+            self.sample_spin = QSpinBox()
+            self.sample_spin.setRange(1, 15)
+            self.sample_spin.setSingleStep(2)
+            self.sample_spin.setSuffix(" px")
+            self.sample_spin.setValue(self.settings.eyedropper_sample_size)
+            self.sample_spin.valueChanged.connect(self.changeSampleSize)
+            status_bar.addPermanentWidget(self.sample_spin)
+
+            self.color_preview = QLabel()
+            self.color_preview.setMinimumWidth(90)
+            self.color_preview.setAlignment(Qt.AlignCenter)
+            status_bar.addPermanentWidget(self.color_preview)
+            self.showColorPreview(self.settings.current_color)
+
+            # Индикатор фоновой загрузки холста
+            self.load_progress = QProgressBar()
+            self.load_progress.setMaximumWidth(150)
+            self.load_progress.hide()
+            status_bar.addWidget(self.load_progress)
+
+            self.load_cancel_button = QPushButton("Отмена")
+            self.load_cancel_button.clicked.connect(self.canvas_loader.cancel)
+            self.load_cancel_button.hide()
+            status_bar.addWidget(self.load_cancel_button)
         except Exception as e:
             logging.exception("Exception in createStatusBar:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при создании статус-бара:\n{e}")
@@ -136,206 +239,568 @@ class CanvasWindow(QMainWindow):
             load_place_action.triggered.connect(self.loadPlace)
             load_place_action.setShortcut("Ctrl+Shift+O")  # Горячая клавиша Ctrl+Shift+O
             file_menu.addAction(load_place_action)
+
+            # Импорт изображения-референса
+            import_image_action = QAction('Импорт изображения...', self)
+            import_image_action.triggered.connect(self.importImage)
+            import_image_action.setShortcut("Ctrl+I")  # Горячая клавиша Ctrl+I
+            file_menu.addAction(import_image_action)
+
+            # Экспорт в PNG, SVG или PDF
+            export_all_action = QAction('Экспорт холста...', self)
+            export_all_action.triggered.connect(lambda: self.exportCanvas(True))
+            export_all_action.setShortcut("Ctrl+E")  # Горячая клавиша Ctrl+E
+            file_menu.addAction(export_all_action)
+
+            export_view_action = QAction('Экспорт видимой области...', self)
+            export_view_action.triggered.connect(lambda: self.exportCanvas(False))
+            export_view_action.setShortcut("Ctrl+Shift+E")  # Горячая клавиша Ctrl+Shift+E
+            file_menu.addAction(export_view_action)
+
+            # Слои
+            layers_menu = menubar.addMenu('Слои')
+
+            new_layer_action = QAction('Новый слой', self)
+            new_layer_action.triggered.connect(self.layer_panel.addLayer)
+            new_layer_action.setShortcut("Ctrl+Shift+N")  # Горячая клавиша Ctrl+Shift+N
+            layers_menu.addAction(new_layer_action)
+
+            layer_panel_action = self.layer_panel.toggleViewAction()
+            layer_panel_action.setText('Панель слоев')
+            layer_panel_action.setShortcut("F7")  # Горячая клавиша F7
+            layers_menu.addAction(layer_panel_action)
+
+            # Закладки
+            bookmarks_menu = menubar.addMenu('Закладки')
+
+            add_bookmark_action = QAction('Добавить закладку', self)
+            add_bookmark_action.triggered.connect(self.addBookmark)
+            add_bookmark_action.setShortcut("Ctrl+D")  # Горячая клавиша Ctrl+D
+            bookmarks_menu.addAction(add_bookmark_action)
+
+            bookmark_panel_action = self.bookmark_panel.toggleViewAction()
+            bookmark_panel_action.setText('Панель закладок')
+            bookmark_panel_action.setShortcut("F8")  # Горячая клавиша F8
+            bookmarks_menu.addAction(bookmark_panel_action)
+
+            # Переход к первым девяти закладкам: Ctrl+1..Ctrl+9
+            for index in range(9):
+                jump_action = QAction(f'Закладка {index + 1}', self)
+                jump_action.setShortcut(f"Ctrl+{index + 1}")
+                jump_action.triggered.connect(lambda checked, index=index: self.goToBookmark(index))
+                self.addAction(jump_action)
+
+            # Отладка и метрики производительности
+            debug_menu = menubar.addMenu('Отладка')
+
+            self.metrics_action = QAction('Сбор метрик', self)
+            self.metrics_action.setCheckable(True)
+            self.metrics_action.setChecked(metrics.enabled)
+            self.metrics_action.toggled.connect(self.toggleMetrics)
+            debug_menu.addAction(self.metrics_action)
+
+            self.overlay_action = QAction('Оверлей метрик', self)
+            self.overlay_action.setCheckable(True)
+            self.overlay_action.setShortcut("F12")  # Горячая клавиша F12
+            self.overlay_action.toggled.connect(self.toggleMetricsOverlay)
+            debug_menu.addAction(self.overlay_action)
+
+            smooth_action = QAction('Сглаживание штрихов', self)
+            smooth_action.setCheckable(True)
+            smooth_action.setChecked(self.settings.smooth_strokes)
+            smooth_action.toggled.connect(self.toggleSmoothing)
+            debug_menu.addAction(smooth_action)
+
+            bake_action = QAction('Запекание штрихов', self)
+            bake_action.setCheckable(True)
+            bake_action.setChecked(self.settings.bake_strokes)
+            bake_action.toggled.connect(self.toggleBaking)
+            debug_menu.addAction(bake_action)
+
+            prefetch_action = QAction('Предзагрузка закладок', self)
+            prefetch_action.setCheckable(True)
+            prefetch_action.setChecked(self.settings.prefetch_places)
+            prefetch_action.toggled.connect(self.togglePrefetch)
+            debug_menu.addAction(prefetch_action)
+
+            self.record_input_action = QAction('Запись ввода...', self)
+            self.record_input_action.setCheckable(True)
+            self.record_input_action.toggled.connect(self.toggleInputRecording)
+            debug_menu.addAction(self.record_input_action)
+
+            replay_action = QAction('Воспроизвести запись...', self)
+            replay_action.triggered.connect(lambda: self.replayInput(fast=False))
+            debug_menu.addAction(replay_action)
+
+            replay_fast_action = QAction('Воспроизвести запись быстро...', self)
+            replay_fast_action.triggered.connect(lambda: self.replayInput(fast=True))
+            debug_menu.addAction(replay_fast_action)
+
+            dump_metrics_action = QAction('Сохранить метрики...', self)
+            dump_metrics_action.triggered.connect(self.dumpMetrics)
+            debug_menu.addAction(dump_metrics_action)
+
+            reset_metrics_action = QAction('Сбросить метрики', self)
+            reset_metrics_action.triggered.connect(metrics.reset)
+            debug_menu.addAction(reset_metrics_action)
         except Exception as e:
             logging.exception("Exception in createMenuBar:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при создании меню:\n{e}")
 
     def selectBrushTool(self):
-        print("CanvasWindow: Selected BrushTool")
-        self.view.current_tool = BrushTool(self.settings)
+        log.debug("CanvasWindow: Selected BrushTool")
+        self.view.setTool(BrushTool(self.settings))
 
     def selectLassoFillTool(self):
-        print("CanvasWindow: Selected LassoFillTool")
-        self.view.current_tool = LassoFillTool(self.settings)
+        log.debug("CanvasWindow: Selected LassoFillTool")
+        self.view.setTool(LassoFillTool(self.settings))
 
     def selectLassoEraseTool(self):
-        print("CanvasWindow: Selected LassoEraseTool")
-        self.view.current_tool = LassoEraseTool(self.settings)
+        log.debug("CanvasWindow: Selected LassoEraseTool")
+        self.view.setTool(LassoEraseTool(self.settings))
 
     def selectEyedropperTool(self):
-        print("CanvasWindow: Selected EyedropperTool")
-        self.view.current_tool = EyedropperTool(self.settings)
+        log.debug("CanvasWindow: Selected EyedropperTool")
+        self.view.setTool(EyedropperTool(self.settings))
 
     def chooseColor(self):
         try:
             color = QColorDialog.getColor()
             if color.isValid():
                 self.settings.current_color = color
-                print(f"CanvasWindow: Color changed to {color.name()}")
+                self.showColorPreview(color)
+                if self.view.input_recorder is not None:
+                    self.view.input_recorder.color(color)
+                log.debug("CanvasWindow: Color changed to %s", color.name())
         except Exception as e:
             logging.exception("Exception in chooseColor:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при выборе цвета:\n{e}")
 
     def changeBrushSize(self, value):
         try:
-            print(f"CanvasWindow: Brush size percentage changed to {value}%")
+            log.debug("CanvasWindow: Brush size percentage changed to %s%%", value)
             self.settings.brush_size_percentage = value
+            if self.view.input_recorder is not None:
+                self.view.input_recorder.brush(value)
             self.view.updateBrushSize()
         except Exception as e:
             logging.exception("Exception in changeBrushSize:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при изменении размера кисти:\n{e}")
 
+    def changeSimplifyTolerance(self, value):
+        try:
+            log.debug("CanvasWindow: Simplify tolerance changed to %spx", value)
+            self.settings.simplify_tolerance = value
+        except Exception as e:
+            logging.exception("Exception in changeSimplifyTolerance:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при изменении упрощения линий:\n{e}")
+
+    def changeSampleSize(self, value):
+        try:
+            log.debug("CanvasWindow: Eyedropper sample size changed to %s", value)
+            self.settings.eyedropper_sample_size = value
+        except Exception as e:
+            logging.exception("Exception in changeSampleSize:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при изменении области пипетки:\n{e}")
+
+    def showColorPreview(self, color):
+        # Светлый текст на темном образце и наоборот
+        text_color = '#000000' if color.lightness() > 127 else '#ffffff'
+        self.color_preview.setStyleSheet(f"background-color: {color.name()}; color: {text_color};")
+        self.color_preview.setText(color.name())
+
     def saveCanvas(self):
-        print("CanvasWindow: Saving canvas")
+        log.debug("CanvasWindow: Saving canvas")
         try:
+            if self.canvas_loader.isRunning():
+                QMessageBox.information(self, "Сохранение", "Дождитесь окончания загрузки холста.")
+                return
             options = QFileDialog.Options()
             filename, _ = QFileDialog.getSaveFileName(self, "Сохранить холст", "",
                                                       "EndlessSketch Files (*.ess)", options=options)
             if filename:
-                data = []
-                for item in reversed(self.scene.items()):
-                    if isinstance(item, QGraphicsPathItem):
-                        path = item.path()
-                        # Extract path as list of points
-                        points = []
-                        for i in range(path.elementCount()):
-                            element = path.elementAt(i)
-                            points.append((element.x, element.y))
-                        # Get pen properties
-                        pen = item.pen()
-                        item_data = {
-                            'type': 'path',
-                            'color': pen.color().name(),
-                            'width': pen.widthF(),
-                            'path': points
-                        }
-                        data.append(item_data)
-                    elif isinstance(item, QGraphicsPolygonItem):
-                        polygon = item.polygon()
-                        points = [(point.x(), point.y()) for point in polygon]
-                        brush = item.brush()
-                        item_data = {
-                            'type': 'polygon',
-                            'color': brush.color().name(),
-                            'points': points
-                        }
-                        data.append(item_data)
-                with open(filename, 'w') as f:
-                    json.dump(data, f, indent=4)
-                print(f"CanvasWindow: Canvas saved to {filename}")
+                self.writeCanvas(filename)
+                log.debug("CanvasWindow: Canvas saved to %s", filename)
         except Exception as e:
             logging.exception("Exception in saveCanvas:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при сохранении холста:\n{e}")
 
+    def writeCanvas(self, filename):
+        # Повторное сохранение в тот же файл переписывает только измененные страницы
+        self.document.save(filename)
+        # Журнал продолжается от сохраненного файла; uid и z элементов хранятся в нем самом
+        self.journal.rebase(filename)
+
     def loadCanvas(self):
-        print("CanvasWindow: Loading canvas")
+        log.debug("CanvasWindow: Loading canvas")
         try:
             options = QFileDialog.Options()
             filename, _ = QFileDialog.getOpenFileName(self, "Загрузить холст", "",
                                                       "EndlessSketch Files (*.ess)", options=options)
             if filename:
-                with open(filename, 'r') as f:
-                    data = json.load(f)
-                self.scene.clear()
-                for item_data in data:  # Загружаем в том же порядке
-                    if item_data['type'] == 'path':
-                        path = QPainterPath()
-                        points = item_data['path']
-                        if points:
-                            path.moveTo(*points[0])
-                            for point in points[1:]:
-                                path.lineTo(*point)
-                        path_item = QGraphicsPathItem(path)
-                        pen = QPen(QColor(item_data['color']), item_data['width'])
-                        pen.setCapStyle(Qt.RoundCap)
-                        pen.setJoinStyle(Qt.RoundJoin)
-                        path_item.setPen(pen)
-                        self.scene.addItem(path_item)
-                    elif item_data['type'] == 'polygon':
-                        points = [QPointF(x, y) for x, y in item_data['points']]
-                        polygon = QPolygonF(points)
-                        brush_color = QColor(item_data['color'])
-                        brush = QBrush(brush_color)
-                        pen = QPen(Qt.NoPen)
-                        polygon_item = QGraphicsPolygonItem()
-                        polygon_item.setPolygon(polygon)
-                        polygon_item.setBrush(brush)
-                        polygon_item.setPen(pen)
-                        self.scene.addItem(polygon_item)
-                print(f"CanvasWindow: Canvas loaded from {filename}")
+                self.openCanvas(filename)
         except Exception as e:
             logging.exception("Exception in loadCanvas:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при загрузке холста:\n{e}")
 
+    def openCanvas(self, filename):
+        # Запускает фоновую загрузку; окончание сообщает сигнал canvas_loader.finished
+        self.canvas_loader.cancel()
+        self.view.chunk_store.clear()
+        self.history.clear()
+        self.document.reset()
+        self.journal.rebase(filename)
+
+        # Если рядом лежит файл места с тем же именем, сначала переходим к нему
+        place_filename = os.path.splitext(filename)[0] + '.esp'
+        if os.path.exists(place_filename):
+            self.applyPlace(self.readPlace(place_filename))
+
+        # Элементы в видимой области загружаются первыми
+        focus_rect = self.view.visibleDocumentRect()
+        self.canvas_loader.start(filename, focus_rect)
+        self.load_progress.setRange(0, 0)
+        self.load_progress.show()
+        self.load_cancel_button.show()
+
+    def toggleMetrics(self, enabled):
+        metrics.setEnabled(enabled)
+        if not enabled and self.overlay_action.isChecked():
+            self.overlay_action.setChecked(False)
+
+    def toggleMetricsOverlay(self, enabled):
+        # Оверлей без сбора метрик бесполезен
+        if enabled and not metrics.enabled:
+            self.metrics_action.setChecked(True)
+        metrics.overlay = enabled
+        self.view.viewport().update()
+
+    def toggleSmoothing(self, enabled):
+        self.settings.smooth_strokes = enabled
+
+    def toggleBaking(self, enabled):
+        self.settings.bake_strokes = enabled
+        self.view.stroke_baker.setEnabled(enabled)
+
+    def togglePrefetch(self, enabled):
+        self.settings.prefetch_places = enabled
+        self.view.prefetcher.setEnabled(enabled)
+
+    def dumpMetrics(self):
+        try:
+            options = QFileDialog.Options()
+            filename, _ = QFileDialog.getSaveFileName(self, "Сохранить метрики", "",
+                                                      "JSON Files (*.json)", options=options)
+            if filename:
+                metrics.dump(filename)
+        except Exception as e:
+            logging.exception("Exception in dumpMetrics:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при сохранении метрик:\n{e}")
+
+    def toggleInputRecording(self, enabled):
+        try:
+            if not enabled:
+                recorder, self.view.input_recorder = self.view.input_recorder, None
+                if recorder is None:
+                    return
+                events = recorder.close()
+                if recorder.error is not None:
+                    QMessageBox.critical(self, "Ошибка", f"Запись ввода прервана:\n{recorder.error}")
+                else:
+                    self.statusBar().showMessage(f"Запись ввода сохранена: {events} событий", 5000)
+                return
+            options = QFileDialog.Options()
+            filename, _ = QFileDialog.getSaveFileName(self, "Запись ввода", "",
+                                                      "EndlessSketch Recording Files (*.esr)", options=options)
+            if not filename:
+                self.record_input_action.setChecked(False)
+                return
+            self.view.input_recorder = InputRecorder(filename, self)
+            self.statusBar().showMessage("Идет запись ввода", 5000)
+        except Exception as e:
+            logging.exception("Exception in toggleInputRecording:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при записи ввода:\n{e}")
+            self.record_input_action.setChecked(False)
+
+    def replayInput(self, fast):
+        try:
+            if self.view.input_recorder is not None:
+                self.statusBar().showMessage("Сначала остановите запись ввода", 5000)
+                return
+            options = QFileDialog.Options()
+            filename, _ = QFileDialog.getOpenFileName(self, "Воспроизвести запись", "",
+                                                      "EndlessSketch Recording Files (*.esr)", options=options)
+            if not filename:
+                return
+            answer = QMessageBox.question(
+                self, "Воспроизведение",
+                "Холст будет заменен документом из записи. Продолжить?",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer != QMessageBox.Yes:
+                return
+            replayer = InputReplayer(self, filename)
+
+            # Вид подгоняется под записанный размер до начала: окну для этого нужен цикл событий,
+            # а во время воспроизведения он не запускается
+            if self.isMaximized() or self.isFullScreen():
+                self.showNormal()
+            dx, dy = replayer.viewportDelta()
+            self.resize(self.width() + dx, self.height() + dy)
+            QApplication.processEvents()
+            replayer.prepare()
+            results = replayer.run(fast)
+            message = (f"Воспроизведено кадров: {results['frames']} за {results['wall_seconds']:.2f} с, "
+                       f"кадр p50 {results['frame_p50'] * 1000:.1f} мс, p95 {results['frame_p95'] * 1000:.1f} мс")
+            self.statusBar().showMessage(message)
+            log.debug("CanvasWindow: %s", message)
+
+            timings, _ = QFileDialog.getSaveFileName(self, "Сохранить времена воспроизведения",
+                                                     os.path.splitext(filename)[0] + '-replay.json',
+                                                     "JSON Files (*.json)", options=options)
+            if timings:
+                with open(timings, 'w') as f:
+                    json.dump(results, f, indent=4)
+        except Exception as e:
+            logging.exception("Exception in replayInput:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при воспроизведении записи:\n{e}")
+
+    def onLoadProgress(self, done, total):
+        self.load_progress.setRange(0, max(total, 1))
+        self.load_progress.setValue(done)
+
+    def onLoadFinished(self, completed):
+        self.load_progress.hide()
+        self.load_cancel_button.hide()
+        if not completed:
+            self.statusBar().showMessage("Загрузка холста отменена", 5000)
+            return
+        try:
+            if is_paged_ess(self.canvas_loader.filename):
+                self.document.attach(self.canvas_loader.filename)
+        except Exception as e:
+            logging.exception("Exception in onLoadFinished:")
+
+    def onLoadFailed(self, message):
+        self.load_progress.hide()
+        self.load_cancel_button.hide()
+        QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при загрузке холста:\n{message}")
+
     def savePlace(self):
-        print("CanvasWindow: Saving place")
+        log.debug("CanvasWindow: Saving place")
         try:
             options = QFileDialog.Options()
             filename, _ = QFileDialog.getSaveFileName(self, "Сохранить место", "",
                                                       "EndlessSketch Place Files (*.esp)", options=options)
             if filename:
-                center = self.view.mapToScene(self.view.viewport().rect().center())
-                place = {
-                    'x': center.x(),
-                    'y': center.y(),
-                    'zoom_factor': self.view.zoom_factor  # Используем zoom_factor из view
-                }
                 with open(filename, 'w') as f:
-                    json.dump(place, f, indent=4)
-                print(f"CanvasWindow: Place saved to {filename}")
+                    json.dump(encode_place(self.currentPlace()), f, indent=4)
+                log.debug("CanvasWindow: Place saved to %s", filename)
         except Exception as e:
             logging.exception("Exception in savePlace:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при сохранении места:\n{e}")
 
     def loadPlace(self):
-        print("CanvasWindow: Loading place")
+        log.debug("CanvasWindow: Loading place")
         try:
             options = QFileDialog.Options()
             filename, _ = QFileDialog.getOpenFileName(self, "Загрузить место", "",
                                                       "EndlessSketch Place Files (*.esp)", options=options)
             if filename:
-                with open(filename, 'r') as f:
-                    place = json.load(f)
-                # Reset zoom to 1.0 first
-                self.resetZoom()
+                self.applyPlace(self.readPlace(filename))
+                log.debug("CanvasWindow: Place loaded from %s", filename)
+        except Exception as e:
+            logging.exception("Exception in loadPlace:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при загрузке места:\n{e}")
 
-                # Apply saved zoom factor
-                target_zoom = place.get('zoom_factor', 1.0)
-                if target_zoom <= 0:
-                    print("CanvasWindow: Invalid zoom_factor in place file")
-                    target_zoom = 1.0
+    def importImage(self):
+        log.debug("CanvasWindow: Importing image")
+        try:
+            options = QFileDialog.Options()
+            patterns = " ".join(f"*.{name}" for name in sorted(image_formats()))
+            filename, _ = QFileDialog.getOpenFileName(self, "Импорт изображения", "",
+                                                      f"Изображения ({patterns})", options=options)
+            if filename:
+                self.view.addImage(filename)
+        except Exception as e:
+            logging.exception("Exception in importImage:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при импорте изображения:\n{e}")
 
-                scale_factor = target_zoom / self.view.zoom_factor
-                self.view.scale(scale_factor, scale_factor)
-                self.view.zoom_factor = target_zoom
-                print(f"CanvasWindow: Zoom factor set to {self.view.zoom_factor}")
+    def exportCanvas(self, everything=True):
+        # Весь рисунок экспортируется в масштабе 1, видимая область - в текущем масштабе вида
+        log.debug("CanvasWindow: Exporting %s", "canvas" if everything else "visible area")
+        try:
+            if self.canvas_loader.isRunning():
+                QMessageBox.information(self, "Экспорт", "Дождитесь окончания загрузки холста.")
+                return
+            store = self.view.chunk_store
+            if everything:
+                rect = store.items_bounds(set(store.layers.visible_ids()))
+                if rect is None:
+                    QMessageBox.information(self, "Экспорт", "Холст пуст.")
+                    return
+                rect = rect.adjusted(-MARGIN, -MARGIN, MARGIN, MARGIN)
+                zoom = 1.0
+            else:
+                rect = self.view.visibleDocumentRect()
+                zoom = self.view.zoom_factor
+            options = QFileDialog.Options()
+            filters = ";;".join(f"{extension.upper()} (*.{extension})" for extension in EXPORT_FORMATS)
+            filename, selected = QFileDialog.getSaveFileName(self, "Экспорт", "", filters, options=options)
+            if not filename:
+                return
+            if os.path.splitext(filename)[1][1:].lower() not in EXPORT_FORMATS:
+                filename += "." + selected.split()[0].lower()
+            if self.runExport(export_document(store, filename, rect, zoom), filename):
+                self.statusBar().showMessage(f"Экспорт сохранен в {filename}", 5000)
+                log.debug("CanvasWindow: Exported to %s", filename)
+        except Exception as e:
+            logging.exception("Exception in exportCanvas:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при экспорте:\n{e}")
 
-                # Center view on saved coordinates
-                self.view.centerOn(place['x'], place['y'])
-                print(f"CanvasWindow: Place loaded from {filename}")
+    def runExport(self, steps, filename):
+        # Шаги экспорта идут под модальным окном прогресса: холст не меняется, пока файл пишется.
+        # Прерванный экспорт удаляет недописанный файл
+        progress = QProgressDialog("Экспорт...", "Отмена", 0, 1, self)
+        progress.setWindowTitle("Экспорт")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(300)
+        completed = False
+        try:
+            for done, total in steps:
+                progress.setMaximum(total)
+                progress.setValue(done)
+                if progress.wasCanceled():
+                    break
+            else:
+                completed = True
+        finally:
+            steps.close()
+            progress.close()
+            if not completed and os.path.exists(filename):
+                os.remove(filename)
+        return completed
 
-                # Обновляем размер кисти после изменения масштаба
-                self.view.updateBrushSize()
+    def currentPlace(self):
+        center = self.view.mapToDocument(self.view.viewport().rect().center())
+        return make_place(center.x(), center.y(), self.view.zoom_factor)
+
+    def addBookmark(self):
+        try:
+            index = self.view.chunk_store.bookmarks.add(self.currentPlace())
+            self.statusBar().showMessage(f"Добавлена закладка {index + 1}", 3000)
+            log.debug("CanvasWindow: Bookmark %s added", index + 1)
         except Exception as e:
-            logging.exception("Exception in loadPlace:")
-            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при загрузке места:\n{e}")
+            logging.exception("Exception in addBookmark:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при добавлении закладки:\n{e}")
+
+    def goToBookmark(self, index):
+        try:
+            bookmarks = self.view.chunk_store.bookmarks
+            if not 0 <= index < len(bookmarks):
+                self.statusBar().showMessage(f"Закладки {index + 1} нет", 3000)
+                return
+            self.applyPlace(bookmarks[index])
+            log.debug("CanvasWindow: Jumped to bookmark %s", index + 1)
+        except Exception as e:
+            logging.exception("Exception in goToBookmark:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при переходе к закладке:\n{e}")
+
+    def recoverAutosave(self):
+        try:
+            orphans = orphan_sessions(self.journal.directory)
+            if orphans:
+                answer = QMessageBox.question(
+                    self, "Восстановление",
+                    "Предыдущий сеанс завершился аварийно. Восстановить несохраненные изменения?",
+                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+                if answer == QMessageBox.Yes:
+                    self.view.chunk_store.clear()
+                    self.history.clear()
+                    self.journal.adopt(orphans[0])
+                    self.view.updateVisibleChunks()
+                    log.debug("CanvasWindow: Restored %s items from %s", len(self.view.chunk_store), orphans[0])
+                    return
+                discard_session(orphans[0])
+            self.journal.start()
+        except Exception as e:
+            logging.exception("Exception in recoverAutosave:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при восстановлении холста:\n{e}")
+            if self.journal.session_dir is None:
+                self.journal.start()
+
+    def closeEvent(self, event):
+        # Штатное завершение: журнал восстановления больше не нужен
+        self.record_input_action.setChecked(False)
+        self.canvas_loader.cancel()
+        self.view.tile_cache.shutdown()
+        self.journal.close(discard=True)
+        super().closeEvent(event)
+
+    def readPlace(self, filename):
+        with open(filename, 'r') as f:
+            return decode_place(json.load(f))
+
+    def applyPlace(self, place):
+        target_zoom = place.get('zoom_factor', 1.0)
+        if target_zoom <= 0:
+            log.warning("CanvasWindow: Invalid zoom_factor in place file")
+            target_zoom = 1.0
+
+        # Масштаб выставляется сразу, без промежуточного сброса к 1.0: иначе по пути
+        # подгружались бы чанки или тайлы вокруг старого центра
+        self.view.zoom_factor = target_zoom
+        self.view.setTransform(QTransform.fromScale(target_zoom, target_zoom))
+        log.debug("CanvasWindow: Zoom factor set to %s", self.view.zoom_factor)
+
+        # Center view on saved coordinates
+        self.view.centerOnDocument(place['x'], place['y'])
+        self.view.updateVisibleChunks()
+
+        # Обновляем размер кисти после изменения масштаба
+        self.view.updateBrushSize()
 
     def resetZoom(self):
-        print("CanvasWindow: Resetting zoom to 1.0")
+        log.debug("CanvasWindow: Resetting zoom to 1.0")
         # Reset the view's scale to original
+        center = self.view.mapToDocument(self.view.viewport().rect().center())
         self.view.resetTransform()
         self.view.zoom_factor = 1.0
-        print("CanvasWindow: Zoom reset to 1.0")
+        self.view.centerOnDocument(center.x(), center.y())
+        self.view.updateVisibleChunks()
+        log.debug("CanvasWindow: Zoom reset to 1.0")
 
     def undo(self):
         try:
-            if self.undo_stack:
-                last_action = self.undo_stack.pop()
-                for item in last_action:
-                    self.scene.removeItem(item)
-                print("CanvasWindow: Last action undone")
+            if self.history.undo():
+                log.debug("CanvasWindow: Last action undone")
             else:
-                print("CanvasWindow: Undo stack is empty")
+                log.debug("CanvasWindow: Undo stack is empty")
         except Exception as e:
             logging.exception("Exception in undo:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при отмене действия:\n{e}")
 
+    def redo(self):
+        try:
+            if self.history.redo():
+                log.debug("CanvasWindow: Last undone action redone")
+            else:
+                log.debug("CanvasWindow: Redo stack is empty")
+        except Exception as e:
+            logging.exception("Exception in redo:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при повторе действия:\n{e}")
+
     def keyPressEvent(self, event):
         try:
+            if self.view.input_recorder is not None:
+                self.view.input_recorder.key(event)
             if event.key() == Qt.Key_C and event.modifiers() & Qt.ControlModifier:
                 self.chooseColor()
             elif event.key() == Qt.Key_S and event.modifiers() & Qt.ControlModifier and event.modifiers() & Qt.ShiftModifier:
                 self.savePlace()
+            elif event.key() == Qt.Key_Z and event.modifiers() & Qt.ControlModifier and event.modifiers() & Qt.ShiftModifier:
+                self.redo()
+            elif event.key() == Qt.Key_Y and event.modifiers() & Qt.ControlModifier:
+                self.redo()
             elif event.key() == Qt.Key_Z and event.modifiers() & Qt.ControlModifier:
                 self.undo()
             elif event.key() == Qt.Key_F1:
@@ -348,7 +813,7 @@ class CanvasWindow(QMainWindow):
 
     def showHelp(self):
         try:
-            print("CanvasWindow: Showing help")
+            log.debug("CanvasWindow: Showing help")
             help_text = (
                 "<h2>EndlessSketch - Справка</h2>"
                 "<p>EndlessSketch - это приложение для рисования на бесконечном холсте (еще нет).</p>"
@@ -359,6 +824,9 @@ class CanvasWindow(QMainWindow):
                 "<li><b>Лассо Стирание (E):</b> Стирание произвольной области.</li>"
                 "<li><b>Пипетка (I):</b> Выбор цвета из области холста.</li>"
                 "</ul>"
+                "<h3>Слои:</h3>"
+                "<p>Кисть, заливка и стирание работают с текущим слоем, выбранным на панели слоев. "
+                "В скрытом или заблокированном слое рисовать нельзя. Пипетка берет цвет со всех видимых слоев.</p>"
                 "<h3>Горячие клавиши:</h3>"
                 "<ul>"
                 "<li><b>B:</b> Выбрать инструмент Кисть.</li>"
@@ -367,12 +835,25 @@ class CanvasWindow(QMainWindow):
                 "<li><b>I:</b> Выбрать инструмент Пипетка.</li>"
                 "<li><b>C:</b> Выбрать цвет.</li>"
                 "<li><b>Ctrl+z:</b> Отмена.</li>"
+                "<li><b>Ctrl+Shift+Z / Ctrl+Y:</b> Повтор.</li>"
                 "<li><b>Ctrl+S:</b> Сохранить холст.</li>"
                 "<li><b>Ctrl+O:</b> Загрузить холст.</li>"
                 "<li><b>Ctrl+Shift+S:</b> Сохранить место.</li>"
                 "<li><b>Ctrl+Shift+O:</b> Загрузить место.</li>"
+                "<li><b>Ctrl+I:</b> Импорт изображения (или перетащите файл на холст).</li>"
+                "<li><b>Ctrl+E / Ctrl+Shift+E:</b> Экспорт холста или видимой области в PNG, SVG или PDF.</li>"
+                "<li><b>Ctrl+Shift+N:</b> Новый слой.</li>"
+                "<li><b>F7:</b> Показать или скрыть панель слоев.</li>"
+                "<li><b>Ctrl+D:</b> Добавить закладку на текущее место.</li>"
+                "<li><b>Ctrl+1..Ctrl+9:</b> Перейти к закладке.</li>"
+                "<li><b>F8:</b> Показать или скрыть панель закладок.</li>"
                 "<li><b>F1:</b> Открыть справку.</li>"
+                "<li><b>F12:</b> Оверлей метрик.</li>"
                 "</ul>"
+                "<h3>Запись ввода:</h3>"
+                "<p>Меню <b>Отладка</b> записывает мышь, колесико, клавиши, смену инструмента, цвета и размера кисти "
+                "в файл .esr вместе с холстом и воспроизводит запись с теми же кадрами, как вживую или как можно быстрее, "
+                "с замером времени каждого кадра.</p>"
                 "<h3>Изменение размера кисти:</h3>"
                 "<p>Удерживайте клавишу <b>Shift</b> и прокручивайте колесико мыши для изменения размера кисти.</p>"
                 "<h3>Перемещение по холсту:</h3>"
@@ -391,16 +872,38 @@ class CanvasView(QGraphicsView):
             super().__init__(scene)
             self.settings = settings
             self.current_tool = BrushTool(self.settings)
+            self.chunk_store = ChunkStore(scene)  # Элементы холста, разбитые на чанки
+            self.tile_cache = TileCache(self.chunk_store)  # Растровые тайлы для отдаленного масштаба
+            self.lod_active = False
+            self.chunk_store.listeners.append(self.onCanvasChanged)
+            self.chunk_store.layers.listeners.append(self.onLayersChanged)
+            self.tile_cache.listeners.append(self.onTileReady)
+            self.stroke_baker = StrokeBaker(self.chunk_store, self)  # Запекание неизменяемых участков
+            self.stroke_baker.setEnabled(settings.bake_strokes)
+            self.prefetcher = PlacePrefetcher(self, self)  # Предзагрузка закладок и направления сдвига в простое
+            self.prefetcher.setEnabled(settings.prefetch_places)
+            pyramid_signals().built.connect(self.onImageBuilt)  # Готовые изображения заменяют заглушки
+            self.setAcceptDrops(True)
+            self.pending_input_time = None  # Время первого события, еще не показанного на экране
+            # Движения мыши копятся и передаются инструменту раз в кадр
+            self.pending_samples = []  # (x, y, время в мс) в координатах документа
+            self.input_timer = QTimer(self)
+            self.input_timer.setSingleShot(True)
+            self.input_timer.timeout.connect(self.onInputFrame)
+            self.input_recorder = None  # Запись ввода (InputRecorder), пока она включена
+            self.last_paint_time = None
             self.setRenderHint(QPainter.Antialiasing)
             self.last_point = None
             self.setDragMode(QGraphicsView.NoDrag)
             self.zoom_factor = 1.0  # Изначальный масштаб
-            print(f"CanvasView: Initialized with zoom_factor = {self.zoom_factor}")
+            log.debug("CanvasView: Initialized with zoom_factor = %s", self.zoom_factor)
 
             # Отключаем прокрутку
             self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
             self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+            # Точку под курсором при масштабировании держит wheelEvent: якорь Qt помнит
+            # координаты сцены, которые устаревают при переносе начала координат
+            self.setTransformationAnchor(QGraphicsView.NoAnchor)
             self.setResizeAnchor(QGraphicsView.NoAnchor)
 
             # Устанавливаем большой размер сцены
@@ -414,7 +917,10 @@ class CanvasView(QGraphicsView):
             sys.exit(1)
 
     def wheelEvent(self, event: QWheelEvent):
+        started = time.perf_counter() if metrics.enabled else 0.0
         try:
+            if self.input_recorder is not None:
+                self.input_recorder.wheel(event)
             if event.modifiers() & Qt.ShiftModifier:
                 # Изменение размера кисти
                 delta = event.angleDelta().y() / 8  # Получаем число "щелчков" колесика
@@ -427,17 +933,226 @@ class CanvasView(QGraphicsView):
                 if event.angleDelta().y() > 0:
                     scale_factor = zoom_in_factor
                     self.zoom_factor *= zoom_in_factor
-                    print(f"CanvasView: Zooming in. New zoom factor: {self.zoom_factor}")
+                    log.debug("CanvasView: Zooming in. New zoom factor: %s", self.zoom_factor)
                 else:
                     scale_factor = zoom_out_factor
                     self.zoom_factor *= zoom_out_factor
-                    print(f"CanvasView: Zooming out. New zoom factor: {self.zoom_factor}")
+                    log.debug("CanvasView: Zooming out. New zoom factor: %s", self.zoom_factor)
 
+                anchor = self.mapToDocument(event.pos())
                 self.scale(scale_factor, scale_factor)
+                self.keepDocumentPoint(anchor, event.pos())
+                self.updateVisibleChunks()
                 self.updateBrushSize()
         except Exception as e:
             logging.exception("Exception in wheelEvent:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при обработке события колесика мыши:\n{e}")
+        if started:
+            self.recordEvent('wheel', started)
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.updateVisibleChunks()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateVisibleChunks()
+
+    def mapToDocument(self, pos):
+        # Точка вида в координатах документа: сцена сдвинута на плавающее начало координат
+        return self.mapToScene(pos) + self.chunk_store.layers.origin
+
+    def visibleDocumentRect(self):
+        return self.mapToScene(self.viewport().rect()).boundingRect().translated(self.chunk_store.layers.origin)
+
+    def centerOnDocument(self, x, y):
+        # Центрирует вид на точке документа; далекая точка сначала становится началом координат
+        if self.isFarFromOrigin(x, y):
+            self.rebase(x, y)
+        origin = self.chunk_store.layers.origin
+        self.centerOn(x - origin.x(), y - origin.y())
+
+    def isFarFromOrigin(self, x, y):
+        origin = self.chunk_store.layers.origin
+        return max(abs(x - origin.x()), abs(y - origin.y())) * max(self.zoom_factor, 1.0) > REBASE_PIXELS
+
+    def keepDocumentPoint(self, point, pos):
+        # Сдвигает вид так, чтобы точка документа point оказалась под точкой вида pos
+        inverse = self.viewportTransform().inverted()[0]
+        offset = inverse.map(QRectF(self.viewport().rect()).center()) - inverse.map(QPointF(pos))
+        self.centerOnDocument(point.x() + offset.x(), point.y() + offset.y())
+
+    def rebase(self, x, y):
+        # Плавающее начало координат: начало чанка с точкой (x, y) становится началом сцены.
+        # Координаты сцены и полос прокрутки остаются небольшими на любом удалении от начала документа,
+        # иначе прокрутка QGraphicsView (int) переполняется, а отрисовка теряет точность
+        cx, cy = chunk_key(x, y)
+        origin = QPointF(cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+        if origin == self.chunk_store.layers.origin:
+            return
+        self.chunk_store.layers.set_origin(origin)
+        self.resetCachedContent()
+        log.debug("CanvasView: Origin moved to chunk (%s, %s)", cx, cy)
+
+    def updateVisibleChunks(self):
+        # Подгружаем в сцену только чанки рядом с видимой областью
+        started = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            center = self.mapToDocument(self.viewport().rect().center())
+            if self.isFarFromOrigin(center.x(), center.y()):
+                # Вид ушел далеко от начала координат - переносим его к центру вида
+                self.centerOnDocument(center.x(), center.y())
+            lod_active = self.zoom_factor < LOD_ZOOM_THRESHOLD
+            if lod_active != self.lod_active:
+                log.debug("CanvasView: Tile rendering %s", 'enabled' if lod_active else 'disabled')
+                self.lod_active = lod_active
+                self.resetCachedContent()
+                self.viewport().update()
+            # При отрисовке тайлами векторные элементы в сцене не нужны
+            self.chunk_store.set_suspended(lod_active)
+            visible_rect = self.visibleDocumentRect()
+            if lod_active:
+                self.tile_cache.retainVisible(visible_rect, self.zoom_factor)
+            else:
+                self.chunk_store.update_view(visible_rect)
+            self.prefetcher.onViewChanged(visible_rect, self.zoom_factor)
+        except Exception as e:
+            logging.exception("Exception in updateVisibleChunks:")
+        if started:
+            metrics.observe('scene.update_view', time.perf_counter() - started)
+
+    def onCanvasChanged(self, rect, layer):
+        if self.lod_active:
+            self.viewport().update()
+
+    def onLayersChanged(self):
+        # В векторном режиме сцена перерисуется сама; тайлы слоев смешиваются при отрисовке
+        if self.lod_active:
+            self.viewport().update()
+
+    def addImage(self, filename, pos=None):
+        # Ставит изображение по центру вида (или в точку вида pos) так, что пиксель изображения
+        # равен пикселю экрана; слишком большое уменьшается до IMAGE_VIEW_FILL вида
+        layer = editable_layer(self)
+        if layer is None:
+            return None
+        pyramid = image_pyramid(filename)
+        if pyramid.failed:
+            raise ValueError(f"Не удалось прочитать изображение {filename}")
+        viewport = self.viewport().rect()
+        width, height = pyramid.size
+        scale = min(1.0, IMAGE_VIEW_FILL * viewport.width() / width, IMAGE_VIEW_FILL * viewport.height() / height)
+        width, height = width * scale / self.zoom_factor, height * scale / self.zoom_factor
+        center = self.mapToDocument(viewport.center() if pos is None else pos)
+        item = ImageItem(filename, QRectF(center.x() - width / 2, center.y() - height / 2, width, height))
+        self.chunk_store.add_item(item, layer=layer)
+        self.window().history.push(AddItemsCommand([item]))
+        log.debug("CanvasView: Imported image %s (%sx%s)", filename, *pyramid.size)
+        return item
+
+    def onImageBuilt(self, source):
+        # Пирамида собралась: заглушки в сцене и в тайлах отдаленного масштаба перерисовываются
+        for item in self.chunk_store.items():
+            if isinstance(item, ImageItem) and item.source == source:
+                self.chunk_store.update_item(item)
+                item.update()
+
+    def dragEnterEvent(self, event):
+        if dropped_images(event.mimeData()):
+            event.acceptProposedAction()
+        else:
+            super().dragEnterEvent(event)
+
+    def dragMoveEvent(self, event):
+        if dropped_images(event.mimeData()):
+            event.acceptProposedAction()
+        else:
+            super().dragMoveEvent(event)
+
+    def dropEvent(self, event):
+        filenames = dropped_images(event.mimeData())
+        if not filenames:
+            super().dropEvent(event)
+            return
+        try:
+            for filename in filenames:
+                self.addImage(filename, event.pos())
+            event.acceptProposedAction()
+        except Exception as e:
+            logging.exception("Exception in dropEvent:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при импорте изображения:\n{e}")
+
+    def onTileReady(self, rect):
+        # Готовый тайл из пула потоков заменяет заглушку
+        if self.lod_active:
+            rect = rect.translated(-self.chunk_store.layers.origin)
+            self.viewport().update(self.mapFromScene(rect).boundingRect().adjusted(-1, -1, 1, 1))
+
+    def drawBackground(self, painter, rect):
+        super().drawBackground(painter, rect)
+        if self.lod_active:
+            try:
+                # Тайлы лежат в координатах документа
+                origin = self.chunk_store.layers.origin
+                painter.save()
+                painter.translate(-origin)
+                complete = self.tile_cache.draw(painter, rect.translated(origin), self.zoom_factor)
+                painter.restore()
+                if not complete:
+                    # Не все тайлы успели уйти в отрисовку — запросим их в следующем кадре
+                    QTimer.singleShot(0, self.viewport().update)
+            except Exception as e:
+                logging.exception("Exception in drawBackground:")
+
+    def recordEvent(self, name, started):
+        metrics.count('events.' + name)
+        metrics.observe('event.' + name, time.perf_counter() - started)
+        if self.pending_input_time is None:
+            self.pending_input_time = started
+
+    def paintEvent(self, event):
+        if self.input_recorder is not None:
+            self.input_recorder.frame()
+        if not metrics.enabled:
+            super().paintEvent(event)
+            return
+        started = time.perf_counter()
+        super().paintEvent(event)
+        finished = time.perf_counter()
+        metrics.observe('paint', finished - started)
+        if self.last_paint_time is not None:
+            metrics.observe('frame_interval', started - self.last_paint_time)
+        self.last_paint_time = started
+        if self.pending_input_time is not None:
+            metrics.observe('event_to_paint', finished - self.pending_input_time)
+            self.pending_input_time = None
+
+    def drawForeground(self, painter, rect):
+        super().drawForeground(painter, rect)
+        if metrics.overlay:
+            try:
+                self.drawMetricsOverlay(painter)
+            except Exception as e:
+                logging.exception("Exception in drawMetricsOverlay:")
+
+    def drawMetricsOverlay(self, painter):
+        lines = [f"Элементов в сцене: {len(self.scene().items())} / {len(self.chunk_store)}"]
+        for name, title in (('paint', 'Отрисовка'), ('frame_interval', 'Кадр'),
+                            ('event_to_paint', 'Событие→экран'), ('event.mouse_move', 'Движение мыши')):
+            histogram = metrics.histogram(name)
+            if histogram is not None:
+                lines.append(f"{title}: {histogram.last * 1000:.1f} мс (p95 {histogram.percentile(0.95) * 1000:.1f})")
+        painter.save()
+        painter.resetTransform()
+        metrics_rect = painter.fontMetrics().boundingRect(0, 0, 1000, 1000, Qt.AlignLeft, "\n".join(lines))
+        metrics_rect.adjust(-6, -6, 6, 6)
+        metrics_rect.moveTopLeft(self.viewport().rect().topLeft())
+        painter.fillRect(metrics_rect, QColor(0, 0, 0, 160))
+        painter.setPen(QColor(255, 255, 255))
+        painter.drawText(metrics_rect.adjusted(6, 6, -6, -6), Qt.AlignLeft, "\n".join(lines))
+        painter.restore()
+        # Оверлей должен обновляться, даже если холст не меняется
+        QTimer.singleShot(250, self.viewport().update)
 
     def changeBrushSizeByDelta(self, delta):
         try:
@@ -453,16 +1168,19 @@ class CanvasView(QGraphicsView):
 
             # Обновляем ползунок в статус-баре
             self.parent().brush_slider.setValue(self.settings.brush_size_percentage)
-            print(f"CanvasView: Brush size changed to {self.settings.brush_size_percentage}% via wheel")
+            log.debug("CanvasView: Brush size changed to %s%% via wheel", self.settings.brush_size_percentage)
             self.updateBrushSize()
         except Exception as e:
             logging.exception("Exception in changeBrushSizeByDelta:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при изменении размера кисти:\n{e}")
 
     def mousePressEvent(self, event: QMouseEvent):
+        started = time.perf_counter() if metrics.enabled else 0.0
         try:
+            if self.input_recorder is not None:
+                self.input_recorder.press(event)
             if event.button() == Qt.MiddleButton:
-                print("CanvasView: Middle mouse button pressed - activating drag mode")
+                log.debug("CanvasView: Middle mouse button pressed - activating drag mode")
                 self.setDragMode(QGraphicsView.ScrollHandDrag)
                 self.viewport().setCursor(Qt.ClosedHandCursor)
                 fake_event = QMouseEvent(
@@ -476,14 +1194,20 @@ class CanvasView(QGraphicsView):
             elif event.button() == Qt.RightButton:
                 self.showContextMenu(event)
             else:
+                self.flushInput(everything=True)
                 self.current_tool.on_press(event, self)
                 super(CanvasView, self).mousePressEvent(event)
         except Exception as e:
             logging.exception("Exception in mousePressEvent:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при обработке нажатия мыши:\n{e}")
+        if started:
+            self.recordEvent('mouse_press', started)
 
     def mouseMoveEvent(self, event: QMouseEvent):
+        started = time.perf_counter() if metrics.enabled else 0.0
         try:
+            if self.input_recorder is not None:
+                self.input_recorder.move(event)
             if event.buttons() & Qt.MiddleButton:
                 fake_event = QMouseEvent(
                     QEvent.MouseMove,
@@ -493,17 +1217,27 @@ class CanvasView(QGraphicsView):
                     event.modifiers()
                 )
                 super(CanvasView, self).mouseMoveEvent(fake_event)
+            elif not event.buttons() and hasattr(self.current_tool, 'on_hover'):
+                self.current_tool.on_hover(event, self)
             else:
-                self.current_tool.on_move(event, self)
+                document_pos = self.mapToDocument(event.pos())
+                self.pending_samples.append((document_pos.x(), document_pos.y(), event.timestamp()))
+                if not self.input_timer.isActive():
+                    self.input_timer.start(self.settings.input_frame_interval)
                 super(CanvasView, self).mouseMoveEvent(event)
         except Exception as e:
             logging.exception("Exception in mouseMoveEvent:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при обработке движения мыши:\n{e}")
+        if started:
+            self.recordEvent('mouse_move', started)
 
     def mouseReleaseEvent(self, event: QMouseEvent):
+        started = time.perf_counter() if metrics.enabled else 0.0
         try:
+            if self.input_recorder is not None:
+                self.input_recorder.release(event)
             if event.button() == Qt.MiddleButton:
-                print("CanvasView: Middle mouse button released - deactivating drag mode")
+                log.debug("CanvasView: Middle mouse button released - deactivating drag mode")
                 self.setDragMode(QGraphicsView.NoDrag)
                 self.viewport().setCursor(Qt.CrossCursor)
                 fake_event = QMouseEvent(
@@ -515,14 +1249,59 @@ class CanvasView(QGraphicsView):
                 )
                 super(CanvasView, self).mouseReleaseEvent(fake_event)
             else:
+                # Штрих должен получить все движения до отпускания
+                self.flushInput(everything=True)
                 self.current_tool.on_release(event, self)
                 super(CanvasView, self).mouseReleaseEvent(event)
         except Exception as e:
             logging.exception("Exception in mouseReleaseEvent:")
             QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при обработке отпускания мыши:\n{e}")
+        if started:
+            self.recordEvent('mouse_release', started)
+
+    def onInputFrame(self):
+        # Кадр ввода по таймеру; запись ввода отмечает его, чтобы при воспроизведении
+        # движения разбились на порции так же
+        if self.input_recorder is not None:
+            self.input_recorder.flush()
+        self.flushInput()
+
+    def flushInput(self, everything=False):
+        # Передает инструменту накопленные движения, не больше input_samples_per_frame за раз.
+        # Остаток уходит на следующий кадр
+        if not self.pending_samples:
+            return
+        started = time.perf_counter() if metrics.enabled else 0.0
+        limit = max(1, self.settings.input_samples_per_frame)
+        if everything or len(self.pending_samples) <= limit:
+            samples, self.pending_samples = self.pending_samples, []
+        else:
+            samples = self.pending_samples[:limit]
+            del self.pending_samples[:limit]
+        try:
+            self.current_tool.on_move(samples, self)
+        except Exception as e:
+            logging.exception("Exception in flushInput:")
+        if self.pending_samples and not self.input_timer.isActive():
+            self.input_timer.start(self.settings.input_frame_interval)
+        if started:
+            metrics.count('input.samples', len(samples))
+            metrics.observe('input.flush', time.perf_counter() - started)
+
+    def setTool(self, tool):
+        # Движения, накопленные для прежнего инструмента, ему и достаются
+        self.flushInput(everything=True)
+        if self.input_recorder is not None:
+            self.input_recorder.tool(tool)
+        self.current_tool = tool
+        # Движения без нажатых кнопок нужны только инструментам с предпросмотром при наведении
+        self.viewport().setMouseTracking(hasattr(tool, 'on_hover'))
+        window = self.window()
+        if hasattr(window, 'color_preview'):
+            window.showColorPreview(self.settings.current_color)
 
     def updateBrushSize(self):
-        print("CanvasView: updateBrushSize called")
+        log.debug("CanvasView: updateBrushSize called")
         if hasattr(self.current_tool, 'updatePen'):
             try:
                 self.current_tool.updatePen(self)
@@ -577,7 +1356,7 @@ class CanvasView(QGraphicsView):
 
     def changeBrushSize(self, value):
         try:
-            print(f"CanvasView: Brush size percentage changed to {value}%")
+            log.debug("CanvasView: Brush size percentage changed to %s%%", value)
             self.settings.brush_size_percentage = value
             self.parent().brush_slider.setValue(value)
             self.updateBrushSize()
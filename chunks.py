@@ -0,0 +1,485 @@
+# chunks.py
+
+import math
+import time
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPathItem
+from PyQt5.QtCore import QRectF
+from stroke_item import StrokeItem
+from image_item import ImageItem
+from layers import LayerStack, document_transform
+from bookmarks import BookmarkIndex
+from spatial import SpatialIndex, distance_to_item, item_touches_polygon, rect_to_polygon
+from instrumentation import metrics
+
+CHUNK_SIZE = 2048.0  # Размер чанка в единицах сцены
+LOAD_MARGIN = 1  # Сколько чанков вокруг видимой области подгружать
+EVICT_MARGIN = 3  # Чанки дальше этого расстояния от видимой области выгружаются
+MAX_CHUNKS_PER_ITEM = 64  # Элементы, покрывающие больше чанков, считаются крупными
+ITEM_UID = 0  # Ключ QGraphicsItem.data() с постоянным идентификатором элемента.
+# Элементы, загруженные из файла, получают uid -(номер в файле + 1), новые — положительные
+ITEM_LAYER = 1  # Ключ QGraphicsItem.data() с id слоя элемента
+MAX_BAKE_GROUP = 16  # Больше связанных чанков за раз не запекается
+
+
+def chunk_key(x, y):
+    return (math.floor(x / CHUNK_SIZE), math.floor(y / CHUNK_SIZE))
+
+
+def chunk_range(rect, margin=0):
+    # Диапазон ключей чанков, покрывающих прямоугольник (включительно)
+    x0, y0 = chunk_key(rect.left(), rect.top())
+    x1, y1 = chunk_key(rect.right(), rect.bottom())
+    return x0 - margin, y0 - margin, x1 + margin, y1 + margin
+
+
+def chunk_rect(key):
+    return QRectF(key[0] * CHUNK_SIZE, key[1] * CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE)
+
+
+def item_bounds(item):
+    # Рамка элемента в координатах документа.
+    # QGraphicsPathItem.boundingRect() строит контур обводки, что дорого для длинных штрихов;
+    # для раскладки по чанкам достаточно рамки контрольных точек плюс половины толщины пера
+    if isinstance(item, QGraphicsPathItem):
+        half_width = item.pen().widthF() / 2
+        rect = item.path().controlPointRect().adjusted(-half_width, -half_width, half_width, half_width)
+        return document_transform(item).mapRect(rect)
+    return document_transform(item).mapRect(item.boundingRect())
+
+
+class Chunk:
+    __slots__ = ('key', 'items', 'loaded', 'touched', 'baked', 'group')
+
+    def __init__(self, key):
+        self.key = key
+        self.items = set()
+        self.loaded = False
+        self.touched = time.monotonic()  # Время последнего изменения элементов чанка
+        self.baked = None  # id слоя -> запеченный элемент, заменяющий элементы слоя в чанке
+        self.group = None  # Ключи чанков, запеченных вместе с этим
+
+
+# Хранилище элементов холста, разбитое на чанки фиксированного размера.
+# В сцену попадают только элементы чанков рядом с видимой областью,
+# остальные живут вне сцены и не участвуют ни в индексе, ни в отрисовке.
+# В сцене элемент - дочерний элемент корня своего слоя. Пространственные запросы
+# (точка, прямоугольник, многоугольник, ближайшие) идут по отдельному индексу всех
+# элементов документа, а не по сцене
+class ChunkStore:
+    def __init__(self, scene):
+        self.scene = scene
+        self.layers = LayerStack(scene)
+        self.bookmarks = BookmarkIndex()  # Закладки документа
+        self.chunks = {}  # (cx, cy) -> Chunk
+        self.item_keys = {}  # item -> список ключей чанков
+        self.load_refs = {}  # item -> число загруженных чанков, содержащих элемент
+        self.large_items = set()  # Крупные элементы, всегда находятся в сцене
+        self.spatial = SpatialIndex()  # Рамки всех элементов документа
+        self.loaded_keys = set()
+        self.pinned_keys = set()  # Чанки, которые держатся в сцене вне видимой области (предзагрузка)
+        self.load_range = None  # Диапазон чанков, которые должны быть загружены
+        self.suspended = False  # Все элементы убраны из сцены (например, при отрисовке тайлами)
+        self.listeners = []  # Функции listener(rect, layer), вызываемые при изменении элементов слоя
+        self.uids = {}  # uid -> item
+        self.baked_items = set()  # Элементы, которые рисуются запеченными чанками, а не сами
+        self._next_uid = 1
+        self._z = 0.0
+
+    def next_z(self):
+        self._z += 1.0
+        return self._z
+
+    def reserve_z(self, count):
+        # Значения z 1..count заняты элементами, которые еще загружаются
+        self._z = max(self._z, float(count))
+
+    def reserve_uid(self, uid):
+        # uid до указанного включительно заняты элементами, которые еще загружаются
+        self._next_uid = max(self._next_uid, uid + 1)
+
+    def counters(self):
+        # Последние выданные z и uid - чтобы копия документа продолжила их так же, как оригинал
+        return self._z, self._next_uid - 1
+
+    def item_by_uid(self, uid):
+        return self.uids.get(uid)
+
+    def __len__(self):
+        return len(self.item_keys) + len(self.large_items)
+
+    def __contains__(self, item):
+        return item in self.item_keys or item in self.large_items
+
+    def add_item(self, item, z=None, layer=None):
+        # Слой - явно указанный, уже записанный в элементе или текущий
+        if z is None:
+            z = self.next_z()
+        else:
+            self._z = max(self._z, z)
+        item.setZValue(z)
+        if layer is None:
+            layer = item.data(ITEM_LAYER)
+        if layer is None:
+            layer = self.layers.current
+        item.setData(ITEM_LAYER, layer)
+        uid = item.data(ITEM_UID)
+        if uid is None:
+            uid = self._next_uid
+            self._next_uid += 1
+            item.setData(ITEM_UID, uid)
+        elif uid >= self._next_uid:
+            # Элемент восстановлен с сохраненным uid (например, из журнала)
+            self._next_uid = uid + 1
+        self.uids[uid] = item
+        if metrics.enabled:
+            metrics.count('items_added')
+
+        bounds = item_bounds(item)
+        self.spatial.insert(item, bounds)
+        x0, y0, x1, y1 = chunk_range(bounds)
+        self._unbake_range(x0, y0, x1, y1)
+        self._notify(bounds, layer)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_CHUNKS_PER_ITEM:
+            self.large_items.add(item)
+            if self.suspended:
+                self._hide(item)
+            else:
+                self._show(item)
+            return
+
+        keys = [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+        self.item_keys[item] = keys
+        refs = 0
+        for key in keys:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                chunk = self.chunks[key] = Chunk(key)
+                if self._in_load_range(key):
+                    chunk.loaded = True
+                    self.loaded_keys.add(key)
+            chunk.items.add(item)
+            if chunk.loaded:
+                refs += 1
+        self.load_refs[item] = refs
+        if refs:
+            self._show(item)
+        else:
+            self._hide(item)
+
+    def remove_item(self, item):
+        if item in self.baked_items:
+            self._unbake_range(*chunk_range(item_bounds(item)))
+        if item in self.large_items:
+            self.large_items.discard(item)
+        else:
+            keys = self.item_keys.pop(item, None)
+            if keys is None:
+                return False
+            self.load_refs.pop(item, None)
+            for key in keys:
+                chunk = self.chunks.get(key)
+                if chunk is None:
+                    continue
+                chunk.items.discard(item)
+                if not chunk.items:
+                    del self.chunks[key]
+                    self.loaded_keys.discard(key)
+        bounds = self.spatial.remove(item)
+        self.uids.pop(item.data(ITEM_UID), None)
+        if metrics.enabled:
+            metrics.count('items_removed')
+        self._hide(item)
+        self._notify(bounds, item.data(ITEM_LAYER))
+        return True
+
+    def update_item(self, item):
+        # Элемент изменился на месте (например, стиль) — запеченное и закэшированное устарело
+        if item not in self:
+            return
+        bounds = item_bounds(item)
+        old_bounds = self.spatial.remove(item)
+        self.spatial.insert(item, bounds)
+        if old_bounds is not None:
+            bounds = bounds.united(old_bounds)
+        self._unbake_range(*chunk_range(bounds))
+        self._notify(bounds, item.data(ITEM_LAYER))
+
+    def bake_group(self, key, idle_since):
+        # Набор чанков, которые можно запечь вместе с данным: элементы, лежащие сразу в нескольких
+        # чанках, связывают их, поэтому запекаются либо все связанные чанки, либо ни один.
+        # None, если какой-то из них менялся после idle_since, уже запечен, содержит изображение
+        # или задет крупным элементом
+        pending = [key]
+        group = {key}
+        while pending:
+            chunk = self.chunks.get(pending.pop())
+            if chunk is None or chunk.baked is not None or chunk.touched > idle_since:
+                return None
+            for item in chunk.items:
+                if isinstance(item, ImageItem):
+                    # Изображение рисуется тайлами своей пирамиды, запекать его в QPicture незачем
+                    return None
+                for other in self.item_keys[item]:
+                    if other not in group:
+                        group.add(other)
+                        pending.append(other)
+            if len(group) > MAX_BAKE_GROUP:
+                return None
+        for item in self.large_items:
+            bounds = item_bounds(item)
+            if any(chunk_rect(key).intersects(bounds) for key in group):
+                return None
+        return group
+
+    def bake(self, baked):
+        # baked: ключ чанка -> {id слоя: элемент, рисующий все элементы слоя в чанке разом}
+        group = frozenset(baked)
+        for key, baked_item in baked.items():
+            chunk = self.chunks[key]
+            chunk.baked = baked_item
+            chunk.group = group
+            for item in chunk.items:
+                if item not in self.baked_items:
+                    self.baked_items.add(item)
+                    self._hide(item)
+            if chunk.loaded:
+                self._show_baked(chunk)
+        if metrics.enabled:
+            metrics.count('chunks_baked', len(group))
+
+    def unbake(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None or chunk.group is None:
+            return
+        for group_key in chunk.group:
+            group_chunk = self.chunks.get(group_key)
+            if group_chunk is None or group_chunk.baked is None:
+                continue
+            self._hide_baked(group_chunk)
+            group_chunk.baked = None
+            group_chunk.group = None
+            for item in group_chunk.items:
+                self.baked_items.discard(item)
+                if self.load_refs.get(item):
+                    self._show(item)
+        if metrics.enabled:
+            metrics.count('chunks_unbaked')
+
+    def items(self):
+        # Все элементы документа в порядке наложения (снизу вверх)
+        result = list(self.item_keys)
+        result.extend(self.large_items)
+        result.sort(key=self.stacking_key())
+        return result
+
+    def items_in_layer(self, layer_id):
+        return [item for item in self.items() if item.data(ITEM_LAYER) == layer_id]
+
+    def items_in_rect(self, rect, layers=None, exact=False):
+        # Элементы в порядке наложения, рамка которых задевает rect. layers - id слоев, элементы
+        # которых нужны (None - всех); exact - rect должна задевать сама закрашенная часть элемента
+        found = self.spatial.query(rect)
+        if layers is not None:
+            found = [item for item in found if item.data(ITEM_LAYER) in layers]
+        if exact:
+            polygon = rect_to_polygon(rect)
+            found = [item for item in found if item_touches_polygon(item, polygon)]
+        return sorted(found, key=self.stacking_key())
+
+    def items_bounds(self, layers=None):
+        # Общая рамка элементов (только слоев layers, если они заданы); None, если элементов нет
+        entries = [entry[:4] for item, entry in self.spatial.entries.items()
+                   if layers is None or item.data(ITEM_LAYER) in layers]
+        if not entries:
+            return None
+        entries = np.array(entries, dtype=np.float64)
+        (left, top), (right, bottom) = entries[:, :2].min(axis=0), entries[:, 2:].max(axis=0)
+        return QRectF(left, top, right - left, bottom - top)
+
+    def items_at(self, x, y, tolerance=0.0, layers=None):
+        # Элементы в порядке наложения, закрашенная часть которых не дальше tolerance от точки
+        rect = QRectF(x - tolerance, y - tolerance, 2 * tolerance, 2 * tolerance)
+        return [item for item in self.items_in_rect(rect, layers) if distance_to_item(item, x, y) <= tolerance]
+
+    def items_in_polygon(self, points, layers=None):
+        # Элементы в порядке наложения, задевающие многоугольник points (n, 2), например лассо
+        polygon = np.asarray(points, dtype=np.float64)
+        if len(polygon) < 3:
+            return []
+        (left, top), (right, bottom) = polygon.min(axis=0), polygon.max(axis=0)
+        return [item for item in self.items_in_rect(QRectF(left, top, right - left, bottom - top), layers)
+                if item_touches_polygon(item, polygon)]
+
+    def nearest_items(self, x, y, k=1, layers=None, max_distance=math.inf):
+        # k ближайших к точке элементов [(расстояние, элемент)], ближайшие первыми
+        accept = None if layers is None else (lambda item: item.data(ITEM_LAYER) in layers)
+        return self.spatial.nearest(x, y, k, lambda item: distance_to_item(item, x, y), accept, max_distance)
+
+    def visible_layers_in_rect(self, rect, exact=False):
+        # [(прозрачность, элементы)] видимых слоев снизу вверх - в виде, нужном render_layers
+        visible = self.layers.visible_ids()
+        grouped = {layer_id: [] for layer_id in visible}
+        for item in self.items_in_rect(rect, set(visible), exact):
+            grouped[item.data(ITEM_LAYER)].append(item)
+        return [(self.layers.layers[layer_id].opacity, grouped[layer_id])
+                for layer_id in visible if grouped[layer_id]]
+
+    def stacking_key(self):
+        # Порядок наложения: позиция слоя, затем z внутри слоя
+        positions = {layer_id: position for position, layer_id in enumerate(self.layers.order)}
+        return lambda item: (positions.get(item.data(ITEM_LAYER), -1), item.zValue())
+
+    def set_suspended(self, suspended):
+        # В приостановленном режиме сцена не содержит элементов холста
+        if suspended == self.suspended:
+            return
+        self.suspended = suspended
+        if suspended:
+            for key in list(self.loaded_keys):
+                self._unload(key)
+            self.load_range = None
+            for item in self.large_items:
+                self._hide(item)
+        else:
+            for item in self.large_items:
+                self._show(item)
+
+    def update_view(self, rect):
+        if self.suspended:
+            return
+        # Подгружаем чанки рядом с видимой областью и выгружаем дальние
+        load_range = self.load_range = chunk_range(rect, LOAD_MARGIN)
+        ex0, ey0, ex1, ey1 = chunk_range(rect, EVICT_MARGIN)
+        for key in list(self.loaded_keys):
+            if not (ex0 <= key[0] <= ex1 and ey0 <= key[1] <= ey1) and key not in self.pinned_keys:
+                self._unload(key)
+        for chunk in self._chunks_in_range(*load_range):
+            if not chunk.loaded:
+                self._load(chunk)
+
+    def set_pinned(self, keys):
+        # Закрепленные чанки не выгружаются при смене вида; загружает их preload()
+        keys = set(keys)
+        for key in self.pinned_keys - keys:
+            if key in self.loaded_keys and not self._in_load_range(key):
+                self._unload(key)
+        self.pinned_keys = keys
+
+    def preload(self, key):
+        # Заранее добавляет в сцену элементы закрепленного чанка и готовит их геометрию
+        # для отрисовки. Возвращает False, если делать было нечего
+        chunk = self.chunks.get(key)
+        if self.suspended or chunk is None or chunk.loaded or key not in self.pinned_keys:
+            return False
+        self._load(chunk)
+        for item in chunk.items:
+            if isinstance(item, StrokeItem):
+                item.prepareGeometry()
+        return True
+
+    def clear(self):
+        for item in list(self.item_keys) + list(self.large_items):
+            self._hide(item)
+        for chunk in self.chunks.values():
+            self._hide_baked(chunk)
+        self.chunks.clear()
+        self.item_keys.clear()
+        self.load_refs.clear()
+        self.large_items.clear()
+        self.spatial.clear()
+        self.loaded_keys.clear()
+        self.pinned_keys.clear()
+        self.uids.clear()
+        self.baked_items.clear()
+        self._z = 0.0
+        self.layers.reset()
+        self.bookmarks.reset()
+        self._notify(None)  # None - изменился весь холст
+
+    def _notify(self, rect, layer=None):
+        # layer None - изменение касается всех слоев
+        if rect is not None:
+            now = time.monotonic()
+            for chunk in self._chunks_in_range(*chunk_range(rect)):
+                chunk.touched = now
+        for listener in self.listeners:
+            listener(rect, layer)
+
+    def _in_load_range(self, key):
+        if self.load_range is None:
+            return False
+        x0, y0, x1, y1 = self.load_range
+        return x0 <= key[0] <= x1 and y0 <= key[1] <= y1
+
+    def _chunks_in_range(self, x0, y0, x1, y1):
+        # При сильном отдалении диапазон огромный — тогда перебираем только существующие чанки
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.chunks):
+            return [chunk for key, chunk in self.chunks.items()
+                    if x0 <= key[0] <= x1 and y0 <= key[1] <= y1]
+        result = []
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is not None:
+                    result.append(chunk)
+        return result
+
+    def _unbake_range(self, x0, y0, x1, y1):
+        if not self.baked_items:
+            return
+        for chunk in self._chunks_in_range(x0, y0, x1, y1):
+            if chunk.baked is not None:
+                self.unbake(chunk.key)
+
+    def _load(self, chunk):
+        chunk.loaded = True
+        self.loaded_keys.add(chunk.key)
+        if chunk.baked is not None:
+            self._show_baked(chunk)
+        for item in chunk.items:
+            refs = self.load_refs[item] + 1
+            self.load_refs[item] = refs
+            if refs == 1:
+                self._show(item)
+
+    def _unload(self, key):
+        self.loaded_keys.discard(key)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return
+        chunk.loaded = False
+        if chunk.baked is not None:
+            self._hide_baked(chunk)
+        for item in chunk.items:
+            refs = self.load_refs[item] - 1
+            self.load_refs[item] = refs
+            if refs == 0:
+                self._hide(item)
+
+    def _show(self, item):
+        if item in self.baked_items:
+            return
+        root = self.layers.layer(item.data(ITEM_LAYER)).root
+        if item.parentItem() is not root:
+            item.setParentItem(root)
+
+    def _show_baked(self, chunk):
+        for layer, baked in chunk.baked.items():
+            root = self.layers.layer(layer).root
+            if baked.parentItem() is not root:
+                baked.setParentItem(root)
+
+    def _hide_baked(self, chunk):
+        if chunk.baked is None:
+            return
+        for baked in chunk.baked.values():
+            if baked.scene() is self.scene:
+                self.scene.removeItem(baked)
+
+    def _hide(self, item):
+        if item.scene() is self.scene:
+            self.scene.removeItem(item)
+        if isinstance(item, StrokeItem):
+            # Ломаная для отрисовки строится заново, когда штрих снова покажут
+            item.releaseGeometry()
@@ -0,0 +1,185 @@
+# curves.py
+
+import math
+import numpy as np
+
+# Сглаживание штриха и аппроксимация кубическими кривыми Безье.
+# Кривая хранится массивом (1 + 3k, 2): начальная точка, затем для каждого сегмента
+# две управляющие точки и конечная точка - в том же порядке, что элементы cubicTo в QPainterPath.
+# Все шаги работают пакетом над массивом точек: сегменты подбираются методом наименьших
+# квадратов одновременно (суммы по сегментам через np.add.reduceat), а сегменты с большой
+# ошибкой делятся в точке наибольшего отклонения, пока ошибка не станет меньше допуска
+SMOOTH_PASSES = 4  # Сколько раз сглаживать точки ядром [1, 2, 1] / 4
+CORNER_ANGLE = math.radians(75)  # Поворот, начиная с которого точка считается углом
+CORNER_SPAN = 4.0  # Окно поиска углов в допусках аппроксимации
+MAX_SPLIT_ROUNDS = 16  # Предел раундов деления сегментов
+
+
+def smooth_points(points, passes=SMOOTH_PASSES, pinned=None):
+    # Сглаживание ядром [1, 2, 1] / 4; концы и точки из pinned не сдвигаются
+    points = np.array(points, dtype=np.float64)
+    if len(points) < 3:
+        return points
+    fixed = points[pinned] if pinned is not None else None
+    for _ in range(passes):
+        points[1:-1] = (points[:-2] + 2 * points[1:-1] + points[2:]) / 4
+        if fixed is not None:
+            points[pinned] = fixed
+    return points
+
+
+def corner_indices(points, arc, span):
+    # Углы: точки, где направление от точки на расстоянии span (по длине ломаной) до текущей
+    # и от текущей до точки на span дальше поворачивает больше чем на CORNER_ANGLE.
+    # Окно по длине, а не по соседям, чтобы дрожание частых сэмплов не давало углов;
+    # из нескольких подряд идущих кандидатов остается точка с наибольшим поворотом
+    count = len(points)
+    index = np.arange(1, count - 1)
+    back = np.minimum(np.searchsorted(arc, arc[index] - span, side='right') - 1, index - 1)
+    forward = np.maximum(np.searchsorted(arc, arc[index] + span), index + 1)
+    forward = np.minimum(forward, count - 1)
+    incoming = points[index] - points[np.maximum(back, 0)]
+    outgoing = points[forward] - points[index]
+    cross = incoming[:, 0] * outgoing[:, 1] - incoming[:, 1] * outgoing[:, 0]
+    dot = (incoming * outgoing).sum(axis=1)
+    turn = np.abs(np.arctan2(cross, dot))
+    candidates = np.flatnonzero(turn > CORNER_ANGLE)
+    if not len(candidates):
+        return candidates
+    run_starts = np.flatnonzero(np.diff(candidates, prepend=-2) > 1)
+    run_lengths = np.diff(np.append(run_starts, len(candidates)))
+    run = np.repeat(np.arange(len(run_starts)), run_lengths)
+    order = np.lexsort((-turn[candidates], run))
+    best = order[np.searchsorted(run[order], np.arange(len(run_starts)))]
+    return candidates[best] + 1
+
+
+def _normalize(vectors):
+    lengths = np.hypot(vectors[:, 0], vectors[:, 1])
+    lengths[lengths == 0] = 1.0
+    return vectors / lengths[:, None]
+
+
+def _tangents(points, corners):
+    # Касательные в каждой точке: right - направление сегмента, выходящего из точки,
+    # left - направление назад, в сегмент, который в точке заканчивается
+    central = np.empty_like(points)
+    central[1:-1] = points[2:] - points[:-2]
+    central[0] = points[1] - points[0]
+    central[-1] = points[-1] - points[-2]
+    right = _normalize(central)
+    left = -right
+    if len(corners):
+        # В углах касательные с двух сторон независимы
+        right[corners] = _normalize(points[corners + 1] - points[corners])
+        left[corners] = _normalize(points[corners - 1] - points[corners])
+    return left, right
+
+
+def _segment_samples(knots):
+    # Индексы точек всех сегментов подряд: сегмент [a, b] включает обе концевые точки
+    starts = knots[:-1]
+    lengths = knots[1:] - starts + 1
+    offsets = np.cumsum(lengths) - lengths
+    samples = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    return samples, offsets, lengths
+
+
+def _fit_segments(points, arc, knots, left, right):
+    # Наименьшие квадраты для длин касательных alpha1, alpha2 всех сегментов сразу (как у Шнайдера)
+    samples, offsets, lengths = _segment_samples(knots)
+    segment = np.repeat(np.arange(len(knots) - 1), lengths)
+    a, b = knots[:-1], knots[1:]
+    span = arc[b] - arc[a]
+    span[span == 0] = 1.0
+    t = (arc[samples] - arc[a][segment]) / span[segment]
+    u = 1 - t
+    b0, b1, b2, b3 = u ** 3, 3 * t * u * u, 3 * t * t * u, t ** 3
+
+    p0, p3 = points[a], points[b]
+    t0, t3 = right[a], left[b]
+    a1 = t0[segment] * b1[:, None]
+    a2 = t3[segment] * b2[:, None]
+    rest = points[samples] - p0[segment] * (b0 + b1)[:, None] - p3[segment] * (b2 + b3)[:, None]
+    c11 = np.add.reduceat((a1 * a1).sum(axis=1), offsets)
+    c12 = np.add.reduceat((a1 * a2).sum(axis=1), offsets)
+    c22 = np.add.reduceat((a2 * a2).sum(axis=1), offsets)
+    x = np.add.reduceat((rest * a1).sum(axis=1), offsets)
+    y = np.add.reduceat((rest * a2).sum(axis=1), offsets)
+    det = c11 * c22 - c12 * c12
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha1 = (x * c22 - c12 * y) / det
+        alpha2 = (c11 * y - c12 * x) / det
+    # Вырожденные решения заменяем эвристикой: треть расстояния между концами
+    chord = np.hypot(*(p3 - p0).T)
+    fallback = ~np.isfinite(alpha1) | ~np.isfinite(alpha2) | (alpha1 < 1e-6 * chord) | (alpha2 < 1e-6 * chord)
+    alpha1[fallback] = chord[fallback] / 3
+    alpha2[fallback] = chord[fallback] / 3
+    c1 = p0 + t0 * alpha1[:, None]
+    c2 = p3 + t3 * alpha2[:, None]
+
+    # Отклонение точек от кривой при тех же параметрах t
+    curve = (p0[segment] * b0[:, None] + c1[segment] * b1[:, None] +
+             c2[segment] * b2[:, None] + p3[segment] * b3[:, None])
+    error = ((curve - points[samples]) ** 2).sum(axis=1)
+    return c1, c2, samples, offsets, error
+
+
+def fit_cubic_beziers(points, tolerance, smooth=True):
+    # Возвращает массив кривой (1 + 3k, 2) для ломаной points
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    if len(points) > 1:
+        # Повторяющиеся точки дают сегменты нулевой длины
+        keep = np.ones(len(points), dtype=bool)
+        keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+        points = points[keep]
+    if len(points) < 2:
+        return points.copy()
+    if len(points) == 2:
+        p0, p3 = points
+        return np.array([p0, p0 + (p3 - p0) / 3, p3 - (p3 - p0) / 3, p3])
+
+    arc = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+    corners = corner_indices(points, arc, CORNER_SPAN * tolerance)
+    if smooth:
+        points = smooth_points(points, pinned=corners)
+        arc = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+    left, right = _tangents(points, corners)
+    knots = np.unique(np.concatenate(([0], corners, [len(points) - 1])))
+
+    tolerance2 = max(tolerance, 1e-9) ** 2
+    for _ in range(MAX_SPLIT_ROUNDS):
+        c1, c2, samples, offsets, error = _fit_segments(points, arc, knots, left, right)
+        worst = np.maximum.reduceat(error, offsets)
+        bad = np.flatnonzero((worst > tolerance2) & (np.diff(knots) > 1))
+        if not len(bad):
+            break
+        # Точка наибольшего отклонения в каждом плохом сегменте становится новым узлом
+        segment = np.repeat(np.arange(len(knots) - 1), np.diff(np.append(offsets, len(error))))
+        order = np.lexsort((-error, segment))
+        first = np.searchsorted(segment[order], bad)
+        split = samples[order[first]]
+        knots = np.unique(np.concatenate((knots, split)))
+    else:
+        c1, c2, _, _, _ = _fit_segments(points, arc, knots, left, right)
+
+    curve = np.empty((1 + 3 * (len(knots) - 1), 2))
+    curve[0] = points[knots[0]]
+    curve[1::3] = c1
+    curve[2::3] = c2
+    curve[3::3] = points[knots[1:]]
+    return curve
+
+
+def flatten_curve(curve, steps=16):
+    # Ломаная по кривой: steps точек на сегмент, для геометрических операций над штрихом
+    if len(curve) < 4:
+        return np.array(curve, dtype=np.float64)
+    p0 = curve[0:-1:3][:, None, :]
+    c1 = curve[1::3][:, None, :]
+    c2 = curve[2::3][:, None, :]
+    p3 = curve[3::3][:, None, :]
+    t = np.linspace(0, 1, steps + 1)[1:, None]
+    u = 1 - t
+    points = u ** 3 * p0 + 3 * t * u * u * c1 + 3 * t * t * u * c2 + t ** 3 * p3
+    return np.concatenate((curve[:1], points.reshape(-1, 2)))
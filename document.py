@@ -0,0 +1,112 @@
+# document.py
+
+import os
+import time
+from chunks import ITEM_UID, ITEM_LAYER, chunk_key, item_bounds
+from ess_format import item_to_record, is_paged_ess, open_paged_ess, read_page_index, write_pages, \
+    write_paged_ess
+from instrumentation import log, metrics
+
+
+def page_key(item):
+    # Страница элемента - ячейка сетки чанков, в которую попадает левый верхний угол его рамки
+    bounds = item_bounds(item)
+    return chunk_key(bounds.left(), bounds.top())
+
+
+# Постраничное состояние документа относительно файла, с которым он синхронизирован.
+# Действия истории помечают страницы измененных элементов грязными, и повторное
+# сохранение в тот же файл переписывает только их. Таблица слоев мала и пишется при каждом сохранении
+class DocumentPages:
+    def __init__(self, store, history):
+        self.store = store
+        self.filename = None  # Страничный файл, совпадающий с документом с точностью до dirty
+        self.homes = {}  # uid -> ключ страницы
+        self.pages = {}  # ключ страницы -> множество uid
+        self.dirty = set()
+        history.listeners.append(self.onCommand)
+
+    def reset(self):
+        self.filename = None
+        self.homes.clear()
+        self.pages.clear()
+        self.dirty.clear()
+
+    def attach(self, filename):
+        # Документ загружен из страничного файла; изменения, сделанные во время загрузки, остаются грязными
+        for uid, key in read_page_index(filename).items():
+            if uid not in self.homes:
+                self._place(uid, key)
+        self.filename = os.path.abspath(filename)
+
+    def onCommand(self, command, undone):
+        removed, added = command.changes(undone)
+        for uid in removed:
+            key = self.homes.pop(uid, None)
+            if key is not None:
+                self.pages[key].discard(uid)
+                self.dirty.add(key)
+        for uid in added:
+            item = self.store.item_by_uid(uid)
+            if item is None:
+                continue
+            old_key = self.homes.get(uid)
+            if old_key is not None:
+                self.pages[old_key].discard(uid)
+                self.dirty.add(old_key)
+            key = page_key(item)
+            self._place(uid, key)
+            self.dirty.add(key)
+
+    def save(self, filename):
+        # Возвращает число записанных страниц
+        started = time.perf_counter()
+        filename = os.path.abspath(filename)
+        if filename == self.filename and os.path.exists(filename) and is_paged_ess(filename):
+            written = self._saveDirty()
+        else:
+            written = self._saveAll(filename)
+        self.filename = filename
+        self.dirty.clear()
+        log.debug("DocumentPages: Wrote %s pages to %s", written, filename)
+        if metrics.enabled:
+            metrics.observe('document.save', time.perf_counter() - started)
+        return written
+
+    def _saveDirty(self):
+        pages = {key: self._pageContents(self.pages.get(key, ())) for key in self.dirty}
+        connection = open_paged_ess(self.filename, writable=True)
+        try:
+            write_pages(connection, pages, self.store.layers.state(), self.store.bookmarks.state())
+        finally:
+            connection.close()
+        for key in self.dirty:
+            if not self.pages.get(key):
+                self.pages.pop(key, None)
+        return len(pages)
+
+    def _saveAll(self, filename):
+        self.homes.clear()
+        self.pages.clear()
+        for item in self.store.items():
+            self._place(item.data(ITEM_UID), page_key(item))
+        pages = {key: self._pageContents(uids) for key, uids in self.pages.items()}
+        write_paged_ess(filename, pages, self.store.layers.state(), self.store.bookmarks.state())
+        return len(pages)
+
+    def _pageContents(self, uids):
+        items = [item for item in map(self.store.item_by_uid, uids) if item is not None]
+        items.sort(key=lambda item: item.zValue())
+        contents = ([], [], [], [])
+        for item in items:
+            record = item_to_record(item)
+            if record is not None:
+                contents[0].append(item.data(ITEM_UID))
+                contents[1].append(item.zValue())
+                contents[2].append(item.data(ITEM_LAYER))
+                contents[3].append(record)
+        return contents
+
+    def _place(self, uid, key):
+        self.homes[uid] = key
+        self.pages.setdefault(key, set()).add(uid)
@@ -0,0 +1,145 @@
+# erase.py
+
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem
+from PyQt5.QtGui import QPainterPath
+from curves import flatten_curve
+from stroke_item import StrokeItem
+from chunks import ITEM_LAYER
+from spatial import EPSILON, points_in_polygon
+from ess_format import ItemRecord, KIND_PATH, KIND_POLYGON, KIND_CURVE, array_to_polygon, item_to_record, \
+    polygon_to_array, record_to_item
+
+
+def segment_intersections(starts, ends, polygon):
+    # Параметры t (вдоль отрезков) точек пересечения отрезков с ребрами многоугольника: матрица S x E
+    edge_starts = polygon
+    edge_ends = np.roll(polygon, -1, axis=0)
+    d = (ends - starts)[:, None, :]
+    e = (edge_ends - edge_starts)[None, :, :]
+    w = edge_starts[None, :, :] - starts[:, None, :]
+    denominator = d[..., 0] * e[..., 1] - d[..., 1] * e[..., 0]
+    parallel = np.abs(denominator) < EPSILON
+    denominator = np.where(parallel, 1.0, denominator)
+    t = (w[..., 0] * e[..., 1] - w[..., 1] * e[..., 0]) / denominator
+    u = (w[..., 0] * d[..., 1] - w[..., 1] * d[..., 0]) / denominator
+    valid = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    return np.where(valid, t, np.nan)
+
+
+def clip_polyline(points, polygon):
+    # Вырезает из ломаной части внутри многоугольника.
+    # Возвращает None, если ломаная не задета, иначе список оставшихся кусков
+    if len(points) < 2:
+        if len(points) and points_in_polygon(points, polygon)[0]:
+            return []
+        return None
+
+    starts = points[:-1]
+    ends = points[1:]
+    inside = points_in_polygon(points, polygon)
+    # Пересечения ищем только для отрезков, чья рамка задевает рамку лассо
+    low = polygon.min(axis=0)
+    high = polygon.max(axis=0)
+    candidates = np.flatnonzero(np.all(np.maximum(starts, ends) >= low, axis=1) &
+                                np.all(np.minimum(starts, ends) <= high, axis=1))
+    crossings = np.full((len(starts), len(polygon)), np.nan)
+    if len(candidates):
+        crossings[candidates] = segment_intersections(starts[candidates], ends[candidates], polygon)
+    crossed = ~np.all(np.isnan(crossings), axis=1)
+    if not inside.any() and not crossed.any():
+        return None
+
+    pieces = []
+    current = []
+
+    def extend(point):
+        if not current or np.hypot(*(current[-1] - point)) > EPSILON:
+            current.append(point)
+
+    def close_piece():
+        if len(current) >= 2:
+            pieces.append(np.array(current))
+        current.clear()
+
+    for s in range(len(starts)):
+        a = starts[s]
+        b = ends[s]
+        if not crossed[s]:
+            if inside[s]:
+                close_piece()
+            else:
+                extend(a)
+                extend(b)
+            continue
+        ts = np.sort(crossings[s][~np.isnan(crossings[s])])
+        bounds = np.concatenate(([0.0], ts, [1.0]))
+        middles = (bounds[:-1] + bounds[1:]) / 2
+        middle_points = a + middles[:, None] * (b - a)
+        middle_inside = points_in_polygon(middle_points, polygon)
+        for (t0, t1), is_inside in zip(zip(bounds[:-1], bounds[1:]), middle_inside):
+            if t1 - t0 < EPSILON:
+                continue
+            if is_inside:
+                close_piece()
+            else:
+                extend(a + t0 * (b - a))
+                extend(a + t1 * (b - a))
+    close_piece()
+    return pieces
+
+
+def subtract_fill(coords, lasso_path):
+    # Вычитает лассо из залитой области; None, если область не задета
+    fill_path = QPainterPath()
+    fill_path.addPolygon(array_to_polygon(coords))
+    fill_path.closeSubpath()
+    if not fill_path.intersects(lasso_path):
+        return None
+    result = fill_path.subtracted(lasso_path)
+    # Полигоны из toFillPolygons рассчитаны на заливку по правилу четности, дыры сохраняются
+    return [polygon_to_array(polygon) for polygon in result.toFillPolygons() if polygon.count() >= 3]
+
+
+def erase_region(chunk_store, lasso_points, layer=None):
+    # Вырезает область лассо из элементов холста (только слоя layer, если он задан).
+    # Возвращает (удаленные, добавленные) элементы для истории отмены
+    lasso_points = np.asarray(lasso_points, dtype=np.float64)
+    if len(lasso_points) < 3:
+        return [], []
+    lasso_polygon = array_to_polygon(lasso_points)
+    lasso_path = QPainterPath()
+    lasso_path.addPolygon(lasso_polygon)
+    lasso_path.closeSubpath()
+
+    removed = []
+    added = []
+    layers = None if layer is None else (layer,)
+    # Элементы, которые лассо не задевает (хотя их рамки пересекаются), не режутся
+    for item in chunk_store.items_in_polygon(lasso_points, layers):
+        if isinstance(item, (StrokeItem, QGraphicsPathItem)):
+            record = item_to_record(item)
+            coords = record.coords
+            if record.kind == KIND_CURVE:
+                # Кривая режется как ломаная; оставшиеся куски хранятся ломаными
+                coords = flatten_curve(coords)
+            pieces = clip_polyline(coords, lasso_points)
+            kind = KIND_PATH
+        elif isinstance(item, QGraphicsPolygonItem):
+            record = item_to_record(item)
+            pieces = subtract_fill(record.coords, lasso_path)
+            kind = KIND_POLYGON
+        else:
+            continue
+        if pieces is None:
+            continue
+
+        z = item.zValue()
+        item_layer = item.data(ITEM_LAYER)
+        chunk_store.remove_item(item)
+        removed.append(item)
+        for coords in pieces:
+            new_item = record_to_item(ItemRecord(kind, record.rgba, record.width, coords))
+            chunk_store.add_item(new_item, z, item_layer)
+            added.append(new_item)
+    return removed, added
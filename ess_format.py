@@ -0,0 +1,550 @@
+# ess_format.py
+
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import struct
+import logging
+import argparse
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem
+from PyQt5.QtGui import QPainterPath, QPen, QColor, QBrush
+from PyQt5.QtCore import Qt, QRectF
+from chunks import CHUNK_SIZE, chunk_key
+from stroke_item import StrokeItem, array_to_polygon, polygon_to_array, map_array
+from layers import DEFAULT_LAYER, document_transform
+from image_item import ImageItem
+
+# Бинарный формат .ess:
+#   заголовок    - MAGIC, версия, флаги, число элементов
+#   таблица стилей - тип элемента, цвет RGBA, толщина пера
+#   блоки        - до BLOCK_ITEMS элементов: таблица элементов и координаты
+#                  (float32 относительно первой точки элемента), сжатые zlib.
+#                  Координаты кривой - начальная точка и по три точки на сегмент cubicTo.
+#                  С флагом FLAG_LOCAL после таблицы стилей идет начало координат (float64),
+#                  а первые точки элементов хранятся float32 относительно него.
+#                  С флагом FLAG_REFS после таблицы стилей идет таблица ссылок (путей к файлам):
+#                  изображения хранятся ссылкой, поле цвета в их стиле - номер ссылки,
+#                  а координаты - левый верхний и правый нижний углы
+#
+# Страничный формат .ess - база SQLite: элементы разложены по страницам (ячейкам сетки чанков),
+# страница хранит uid, z и слой своих элементов и их записи в бинарном формате выше.
+# Записи страницы хранятся относительно начала ее чанка, так что координаты остаются небольшими
+# на любом удалении от начала документа. Таблица layers хранит слои снизу вверх, bookmarks - закладки.
+# Сохранение переписывает только измененные страницы
+#
+# Места (.esp и закладки) в файлах хранят номер чанка и координаты относительно его начала
+MAGIC = b'ESSB'
+FORMAT_VERSION = 4  # 2 добавила кривые Безье, 3 - FLAG_LOCAL, 4 - изображения; файлы пишутся младшей подходящей версией
+FLAG_DELTA = 0x1  # Координаты хранятся как разности соседних точек
+FLAG_LOCAL = 0x2  # Первые точки элементов хранятся относительно начала координат из заголовка
+FLAG_REFS = 0x4  # После таблицы стилей идет таблица ссылок на внешние файлы
+
+BLOCK_ITEMS = 4096  # Максимум элементов в одном блоке
+COMPRESS_LEVEL = 6
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+PAGED_FORMAT = 'EndlessSketch pages'
+PAGED_VERSION = 3  # Версия 2 добавила слои, 3 - записи относительно чанка; старые файлы дописываются с обновлением
+
+KIND_PATH = 'path'
+KIND_POLYGON = 'polygon'
+KIND_CURVE = 'curve'
+KIND_IMAGE = 'image'
+KIND_CODES = {KIND_PATH: 0, KIND_POLYGON: 1, KIND_CURVE: 2, KIND_IMAGE: 3}
+KIND_NAMES = {code: name for name, code in KIND_CODES.items()}
+
+HEADER = struct.Struct('<4sHHI')  # magic, version, flags, item_count
+ORIGIN = struct.Struct('<dd')  # начало координат записей с FLAG_LOCAL
+STYLE = struct.Struct('<BId')  # kind, rgba, width
+BLOCK_HEADER = struct.Struct('<III')  # item_count, raw_size, compressed_size
+ITEM_DTYPE = np.dtype([
+    ('style', '<u4'),
+    ('count', '<u4'),
+    ('ox', '<f8'),
+    ('oy', '<f8'),
+])
+LOCAL_ITEM_DTYPE = np.dtype([
+    ('style', '<u4'),
+    ('count', '<u4'),
+    ('ox', '<f4'),
+    ('oy', '<f4'),
+])
+
+
+class ItemRecord:
+    # Данные одного элемента холста без Qt-объектов: координаты хранятся массивом (n, 2) float64.
+    # z, uid и слой известны только для записей из страничного формата, source - путь к файлу изображения
+    __slots__ = ('kind', 'rgba', 'width', 'coords', 'z', 'uid', 'layer', 'source')
+
+    def __init__(self, kind, rgba, width, coords, z=None, uid=None, layer=None, source=None):
+        self.kind = kind
+        self.rgba = rgba
+        self.width = width
+        self.coords = coords
+        self.z = z
+        self.uid = uid
+        self.layer = layer
+        self.source = source
+
+
+def record_uid(record, index):
+    # Записи без сохраненного uid получают отрицательный uid по позиции в файле
+    return record.uid if record.uid is not None else -(index + 1)
+
+
+def record_z(record, index):
+    return record.z if record.z is not None else index + 1
+
+
+def record_layer(record):
+    return record.layer if record.layer is not None else DEFAULT_LAYER
+
+
+def is_curve_path(path):
+    return path.elementCount() > 1 and path.elementAt(1).type == QPainterPath.CurveToElement
+
+
+def path_to_array(path):
+    polygons = path.toSubpathPolygons()
+    if len(polygons) == 1 and not is_curve_path(path):
+        return polygon_to_array(polygons[0])
+    # Кривая, точка или несколько подпутей: берем элементы пути как есть
+    coords = np.empty((path.elementCount(), 2), dtype=np.float64)
+    for i in range(path.elementCount()):
+        element = path.elementAt(i)
+        coords[i] = (element.x, element.y)
+    return coords
+
+
+def item_to_record(item):
+    # Координаты записи всегда в системе документа, независимо от плавающего начала координат
+    if isinstance(item, StrokeItem):
+        coords = map_array(document_transform(item), item.coords())
+        return ItemRecord(KIND_CURVE if item.curve else KIND_PATH, item.rgba, item.width, coords)
+    if isinstance(item, QGraphicsPathItem):
+        pen = item.pen()
+        path = item.path()
+        coords = map_array(document_transform(item), path_to_array(path))
+        kind = KIND_CURVE if is_curve_path(path) else KIND_PATH
+        return ItemRecord(kind, pen.color().rgba(), pen.widthF(), coords)
+    if isinstance(item, QGraphicsPolygonItem):
+        coords = map_array(document_transform(item), polygon_to_array(item.polygon()))
+        return ItemRecord(KIND_POLYGON, item.brush().color().rgba(), 0.0, coords)
+    if isinstance(item, ImageItem):
+        rect = document_transform(item).mapRect(item.rect)
+        coords = np.array([(rect.left(), rect.top()), (rect.right(), rect.bottom())], dtype=np.float64)
+        return ItemRecord(KIND_IMAGE, 0, 0.0, coords, source=item.source)
+    return None
+
+
+def record_to_item(record):
+    if record.kind in (KIND_PATH, KIND_CURVE):
+        return StrokeItem(record.coords, record.rgba, record.width, curve=record.kind == KIND_CURVE)
+    if record.kind == KIND_POLYGON:
+        polygon_item = QGraphicsPolygonItem()
+        polygon_item.setPolygon(array_to_polygon(record.coords))
+        polygon_item.setBrush(QBrush(QColor.fromRgba(record.rgba)))
+        polygon_item.setPen(QPen(Qt.NoPen))
+        return polygon_item
+    if record.kind == KIND_IMAGE:
+        (left, top), (right, bottom) = record.coords
+        return ImageItem(record.source, QRectF(left, top, right - left, bottom - top))
+    return None
+
+
+def _style_key(record, refs):
+    # У изображений вместо цвета в стиле номер ссылки на файл
+    if record.kind == KIND_IMAGE:
+        return KIND_IMAGE, refs.setdefault(record.source, len(refs)), 0.0
+    return record.kind, record.rgba, record.width
+
+
+def _encode_block(records, styles, refs, flags, origin):
+    table = np.zeros(len(records), dtype=LOCAL_ITEM_DTYPE if flags & FLAG_LOCAL else ITEM_DTYPE)
+    chunks = []
+    for i, record in enumerate(records):
+        coords = record.coords
+        table['style'][i] = styles[_style_key(record, refs)]
+        table['count'][i] = len(coords)
+        if not len(coords):
+            continue
+        item_origin = coords[0]
+        if flags & FLAG_LOCAL:
+            # Точки отсчитываются от уже округленной до float32 первой точки, чтобы ошибка не копилась
+            local = (item_origin - origin).astype('<f4')
+            item_origin = origin + local
+            table['ox'][i], table['oy'][i] = local
+        else:
+            table['ox'][i], table['oy'][i] = item_origin
+        relative = coords - item_origin
+        if flags & FLAG_DELTA:
+            relative = np.diff(relative, axis=0, prepend=relative[:1])
+        chunks.append(relative.astype('<f4').tobytes())
+    raw = table.tobytes() + b''.join(chunks)
+    compressed = zlib.compress(raw, COMPRESS_LEVEL)
+    return BLOCK_HEADER.pack(len(records), len(raw), len(compressed)) + compressed
+
+
+def _decode_block(data, style_table, refs, flags, origin):
+    item_count, raw_size, compressed_size = BLOCK_HEADER.unpack_from(data)
+    raw = zlib.decompress(data[BLOCK_HEADER.size:BLOCK_HEADER.size + compressed_size])
+    if len(raw) != raw_size:
+        raise ValueError("Поврежденный блок .ess")
+    table = np.frombuffer(raw, dtype=LOCAL_ITEM_DTYPE if flags & FLAG_LOCAL else ITEM_DTYPE, count=item_count)
+    coords = np.frombuffer(raw, dtype='<f4', offset=table.nbytes).reshape(-1, 2).astype(np.float64)
+    if flags & FLAG_DELTA:
+        # Восстанавливаем координаты из разностей внутри каждого элемента
+        counts = table['count'].astype(np.int64)
+        starts = np.cumsum(counts) - counts
+        cumulative = np.cumsum(coords, axis=0)
+        before = np.zeros((item_count, 2))
+        shifted = starts > 0
+        before[shifted] = cumulative[starts[shifted] - 1]
+        coords = cumulative - np.repeat(before, counts, axis=0)
+    records = []
+    position = 0
+    for entry in table:
+        count = int(entry['count'])
+        kind, rgba, width = style_table[entry['style']]
+        item_coords = coords[position:position + count]
+        item_coords += (origin[0] + float(entry['ox']), origin[1] + float(entry['oy']))
+        if kind == KIND_IMAGE:
+            records.append(ItemRecord(kind, 0, width, item_coords, source=refs[rgba]))
+        else:
+            records.append(ItemRecord(kind, rgba, width, item_coords))
+        position += count
+    return records, BLOCK_HEADER.size + compressed_size
+
+
+def pack_records(records, delta=False, origin=None):
+    # origin - (x, y), относительно которого хранятся элементы (FLAG_LOCAL); None - абсолютные координаты
+    flags = FLAG_DELTA if delta else 0
+    styles = {}
+    refs = {}
+    for record in records:
+        styles.setdefault(_style_key(record, refs), len(styles))
+
+    if refs:
+        flags |= FLAG_REFS
+        version = FORMAT_VERSION
+    elif origin is not None:
+        version = 3
+    else:
+        version = 2 if any(kind == KIND_CURVE for kind, _, _ in styles) else 1
+    if origin is not None:
+        flags |= FLAG_LOCAL
+    parts = [HEADER.pack(MAGIC, version, flags, len(records)), struct.pack('<I', len(styles))]
+    for (kind, rgba, width), _ in sorted(styles.items(), key=lambda entry: entry[1]):
+        parts.append(STYLE.pack(KIND_CODES[kind], rgba, width))
+    if refs:
+        parts.append(struct.pack('<I', len(refs)))
+        for source, _ in sorted(refs.items(), key=lambda entry: entry[1]):
+            encoded = source.encode('utf-8')
+            parts.append(struct.pack('<I', len(encoded)) + encoded)
+    if origin is not None:
+        origin = np.array(origin, dtype=np.float64)
+        parts.append(ORIGIN.pack(*origin))
+    for start in range(0, len(records), BLOCK_ITEMS):
+        parts.append(_encode_block(records[start:start + BLOCK_ITEMS], styles, refs, flags, origin))
+    return b''.join(parts)
+
+
+def unpack_records(data):
+    magic, version, flags, item_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Данные не являются бинарным .ess")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Неподдерживаемая версия формата .ess: {version}")
+    offset = HEADER.size
+    (style_count,) = struct.unpack_from('<I', data, offset)
+    offset += 4
+    style_table = []
+    for _ in range(style_count):
+        kind, rgba, width = STYLE.unpack_from(data, offset)
+        style_table.append((KIND_NAMES[kind], rgba, width))
+        offset += STYLE.size
+    refs = []
+    if flags & FLAG_REFS:
+        (ref_count,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        for _ in range(ref_count):
+            (size,) = struct.unpack_from('<I', data, offset)
+            refs.append(bytes(data[offset + 4:offset + 4 + size]).decode('utf-8'))
+            offset += 4 + size
+    origin = (0.0, 0.0)
+    if flags & FLAG_LOCAL:
+        origin = ORIGIN.unpack_from(data, offset)
+        offset += ORIGIN.size
+
+    records = []
+    view = memoryview(data)
+    while len(records) < item_count:
+        block_records, size = _decode_block(view[offset:], style_table, refs, flags, origin)
+        records.extend(block_records)
+        offset += size
+    return records
+
+
+def write_ess(filename, records, delta=False):
+    # Данные готовятся до открытия файла и пишутся рядом с подменой, как в write_paged_ess
+    data = pack_records(records, delta=delta)
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, filename)
+
+
+def is_binary_ess(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def is_paged_ess(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def read_ess(filename):
+    if is_paged_ess(filename):
+        return read_paged_ess(filename)
+    if not is_binary_ess(filename):
+        return read_json_ess(filename)
+    with open(filename, 'rb') as f:
+        return unpack_records(f.read())
+
+
+def open_paged_ess(filename, writable=False):
+    # writable - файл открывается для записи: создается при необходимости, схема версии 1 обновляется
+    connection = sqlite3.connect(filename)
+    if writable:
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS pages (cx INTEGER, cy INTEGER, uids BLOB, zs BLOB, "
+                           "data BLOB, layers BLOB, PRIMARY KEY (cx, cy))")
+        connection.execute("CREATE TABLE IF NOT EXISTS layers (position INTEGER PRIMARY KEY, state TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS bookmarks (position INTEGER PRIMARY KEY, state TEXT)")
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO meta VALUES (?, ?)",
+                                   [('format', PAGED_FORMAT), ('version', str(PAGED_VERSION))])
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.DatabaseError:
+        meta = {}
+    if meta.get('format') != PAGED_FORMAT:
+        connection.close()
+        raise ValueError("Файл не является страничным .ess")
+    if int(meta['version']) > PAGED_VERSION:
+        connection.close()
+        raise ValueError(f"Неподдерживаемая версия страничного .ess: {meta['version']}")
+    if writable and int(meta['version']) < PAGED_VERSION:
+        # Элементы страниц версии 1 (layers = NULL) лежат в слое по умолчанию. Страницы версии 2
+        # с абсолютными координатами остаются как есть: флаги записей хранятся в каждой странице
+        with connection:
+            if int(meta['version']) < 2:
+                connection.execute("ALTER TABLE pages ADD COLUMN layers BLOB")
+            connection.execute("UPDATE meta SET value = ? WHERE key = 'version'", (str(PAGED_VERSION),))
+    return connection
+
+
+def paged_version(connection):
+    return int(connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+
+def write_pages(connection, pages, layers=None, bookmarks=None):
+    # pages: (cx, cy) -> (uids, zs, слои, records); страница без записей удаляется.
+    # layers - состояние слоев (список словарей снизу вверх), bookmarks - список закладок;
+    # None - не менять. Все пишется одной транзакцией
+    with connection:
+        for (cx, cy), (uids, zs, layer_ids, records) in pages.items():
+            if not records:
+                connection.execute("DELETE FROM pages WHERE cx = ? AND cy = ?", (cx, cy))
+                continue
+            connection.execute("INSERT OR REPLACE INTO pages (cx, cy, uids, zs, data, layers) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (cx, cy, np.asarray(uids, dtype='<i8').tobytes(),
+                                np.asarray(zs, dtype='<f8').tobytes(),
+                                pack_records(records, origin=(cx * CHUNK_SIZE, cy * CHUNK_SIZE)),
+                                np.asarray(layer_ids, dtype='<i8').tobytes()))
+        if layers is not None:
+            connection.execute("DELETE FROM layers")
+            connection.executemany("INSERT INTO layers VALUES (?, ?)",
+                                   [(position, json.dumps(state)) for position, state in enumerate(layers)])
+        if bookmarks is not None:
+            connection.execute("DELETE FROM bookmarks")
+            connection.executemany("INSERT INTO bookmarks VALUES (?, ?)",
+                                   [(position, json.dumps(encode_place(place)))
+                                    for position, place in enumerate(bookmarks)])
+
+
+def write_paged_ess(filename, pages, layers=None, bookmarks=None):
+    # Полная запись: новый файл рядом, затем подмена, чтобы сбой не испортил старый
+    temporary = filename + '.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = open_paged_ess(temporary, writable=True)
+    try:
+        write_pages(connection, pages, layers, bookmarks)
+    finally:
+        connection.close()
+    os.replace(temporary, filename)
+
+
+def read_paged_ess(filename):
+    # Записи всех страниц в порядке наложения внутри слоев
+    connection = open_paged_ess(filename)
+    try:
+        layers_column = 'layers' if paged_version(connection) >= 2 else 'NULL'
+        rows = connection.execute(f"SELECT uids, zs, data, {layers_column} FROM pages ORDER BY cx, cy").fetchall()
+    finally:
+        connection.close()
+    records = []
+    for uids, zs, data, layer_ids in rows:
+        page_records = unpack_records(data)
+        uids = np.frombuffer(uids, dtype='<i8')
+        zs = np.frombuffer(zs, dtype='<f8')
+        layer_ids = (np.frombuffer(layer_ids, dtype='<i8') if layer_ids is not None
+                     else np.full(len(page_records), DEFAULT_LAYER))
+        for record, uid, z, layer in zip(page_records, uids, zs, layer_ids):
+            record.uid = int(uid)
+            record.z = float(z)
+            record.layer = int(layer)
+        records.extend(page_records)
+    records.sort(key=lambda record: record.z)
+    return records
+
+
+def read_layers(filename):
+    # Состояние слоев страничного файла; None для файлов без слоев
+    if not is_paged_ess(filename):
+        return None
+    connection = open_paged_ess(filename)
+    try:
+        if paged_version(connection) < 2:
+            return None
+        rows = connection.execute("SELECT state FROM layers ORDER BY position").fetchall()
+    finally:
+        connection.close()
+    return [json.loads(state) for (state,) in rows] or None
+
+
+def read_bookmarks(filename):
+    # Закладки страничного файла; None для файлов, где их нет
+    if not is_paged_ess(filename):
+        return None
+    connection = open_paged_ess(filename)
+    try:
+        # Таблица закладок появилась позже слоев, в файлах версии 2 ее может не быть
+        if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bookmarks'").fetchone():
+            return None
+        rows = connection.execute("SELECT state FROM bookmarks ORDER BY position").fetchall()
+    finally:
+        connection.close()
+    return [decode_place(json.loads(state)) for (state,) in rows]
+
+
+def encode_place(place):
+    # Место для файла: номер чанка и координаты относительно его начала (остальные поля как есть)
+    cx, cy = chunk_key(place['x'], place['y'])
+    data = dict(place)
+    data['chunk'] = [cx, cy]
+    data['x'] = place['x'] - cx * CHUNK_SIZE
+    data['y'] = place['y'] - cy * CHUNK_SIZE
+    return data
+
+
+def decode_place(data):
+    # Место из файла в координатах документа; места старых файлов без чанка уже абсолютные
+    place = dict(data)
+    cx, cy = place.pop('chunk', (0, 0))
+    place['x'] = cx * CHUNK_SIZE + float(place['x'])
+    place['y'] = cy * CHUNK_SIZE + float(place['y'])
+    return place
+
+
+def read_page_index(filename):
+    # uid -> ключ страницы без чтения самих записей
+    connection = open_paged_ess(filename)
+    try:
+        rows = connection.execute("SELECT cx, cy, uids FROM pages").fetchall()
+    finally:
+        connection.close()
+    index = {}
+    for cx, cy, uids in rows:
+        for uid in np.frombuffer(uids, dtype='<i8').tolist():
+            index[uid] = (cx, cy)
+    return index
+
+
+def read_json_ess(filename):
+    # Старый формат: JSON-список элементов с координатами в виде списков
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    records = []
+    for item_data in data:
+        rgba = QColor(item_data['color']).rgba()
+        if item_data['type'] == KIND_PATH:
+            coords = np.array(item_data['path'], dtype=np.float64).reshape(-1, 2)
+            records.append(ItemRecord(KIND_PATH, rgba, float(item_data['width']), coords))
+        elif item_data['type'] == KIND_POLYGON:
+            coords = np.array(item_data['points'], dtype=np.float64).reshape(-1, 2)
+            records.append(ItemRecord(KIND_POLYGON, rgba, 0.0, coords))
+    return records
+
+
+def group_pages(records):
+    # Раскладка записей по страницам для полной записи страничного файла.
+    # Для записей без uid и z используются те же значения, что дает загрузка холста
+    pages = {}
+    for index, record in enumerate(records):
+        if len(record.coords):
+            key = chunk_key(*(record.coords.min(axis=0) - record.width / 2))
+        else:
+            key = (0, 0)
+        uids, zs, layer_ids, page_records = pages.setdefault(key, ([], [], [], []))
+        uids.append(record_uid(record, index))
+        zs.append(record_z(record, index))
+        layer_ids.append(record_layer(record))
+        page_records.append(record)
+    return pages
+
+
+def convert_ess(source, target, delta=False, paged=None):
+    # paged=None сохраняет вид исходного файла: страничный остается страничным вместе со слоями и закладками
+    source_paged = is_paged_ess(source)
+    if paged is None:
+        paged = source_paged
+    if source_paged and not paged and os.path.exists(target) and os.path.samefile(source, target):
+        raise ValueError("Страничный файл нельзя перезаписать плоским: слои и закладки были бы потеряны")
+    records = read_ess(source)
+    if paged:
+        write_paged_ess(target, group_pages(records), read_layers(source), read_bookmarks(source))
+    else:
+        write_ess(target, records, delta=delta)
+    return len(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Конвертация холстов EndlessSketch в бинарный формат .ess")
+    parser.add_argument('source', help="Исходный файл .ess (JSON, бинарный или страничный)")
+    parser.add_argument('target', help="Файл результата")
+    parser.add_argument('--delta', action='store_true', help="Хранить координаты как разности соседних точек")
+    layout = parser.add_mutually_exclusive_group()
+    layout.add_argument('--paged', dest='paged', action='store_const', const=True,
+                        help="Записать страничный файл (формат сохранения программы)")
+    layout.add_argument('--flat', dest='paged', action='store_const', const=False,
+                        help="Записать плоский бинарный файл без слоев и закладок")
+    args = parser.parse_args(argv)
+    try:
+        count = convert_ess(args.source, args.target, delta=args.delta, paged=args.paged)
+        print(f"ess_format: Converted {count} items to {args.target}")
+    except Exception as e:
+        logging.exception("Exception in convert_ess:")
+        print(f"ess_format: Conversion failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
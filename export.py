@@ -0,0 +1,395 @@
+# export.py
+
+import math
+import zlib
+import numpy as np
+from xml.sax.saxutils import escape, quoteattr
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem
+from PyQt5.QtGui import QImage, QPainter, QColor, QPainterPath, QTransform
+from PyQt5.QtCore import Qt, QRectF, QUrl
+from stroke_item import StrokeItem, polygon_to_array, map_array
+from image_item import ImageItem
+from layers import document_transform
+from tile_cache import render_layers
+from png_writer import PngWriter, TILE_PIXELS, BAND_MEMORY, COMPRESS_LEVEL
+
+# Потоковый экспорт области документа в PNG, SVG и PDF. Экспорт - генератор, который по ходу
+# работы отдает (сделано, всего): окно показывает прогресс и может прервать его между шагами.
+# PNG рисуется полосами тайлов сверху вниз, каждая полоса сразу сжимается в файл.
+# SVG и PDF пишутся по элементу: элементы области берутся из пространственного индекса
+# в порядке наложения (иначе перекрытия разных участков легли бы неверно) и сразу уходят в файл,
+# а в памяти не строится ни картинка, ни дерево документа
+MAX_EXPORT_PIXELS = 1 << 30  # Больше пикселей PNG не рисуется: масштаб уменьшается
+MAX_PDF_POINTS = 14400  # Предел стороны страницы PDF (в пунктах) по спецификации
+VECTOR_STEP = 500  # Элементов между отчетами о прогрессе векторного экспорта
+VECTOR_PRECISION = 2  # Знаков после запятой в координатах SVG и PDF
+EXPORT_FORMATS = ('png', 'svg', 'pdf')
+
+
+def png_zoom(rect, zoom):
+    # Масштаб, при котором PNG области не превышает MAX_EXPORT_PIXELS
+    pixels = rect.width() * rect.height() * zoom * zoom
+    if pixels > MAX_EXPORT_PIXELS:
+        zoom *= math.sqrt(MAX_EXPORT_PIXELS / pixels)
+    return zoom
+
+
+def export_png(chunk_store, filename, rect, zoom=1.0, background='#ffffff'):
+    zoom = png_zoom(rect, zoom)
+    width = max(1, math.ceil(rect.width() * zoom))
+    height = max(1, math.ceil(rect.height() * zoom))
+    band_height = max(1, min(TILE_PIXELS, BAND_MEMORY // (width * 4)))
+    bands = range(0, height, band_height)
+    with open(filename, 'wb') as f:
+        writer = PngWriter(f, width, height)
+        for index, y in enumerate(bands):
+            rows = min(band_height, height - y)
+            tiles = [_render_tile(chunk_store, rect, zoom, x, y, min(TILE_PIXELS, width - x), rows, background)
+                     for x in range(0, width, TILE_PIXELS)]
+            writer.write_rows(np.concatenate(tiles, axis=1))
+            del tiles
+            yield index + 1, len(bands)
+        writer.finish()
+
+
+def _render_tile(chunk_store, rect, zoom, x, y, width, height, background):
+    left, top = rect.left() + x / zoom, rect.top() + y / zoom
+    image = QImage(width, height, QImage.Format_RGBA8888)
+    image.fill(QColor(background))
+    layers = chunk_store.visible_layers_in_rect(QRectF(left, top, width / zoom, height / zoom))
+    for _, items in layers:
+        # Пирамиды изображений достраиваются сразу, чтобы в файл не попала заглушка
+        for item in items:
+            if isinstance(item, ImageItem):
+                item.pyramid.build()
+    if layers:
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.scale(zoom, zoom)
+        painter.translate(-left, -top)
+        render_layers(painter, layers)
+        painter.end()
+    pointer = image.constBits()
+    pointer.setsize(image.sizeInBytes())
+    return np.frombuffer(pointer, dtype=np.uint8).reshape(height, image.bytesPerLine())[:, :width * 4].copy()
+
+
+def _number(value):
+    text = f"{value:.{VECTOR_PRECISION}f}".rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def _points(coords):
+    # Точки (n, 2) строками: округление и перевод в текст сразу для всего массива
+    values = (np.round(coords, VECTOR_PRECISION) + 0.0).tolist()
+    return [(str(x), str(y)) for x, y in values]
+
+
+def _svg_points(coords):
+    return " ".join(f"{x},{y}" for x, y in _points(coords))
+
+
+def _svg_color(rgba):
+    color = QColor.fromRgba(rgba)
+    return f'"{color.name()}"', color.alphaF()
+
+
+def _array_elements(coords, curve=False):
+    # Элементы пути из точек: ломаная или начальная точка и тройки точек кривых Безье
+    points = _points(coords)
+    if curve:
+        return [('M', points[:1])] + [('C', points[i:i + 3]) for i in range(1, len(points) - 2, 3)]
+    return [('M', points[:1])] + [('L', points[i:i + 1]) for i in range(1 if len(points) > 1 else 0, len(points))]
+
+
+def _path_elements(path, transform):
+    # Элементы QPainterPath в координатах transform: ('M' | 'L' | 'C', точки строками)
+    elements = []
+    index = 0
+    while index < path.elementCount():
+        element = path.elementAt(index)
+        if element.type == QPainterPath.CurveToElement:
+            # За CurveToElement идут две точки CurveToDataElement
+            count, kind = 3, 'C'
+        else:
+            count, kind = 1, 'M' if element.type == QPainterPath.MoveToElement else 'L'
+        points = [transform.map(path.elementAt(index + i).x, path.elementAt(index + i).y) for i in range(count)]
+        elements.append((kind, _points(np.array(points, dtype=np.float64))))
+        index += count
+    return elements
+
+
+def _svg_path(elements):
+    return " ".join(kind + " ".join(f"{x},{y}" for x, y in points) for kind, points in elements)
+
+
+def svg_element(item, origin):
+    # Элемент SVG для элемента холста; координаты отсчитываются от origin (угла области)
+    transform = document_transform(item)
+    offset = np.array(origin, dtype=np.float64)
+    if isinstance(item, StrokeItem):
+        coords = map_array(transform, item.coords()) - offset
+        color, alpha = _svg_color(item.rgba)
+        d = _svg_path(_array_elements(coords, item.curve))
+        return (f'<path d="{d}" fill="none" stroke={color} stroke-opacity="{alpha:.3g}" '
+                f'stroke-width="{_number(item.width)}" stroke-linecap="round" stroke-linejoin="round"/>')
+    if isinstance(item, QGraphicsPolygonItem):
+        coords = map_array(transform, polygon_to_array(item.polygon())) - offset
+        color, alpha = _svg_color(item.brush().color().rgba())
+        rule = 'evenodd' if item.fillRule() == Qt.OddEvenFill else 'nonzero'
+        return f'<polygon points="{_svg_points(coords)}" fill={color} fill-opacity="{alpha:.3g}" fill-rule="{rule}"/>'
+    if isinstance(item, QGraphicsPathItem):
+        pen = item.pen()
+        color, alpha = _svg_color(pen.color().rgba())
+        d = _svg_path(_path_elements(item.path(), transform * QTransform.fromTranslate(-offset[0], -offset[1])))
+        return (f'<path d="{d}" fill="none" stroke={color} stroke-opacity="{alpha:.3g}" '
+                f'stroke-width="{_number(pen.widthF())}" stroke-linecap="round" stroke-linejoin="round"/>')
+    if isinstance(item, ImageItem):
+        # Изображение, как и в .ess, - ссылка на исходный файл
+        rect = transform.mapRect(item.rect).translated(-offset[0], -offset[1])
+        href = quoteattr(QUrl.fromLocalFile(item.source).toString())
+        return (f'<image x="{_number(rect.left())}" y="{_number(rect.top())}" '
+                f'width="{_number(rect.width())}" height="{_number(rect.height())}" '
+                f'preserveAspectRatio="none" xlink:href={href}/>')
+    return None
+
+
+def _layer_runs(chunk_store, rect):
+    # Элементы области по видимым слоям снизу вверх: [(id слоя, прозрачность, элементы)] и их общее число.
+    # Списки хранят только ссылки на элементы, которые и так находятся в хранилище
+    layers = chunk_store.layers
+    runs = []
+    for layer_id in layers.visible_ids():
+        items = chunk_store.items_in_rect(rect, {layer_id})
+        if items:
+            runs.append((layer_id, layers.layers[layer_id].opacity, items))
+    return runs, max(1, sum(len(items) for _, _, items in runs))
+
+
+def export_svg(chunk_store, filename, rect):
+    # Слой - группа SVG, поэтому его прозрачность применяется к слою целиком, как на холсте
+    runs, total = _layer_runs(chunk_store, rect)
+    done = 0
+    origin = (rect.left(), rect.top())
+    width, height = _number(rect.width()), _number(rect.height())
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                f'width="{width}" height="{height}" viewBox="0 0 {width} {height}">\n')
+        for layer_id, opacity, items in runs:
+            name = escape(chunk_store.layers.layers[layer_id].name)
+            f.write(f'<g id="layer-{layer_id}" opacity="{opacity:.3g}"><title>{name}</title>\n')
+            for item in items:
+                element = svg_element(item, origin)
+                if element is not None:
+                    f.write(element)
+                    f.write('\n')
+                done += 1
+                if done % VECTOR_STEP == 0:
+                    yield done, total
+            f.write('</g>\n')
+        f.write('</svg>\n')
+    yield total, total
+
+
+class PdfWriter:
+    # Потоковая запись одностраничного PDF (как PngWriter в png_writer): каждый слой - форма
+    # (Form XObject) со своим потоком содержимого, который сжимается и пишется по мере поступления.
+    # В памяти остаются только смещения объектов для таблицы xref и имена ресурсов.
+    # Объекты 1-4 - каталог, дерево страниц, страница и общий словарь ресурсов - пишутся в finish
+    def __init__(self, f, width, height, scale):
+        self.f = f
+        self.width = width  # Размер области в единицах холста
+        self.height = height
+        self.scale = scale  # Пунктов PDF на единицу холста
+        self.offsets = {}
+        self.count = 4
+        self.compressor = None
+        self.stream_length = 0
+        self.length_number = None
+        self.states = {}  # (прозрачность линий, прозрачность заливки) -> имя ExtGState
+        self.forms = []  # (имя, номер объекта, прозрачность слоя)
+        self.images = {}  # имя -> номер объекта изображения
+        self.pending_images = []  # Тайлы изображений слоя: пишутся, когда поток слоя закрыт
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def new_object(self):
+        self.count += 1
+        return self.count
+
+    def _begin_object(self, number):
+        self.offsets[number] = self.f.tell()
+        self.f.write(f"{number} 0 obj\n".encode('ascii'))
+
+    def _object(self, number, body):
+        self._begin_object(number)
+        self.f.write(body.encode('ascii') + b"\nendobj\n")
+
+    def _stream(self, number, dictionary, data):
+        # Небольшой поток целиком (например, тайл изображения)
+        data = zlib.compress(data, COMPRESS_LEVEL)
+        self._begin_object(number)
+        self.f.write(f"<< {dictionary} /Length {len(data)} /Filter /FlateDecode >>\nstream\n".encode('ascii'))
+        self.f.write(data + b"\nendstream\nendobj\n")
+
+    def _begin_stream(self, dictionary):
+        number = self.new_object()
+        self.length_number = self.new_object()
+        self._begin_object(number)
+        self.f.write(f"<< {dictionary} /Length {self.length_number} 0 R /Filter /FlateDecode >>\nstream\n"
+                     .encode('ascii'))
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+        self.stream_length = 0
+        return number
+
+    def write(self, text):
+        data = self.compressor.compress(text.encode('ascii'))
+        if data:
+            self.f.write(data)
+            self.stream_length += len(data)
+
+    def _end_stream(self):
+        data = self.compressor.flush()
+        self.f.write(data + b"\nendstream\nendobj\n")
+        self._object(self.length_number, str(self.stream_length + len(data)))
+        self.compressor = None
+
+    def state(self, stroke_alpha, fill_alpha):
+        key = (round(stroke_alpha, 3), round(fill_alpha, 3))
+        if key not in self.states:
+            self.states[key] = f"G{len(self.states) + 1}"
+        return self.states[key]
+
+    def begin_layer(self, opacity):
+        # Группа прозрачности: прозрачность слоя применяется к слою целиком, как на холсте
+        number = self._begin_stream(f"/Type /XObject /Subtype /Form /BBox [0 0 {_number(self.width)} "
+                                    f"{_number(self.height)}] /Group << /S /Transparency >> /Resources 4 0 R")
+        self.forms.append((f"L{len(self.forms) + 1}", number, opacity))
+        self.write("1 J 1 j\n")  # Круглые концы и стыки линий, как у штрихов
+
+    def end_layer(self):
+        self._end_stream()
+        for name, pyramid, level, tx, ty, source in self.pending_images:
+            self._write_tile(name, pyramid, level, tx, ty, source)
+        self.pending_images = []
+
+    def image_tile(self, pyramid, level, tx, ty, target, source):
+        # Тайл пирамиды в прямоугольнике target (координаты области, ось y вниз)
+        name = f"I{len(self.images) + len(self.pending_images) + 1}"
+        self.pending_images.append((name, pyramid, level, tx, ty, source))
+        self.write(f"q {_number(target.width())} 0 0 {_number(-target.height())} {_number(target.left())} "
+                   f"{_number(target.bottom())} cm /{name} Do Q\n")
+
+    def _write_tile(self, name, pyramid, level, tx, ty, source):
+        # Пиксели хранятся с premultiplied alpha в порядке BGRA; в PDF - RGB и отдельная маска прозрачности
+        width, height = int(source.width()), int(source.height())
+        pixels = np.ascontiguousarray(pyramid.levels[level][ty, tx][:height, :width]).astype(np.float32)
+        alpha = pixels[..., 3:4]
+        rgb = np.where(alpha > 0, pixels[..., 2::-1] * 255 / np.maximum(alpha, 1), 0)
+        rgb = np.clip(np.rint(rgb), 0, 255).astype(np.uint8)
+        mask = self.new_object()
+        self._stream(mask, f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                           f"/ColorSpace /DeviceGray /BitsPerComponent 8", pixels[..., 3].astype(np.uint8).tobytes())
+        number = self.new_object()
+        self._stream(number, f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                             f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /SMask {mask} 0 R", rgb.tobytes())
+        self.images[name] = number
+
+    def finish(self):
+        page_width, page_height = self.width * self.scale, self.height * self.scale
+        # Ось y холста направлена вниз, а у PDF - вверх
+        content = [f"1 0 0 -1 0 {_number(page_height)} cm {self.scale:.6g} 0 0 {self.scale:.6g} 0 0 cm"]
+        for name, _, opacity in self.forms:
+            state = f"/{self.state(opacity, opacity)} gs " if opacity < 1.0 else ""
+            content.append(f"q {state}/{name} Do Q")
+        content_number = self.new_object()
+        self._stream(content_number, "", "\n".join(content).encode('ascii'))
+        states = " ".join(f"/{name} << /CA {stroke:g} /ca {fill:g} >>" for (stroke, fill), name in self.states.items())
+        objects = [f"/{name} {number} 0 R" for name, number, _ in self.forms]
+        objects.extend(f"/{name} {number} 0 R" for name, number in self.images.items())
+        self._object(4, f"<< /ExtGState << {states} >> /XObject << {' '.join(objects)} >> >>")
+        self._object(3, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {_number(page_width)} {_number(page_height)}] "
+                        f"/Resources 4 0 R /Contents {content_number} 0 R >>")
+        self._object(2, "<< /Type /Pages /Kids [3 0 R] /Count 1 >>")
+        self._object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.f.tell()
+        lines = [f"xref\n0 {self.count + 1}\n", "0000000000 65535 f \n"]
+        lines.extend(f"{self.offsets[number]:010d} 00000 n \n" for number in range(1, self.count + 1))
+        lines.append(f"trailer\n<< /Size {self.count + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n")
+        self.f.write("".join(lines).encode('ascii'))
+
+
+def _pdf_color(rgba):
+    color = QColor.fromRgba(rgba)
+    return f"{color.redF():.3g} {color.greenF():.3g} {color.blueF():.3g}", color.alphaF()
+
+
+def _pdf_path(elements):
+    operators = {'M': 'm', 'L': 'l', 'C': 'c'}
+    return " ".join(" ".join(f"{x} {y}" for x, y in points) + " " + operators[kind]
+                    for kind, points in elements)
+
+
+def pdf_operations(item, origin, writer, region):
+    # Операторы PDF для элемента холста; координаты отсчитываются от origin (угла области)
+    transform = document_transform(item)
+    offset = np.array(origin, dtype=np.float64)
+    if isinstance(item, StrokeItem):
+        color, alpha = _pdf_color(item.rgba)
+        coords = map_array(transform, item.coords()) - offset
+        return (f"{color} RG /{writer.state(alpha, alpha)} gs {_number(item.width)} w "
+                f"{_pdf_path(_array_elements(coords, item.curve))} S\n")
+    if isinstance(item, QGraphicsPolygonItem):
+        color, alpha = _pdf_color(item.brush().color().rgba())
+        coords = map_array(transform, polygon_to_array(item.polygon())) - offset
+        fill = 'f*' if item.fillRule() == Qt.OddEvenFill else 'f'
+        return f"{color} rg /{writer.state(alpha, alpha)} gs {_pdf_path(_array_elements(coords))} h {fill}\n"
+    if isinstance(item, QGraphicsPathItem):
+        pen = item.pen()
+        color, alpha = _pdf_color(pen.color().rgba())
+        elements = _path_elements(item.path(), transform * QTransform.fromTranslate(-offset[0], -offset[1]))
+        return f"{color} RG /{writer.state(alpha, alpha)} gs {_number(pen.widthF())} w {_pdf_path(elements)} S\n"
+    if isinstance(item, ImageItem):
+        pyramid = item.pyramid
+        pyramid.build()
+        if not pyramid.ready:
+            return None
+        rect = transform.mapRect(item.rect)
+        level = pyramid.level_for(rect, writer.scale)
+        for tx, ty, target, source in pyramid.tiles_in(rect, region, level):
+            writer.image_tile(pyramid, level, tx, ty, target.translated(-offset[0], -offset[1]), source)
+    return None
+
+
+def export_pdf(chunk_store, filename, rect):
+    # Страница размером с область: 1 единица холста = 1 пункт, крупные области уменьшаются до MAX_PDF_POINTS
+    scale = min(1.0, MAX_PDF_POINTS / max(rect.width(), rect.height()))
+    runs, total = _layer_runs(chunk_store, rect)
+    done = 0
+    origin = (rect.left(), rect.top())
+    with open(filename, 'wb') as f:
+        writer = PdfWriter(f, rect.width(), rect.height(), scale)
+        for layer_id, opacity, items in runs:
+            writer.begin_layer(opacity)
+            for item in items:
+                operations = pdf_operations(item, origin, writer, rect)
+                if operations is not None:
+                    writer.write(operations)
+                done += 1
+                if done % VECTOR_STEP == 0:
+                    yield done, total
+            writer.end_layer()
+        writer.finish()
+    yield total, total
+
+
+def export_document(chunk_store, filename, rect, zoom=1.0):
+    # Формат выбирается по расширению файла
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'png':
+        return export_png(chunk_store, filename, rect, zoom)
+    if extension == 'svg':
+        return export_svg(chunk_store, filename, rect)
+    if extension == 'pdf':
+        return export_pdf(chunk_store, filename, rect)
+    raise ValueError(f"Неизвестный формат экспорта: {extension}")
@@ -0,0 +1,453 @@
+# history.py
+
+import time
+import logging
+import tempfile
+from PyQt5.QtGui import QColor, QTransform
+from PyQt5.QtCore import Qt
+from chunks import ITEM_UID, ITEM_LAYER
+from ess_format import item_to_record, pack_records, record_to_item, unpack_records
+
+MEMORY_LIMIT = 64 * 1024 * 1024  # Сколько байт данных истории держать в памяти
+MAX_ENTRIES = 10000  # Более старые действия забываются
+MERGE_INTERVAL = 0.25  # Действия, повторенные быстрее этого интервала (с), объединяются
+ITEM_OVERHEAD = 256  # Примерная стоимость графического элемента без учета точек
+
+
+def item_memory(item):
+    record = item_to_record(item)
+    if record is None:
+        return ITEM_OVERHEAD
+    return ITEM_OVERHEAD + record.coords.nbytes
+
+
+def apply_style(item, rgba, width):
+    color = QColor.fromRgba(rgba)
+    if hasattr(item, 'pen') and item.pen().style() != Qt.NoPen:
+        pen = item.pen()
+        pen.setColor(color)
+        pen.setWidthF(width)
+        item.setPen(pen)
+    if hasattr(item, 'brush') and item.brush().style() != Qt.NoBrush:
+        brush = item.brush()
+        brush.setColor(color)
+        item.setBrush(brush)
+
+
+def item_style(item):
+    if hasattr(item, 'brush') and item.brush().style() != Qt.NoBrush:
+        return item.brush().color().rgba(), 0.0
+    pen = item.pen()
+    return pen.color().rgba(), pen.widthF()
+
+
+class ItemRef:
+    # Ссылка на элемент из истории. Сам объект держится только пока элемент
+    # не находится в документе; после выгрузки на диск восстанавливается по записи
+    __slots__ = ('uid', 'z', 'layer', 'item', 'index')
+
+    def __init__(self, item):
+        self.uid = item.data(ITEM_UID)
+        self.z = item.zValue()
+        self.layer = item.data(ITEM_LAYER)
+        self.item = item
+        self.index = None  # Номер записи в выгруженном блоке команды
+
+
+class Command:
+    merge_key = None
+
+    def __init__(self):
+        self.timestamp = None  # Время добавления в историю по History.clock
+        self.spill_offset = None  # (смещение, длина) блока во временном файле
+        self.memory = 0
+
+    def refs(self):
+        return []
+
+    def undo(self, history):
+        raise NotImplementedError
+
+    def redo(self, history):
+        raise NotImplementedError
+
+    def merge(self, other):
+        return False
+
+    def changes(self, undone=False):
+        # Итог действия для журнала: (uid удаленных элементов, uid добавленных или измененных)
+        raise NotImplementedError
+
+    def estimateMemory(self, store):
+        # Память занимают только элементы, которых нет в документе
+        self.memory = sum(item_memory(ref.item) for ref in self.refs()
+                          if ref.item is not None and ref.item not in store)
+        return self.memory
+
+    def spill(self, history):
+        store = history.store
+        pending = []
+        for ref in self.refs():
+            if ref.item is None:
+                continue
+            if ref.item not in store:
+                ref.index = len(pending)
+                pending.append(item_to_record(ref.item))
+            ref.item = None
+        if pending:
+            self.spill_offset = history.writeSpill(pack_records(pending))
+        self.memory = 0
+
+    def restore(self, history):
+        if self.spill_offset is None:
+            return
+        records = unpack_records(history.readSpill(*self.spill_offset))
+        for ref in self.refs():
+            if ref.item is None and ref.index is not None and history.store.item_by_uid(ref.uid) is None:
+                item = record_to_item(records[ref.index])
+                item.setData(ITEM_UID, ref.uid)
+                item.setData(ITEM_LAYER, ref.layer)
+                item.setZValue(ref.z)
+                ref.item = item
+        self.spill_offset = None
+
+    def _resolve(self, history, ref):
+        if ref.item is None:
+            ref.item = history.store.item_by_uid(ref.uid)
+        return ref.item
+
+
+class AddItemsCommand(Command):
+    merge_key = 'add'
+
+    def __init__(self, items):
+        super().__init__()
+        self.items = [ItemRef(item) for item in items]
+
+    def refs(self):
+        return self.items
+
+    def undo(self, history):
+        for ref in self.items:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.remove_item(item)
+
+    def redo(self, history):
+        for ref in self.items:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.add_item(item, ref.z)
+
+    def merge(self, other):
+        self.items.extend(other.items)
+        return True
+
+    def changes(self, undone=False):
+        uids = [ref.uid for ref in self.items]
+        return (uids, []) if undone else ([], uids)
+
+
+class RemoveItemsCommand(Command):
+    def __init__(self, items):
+        super().__init__()
+        self.items = [ItemRef(item) for item in items]
+
+    def refs(self):
+        return self.items
+
+    def undo(self, history):
+        for ref in self.items:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.add_item(item, ref.z)
+
+    def redo(self, history):
+        for ref in self.items:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.remove_item(item)
+
+    def changes(self, undone=False):
+        uids = [ref.uid for ref in self.items]
+        return ([], uids) if undone else (uids, [])
+
+
+class EraseClipCommand(Command):
+    # Стирание: исходные элементы заменены оставшимися кусками
+    def __init__(self, removed, added):
+        super().__init__()
+        self.removed = [ItemRef(item) for item in removed]
+        self.added = [ItemRef(item) for item in added]
+
+    def refs(self):
+        return self.removed + self.added
+
+    def undo(self, history):
+        for ref in self.added:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.remove_item(item)
+        for ref in self.removed:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.add_item(item, ref.z)
+
+    def redo(self, history):
+        for ref in self.removed:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.remove_item(item)
+        for ref in self.added:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.add_item(item, ref.z)
+
+    def changes(self, undone=False):
+        removed = [ref.uid for ref in self.removed]
+        added = [ref.uid for ref in self.added]
+        return (added, removed) if undone else (removed, added)
+
+
+class TransformCommand(Command):
+    merge_key = 'transform'
+
+    def __init__(self, items, old_transforms, new_transforms):
+        super().__init__()
+        self.items = [ItemRef(item) for item in items]
+        self.old = [QTransform(transform) for transform in old_transforms]
+        self.new = [QTransform(transform) for transform in new_transforms]
+
+    def refs(self):
+        return self.items
+
+    def _apply(self, history, transforms):
+        for ref, transform in zip(self.items, transforms):
+            item = self._resolve(history, ref)
+            if item is None:
+                continue
+            # Элемент переустанавливается в хранилище, чтобы обновить его чанки
+            in_store = item in history.store
+            if in_store:
+                history.store.remove_item(item)
+            item.setTransform(transform)
+            if in_store:
+                history.store.add_item(item, ref.z)
+
+    def undo(self, history):
+        self._apply(history, self.old)
+
+    def redo(self, history):
+        self._apply(history, self.new)
+
+    def changes(self, undone=False):
+        return [], [ref.uid for ref in self.items]
+
+    def merge(self, other):
+        if [ref.uid for ref in self.items] != [ref.uid for ref in other.items]:
+            return False
+        self.new = other.new
+        return True
+
+
+class StyleCommand(Command):
+    merge_key = 'style'
+
+    def __init__(self, items, old_styles, new_styles):
+        super().__init__()
+        self.items = [ItemRef(item) for item in items]
+        self.old = list(old_styles)  # [(rgba, width), ...]
+        self.new = list(new_styles)
+
+    def refs(self):
+        return self.items
+
+    def _apply(self, history, styles):
+        for ref, (rgba, width) in zip(self.items, styles):
+            item = self._resolve(history, ref)
+            if item is not None:
+                apply_style(item, rgba, width)
+                history.store.update_item(item)
+
+    def undo(self, history):
+        self._apply(history, self.old)
+
+    def redo(self, history):
+        self._apply(history, self.new)
+
+    def changes(self, undone=False):
+        return [], [ref.uid for ref in self.items]
+
+    def merge(self, other):
+        if [ref.uid for ref in self.items] != [ref.uid for ref in other.items]:
+            return False
+        self.new = other.new
+        return True
+
+
+class LayerCommand(Command):
+    # Изменение слоев: состояние LayerStack до и после целиком. При удалении слоя
+    # вместе с ним из документа убираются его элементы
+    merge_key = 'layer'
+
+    def __init__(self, old_state, new_state, removed=()):
+        super().__init__()
+        self.old = old_state
+        self.new = new_state
+        self.removed = [ItemRef(item) for item in removed]
+
+    def refs(self):
+        return self.removed
+
+    def undo(self, history):
+        history.store.layers.set_state(self.old)
+        for ref in self.removed:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.add_item(item, ref.z)
+
+    def redo(self, history):
+        for ref in self.removed:
+            item = self._resolve(history, ref)
+            if item is not None:
+                history.store.remove_item(item)
+        history.store.layers.set_state(self.new)
+
+    def changes(self, undone=False):
+        uids = [ref.uid for ref in self.removed]
+        return ([], uids) if undone else (uids, [])
+
+    def merge(self, other):
+        # Серия изменений одного слоя (например, движение ползунка прозрачности) - одно действие
+        if self.removed or other.removed or len(self.old) != len(other.old):
+            return False
+        changed = [i for i, (a, b) in enumerate(zip(other.old, other.new)) if a != b]
+        own = [i for i, (a, b) in enumerate(zip(self.old, self.new)) if a != b]
+        if changed != own or other.old != self.new:
+            return False
+        self.new = other.new
+        return True
+
+
+# История действий с отменой и повтором. Память считается по обоим стекам: при превышении предела
+# старые записи отмены и самые дальние записи повтора сериализуются во временный файл
+# и читаются обратно при отмене или повторе
+class History:
+    def __init__(self, store, memory_limit=MEMORY_LIMIT, max_entries=MAX_ENTRIES):
+        self.store = store
+        self.memory_limit = memory_limit
+        self.max_entries = max_entries
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory_used = 0
+        self.spill_file = None
+        self.spill_start = 0  # Индекс первой невыгруженной записи в undo_stack
+        self.listeners = []  # Функции listener(command, undone), вызываемые после каждого действия
+        self.clock = time.monotonic  # Время для объединения действий; воспроизведение ввода подставляет время записи
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+    def canUndo(self):
+        return bool(self.undo_stack)
+
+    def canRedo(self):
+        return bool(self.redo_stack)
+
+    def push(self, command):
+        for dropped in self.redo_stack:
+            self.memory_used -= dropped.memory
+        self.redo_stack.clear()
+        command.timestamp = self.clock()
+        top = self.undo_stack[-1] if self.undo_stack else None
+        if (top is not None and top.merge_key is not None and top.merge_key == command.merge_key
+                and top.spill_offset is None
+                and command.timestamp - top.timestamp < MERGE_INTERVAL and top.merge(command)):
+            top.timestamp = command.timestamp
+            self.memory_used -= top.memory
+            self.memory_used += top.estimateMemory(self.store)
+        else:
+            self.undo_stack.append(command)
+            self.memory_used += command.estimateMemory(self.store)
+        self._notify(command, False)
+        self._enforceLimits()
+
+    def undo(self):
+        if not self.undo_stack:
+            return False
+        command = self.undo_stack.pop()
+        self.spill_start = min(self.spill_start, len(self.undo_stack))
+        self.memory_used -= command.memory
+        command.restore(self)
+        command.undo(self)
+        self.redo_stack.append(command)
+        self.memory_used += command.estimateMemory(self.store)
+        self._notify(command, True)
+        self._enforceLimits()
+        return True
+
+    def redo(self):
+        if not self.redo_stack:
+            return False
+        command = self.redo_stack.pop()
+        self.memory_used -= command.memory
+        command.restore(self)
+        command.redo(self)
+        self.undo_stack.append(command)
+        self.memory_used += command.estimateMemory(self.store)
+        self._notify(command, False)
+        self._enforceLimits()
+        return True
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.memory_used = 0
+        self.spill_start = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def _notify(self, command, undone):
+        for listener in self.listeners:
+            listener(command, undone)
+
+    def writeSpill(self, data):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='endless_sketch_history_')
+        self.spill_file.seek(0, 2)
+        offset = self.spill_file.tell()
+        self.spill_file.write(data)
+        return offset, len(data)
+
+    def readSpill(self, offset, length):
+        self.spill_file.seek(offset)
+        return self.spill_file.read(length)
+
+    def _enforceLimits(self):
+        while len(self.undo_stack) > self.max_entries:
+            dropped = self.undo_stack.pop(0)
+            self.memory_used -= dropped.memory
+            self.spill_start = max(0, self.spill_start - 1)
+        # Выгружаем самые старые записи, пока не уложимся в предел
+        while self.memory_used > self.memory_limit and self.spill_start < len(self.undo_stack) - 1:
+            command = self.undo_stack[self.spill_start]
+            self.memory_used -= command.memory
+            try:
+                command.spill(self)
+            except Exception as e:
+                logging.exception("Exception in History spill:")
+                break
+            self.spill_start += 1
+        # Затем записи повтора, начиная с самой дальней (низ стека); верхняя остается в памяти
+        for command in self.redo_stack[:-1]:
+            if self.memory_used <= self.memory_limit:
+                break
+            if not command.memory:
+                continue
+            self.memory_used -= command.memory
+            try:
+                command.spill(self)
+            except Exception as e:
+                logging.exception("Exception in History spill:")
+                break
@@ -0,0 +1,328 @@
+# image_item.py
+
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsItem
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler, QPainter, QColor, QPen
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QRect, QRectF, QStandardPaths, pyqtSignal
+from instrumentation import log
+
+IMAGE_TILE = 256  # Размер тайла пирамиды в пикселях
+BUILD_BAND = 2048  # Строк исходника за одно чтение, если формат умеет читать часть изображения
+TILE_MEMORY_LIMIT = 64 * 1024 * 1024  # Предел памяти (байт) под декодированные тайлы всех изображений
+IMAGE_CACHE_ENV = 'ENDLESS_SKETCH_IMAGE_CACHE'
+PLACEHOLDER_COLOR = QColor(225, 225, 225)  # Изображение еще готовится
+MISSING_COLOR = QColor(200, 120, 120)  # Файл изображения не найден или не читается
+
+# Изображения-референсы. Исходник один раз нарезается на тайлы IMAGE_TILE x IMAGE_TILE
+# с пирамидой уменьшенных копий (каждый уровень вдвое меньше предыдущего) и сохраняется
+# в дисковый кэш: по файлу на уровень, тайлы подряд в формате ARGB32 Premultiplied.
+# Файлы уровней отображаются в память (numpy.memmap), поэтому отрисовка читает с диска
+# только тайлы нужного масштаба в видимой области и не масштабирует исходник целиком.
+# В документе хранится только путь к исходнику и прямоугольник изображения
+
+
+def image_cache_directory():
+    directory = os.environ.get(IMAGE_CACHE_ENV)
+    if not directory:
+        location = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
+        directory = os.path.join(location, 'images')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def image_size(source):
+    # Размер изображения по заголовку файла, без декодирования; None, если файл не читается
+    size = QImageReader(source).size()
+    if not size.isValid() or size.isEmpty():
+        return None
+    return size.width(), size.height()
+
+
+def level_sizes(width, height):
+    # Размеры уровней пирамиды: уровень 0 - исходник, последний целиком помещается в тайл
+    sizes = [(width, height)]
+    while max(sizes[-1]) > IMAGE_TILE:
+        w, h = sizes[-1]
+        sizes.append(((w + 1) // 2, (h + 1) // 2))
+    return sizes
+
+
+def _tile_grid(width, height):
+    return (height + IMAGE_TILE - 1) // IMAGE_TILE, (width + IMAGE_TILE - 1) // IMAGE_TILE
+
+
+def _image_array(image):
+    # Пиксели QImage в формате ARGB32 Premultiplied как массив (высота, ширина, 4) без копии
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def _store_band(level, top, band):
+    # Записывает полосу пикселей (кратную тайлу по высоте, кроме последней) в тайлы уровня
+    rows, columns = level.shape[:2]
+    padded = np.zeros((-(-len(band) // IMAGE_TILE) * IMAGE_TILE, columns * IMAGE_TILE, 4), dtype=np.uint8)
+    padded[:band.shape[0], :band.shape[1]] = band
+    tiles = padded.reshape(-1, IMAGE_TILE, columns, IMAGE_TILE, 4).transpose(0, 2, 1, 3, 4)
+    first = top // IMAGE_TILE
+    level[first:first + len(tiles)] = tiles
+
+
+def _load_band(level, first, count):
+    # Полоса тайловых строк уровня first..first + count как массив пикселей
+    tiles = np.asarray(level[first:first + count])
+    return tiles.transpose(0, 2, 1, 3, 4).reshape(len(tiles) * IMAGE_TILE, -1, 4)
+
+
+class PyramidSignals(QObject):
+    built = pyqtSignal(str)  # Путь исходника, пирамида которого готова (или не собралась)
+
+
+_signals = None
+
+
+def pyramid_signals():
+    # Создается в потоке интерфейса при первом обращении; сигнал доставляется через очередь событий
+    global _signals
+    if _signals is None:
+        _signals = PyramidSignals()
+    return _signals
+
+
+class BuildJob(QRunnable):
+    def __init__(self, pyramid, signals):
+        super().__init__()
+        self.pyramid = pyramid
+        self.signals = signals
+
+    def run(self):
+        try:
+            self.pyramid.build()
+        except Exception as e:
+            logging.exception("Exception in BuildJob run:")
+        self.signals.built.emit(self.pyramid.source)
+
+
+# Пирамида тайлов одного исходника. Общая для всех элементов с тем же файлом; draw() можно
+# вызывать из потоков отрисовки тайлов холста - кэш декодированных тайлов защищен блокировкой
+class ImagePyramid:
+    _tiles = OrderedDict()  # (путь, уровень, tx, ty) -> QImage, общий для всех пирамид
+    _tiles_memory = 0
+    _lock = threading.Lock()
+
+    def __init__(self, source):
+        self.source = source
+        self.size = image_size(source)
+        self.failed = self.size is None
+        self.levels = []  # memmap (строки тайлов, столбцы тайлов, IMAGE_TILE, IMAGE_TILE, 4) по уровням
+        self.building = False
+        if not self.failed:
+            self.directory = os.path.join(image_cache_directory(), self._cache_key())
+            self._open()
+
+    @property
+    def ready(self):
+        return bool(self.levels)
+
+    def _cache_key(self):
+        stat = os.stat(self.source)
+        key = f"{os.path.abspath(self.source)}|{stat.st_size}|{stat.st_mtime_ns}|{IMAGE_TILE}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _open(self):
+        # Открывает готовый кэш; False, если его еще нет
+        try:
+            with open(os.path.join(self.directory, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        levels = []
+        for index, (width, height) in enumerate(meta['levels']):
+            rows, columns = _tile_grid(width, height)
+            levels.append(np.memmap(os.path.join(self.directory, f'level-{index}.raw'), dtype=np.uint8, mode='r',
+                                    shape=(rows, columns, IMAGE_TILE, IMAGE_TILE, 4)))
+        self.levels = levels
+        return True
+
+    def request_build(self):
+        # Собирает пирамиду в пуле потоков; по окончании pyramid_signals().built(source)
+        if self.ready or self.failed or self.building:
+            return
+        self.building = True
+        QThreadPool.globalInstance().start(BuildJob(self, pyramid_signals()))
+
+    def build(self):
+        # Синхронная сборка кэша. Пишется во временный каталог и переименовывается целиком,
+        # так что параллельная сборка того же файла (например, процессами render_cli) безопасна
+        if self.ready or self.failed:
+            return
+        try:
+            temporary = f"{self.directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+            os.makedirs(temporary, exist_ok=True)
+            width, height = self.size
+            sizes = level_sizes(width, height)
+            levels = []
+            for index, (level_width, level_height) in enumerate(sizes):
+                rows, columns = _tile_grid(level_width, level_height)
+                levels.append(np.memmap(os.path.join(temporary, f'level-{index}.raw'), dtype=np.uint8, mode='w+',
+                                        shape=(rows, columns, IMAGE_TILE, IMAGE_TILE, 4)))
+            self._decode_base(levels[0])
+            for index in range(1, len(levels)):
+                self._reduce(levels[index - 1], levels[index], sizes[index - 1])
+            for level in levels:
+                level.flush()
+            del levels
+            with open(os.path.join(temporary, 'meta.json'), 'w') as f:
+                json.dump({'source': os.path.abspath(self.source), 'levels': sizes}, f)
+            try:
+                os.rename(temporary, self.directory)
+            except OSError:
+                # Кэш уже собрал кто-то другой
+                shutil.rmtree(temporary, ignore_errors=True)
+            if not self._open():
+                raise ValueError("Кэш изображения не открылся")
+            log.debug("ImagePyramid: Built %s levels for %s", len(sizes), self.source)
+        except Exception as e:
+            logging.exception("Exception in ImagePyramid build:")
+            self.failed = True
+        finally:
+            self.building = False
+
+    def _decode_base(self, level):
+        # Исходник декодируется полосами, если формат это умеет (например, JPEG), иначе целиком один раз
+        width, height = self.size
+        banded = QImageReader(self.source).supportsOption(QImageIOHandler.ClipRect)
+        band_height = BUILD_BAND if banded else height
+        for top in range(0, height, band_height):
+            reader = QImageReader(self.source)
+            if banded:
+                reader.setClipRect(QRect(0, top, width, min(band_height, height - top)))
+            image = reader.read()
+            if image.isNull():
+                raise ValueError(f"Не удалось прочитать изображение: {reader.errorString()}")
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            _store_band(level, top, _image_array(image))
+
+    def _reduce(self, source, target, source_size):
+        # Уровень вдвое меньше: среднее по квадратам 2x2 (у последнего столбца или строки
+        # нечетного размера соседом служит прозрачный край, как в тайлах)
+        for row in range(target.shape[0]):
+            band = _load_band(source, 2 * row, 2).astype(np.uint16)
+            if len(band) % 2:
+                band = np.concatenate((band, np.zeros((1,) + band.shape[1:], dtype=np.uint16)))
+            if band.shape[1] % 2:
+                band = np.concatenate((band, np.zeros((band.shape[0], 1, 4), dtype=np.uint16)), axis=1)
+            reduced = (band[0::2, 0::2] + band[1::2, 0::2] + band[0::2, 1::2] + band[1::2, 1::2] + 2) // 4
+            _store_band(target, row * IMAGE_TILE, reduced[:, :target.shape[1] * IMAGE_TILE].astype(np.uint8))
+
+    def tile(self, level, tx, ty):
+        key = (self.source, level, tx, ty)
+        with self._lock:
+            image = self._tiles.get(key)
+            if image is not None:
+                self._tiles.move_to_end(key)
+                return image
+        data = np.ascontiguousarray(self.levels[level][ty, tx])
+        image = QImage(data.data, IMAGE_TILE, IMAGE_TILE, IMAGE_TILE * 4, QImage.Format_ARGB32_Premultiplied).copy()
+        with self._lock:
+            cls = ImagePyramid
+            if key not in cls._tiles:
+                cls._tiles[key] = image
+                cls._tiles_memory += image.sizeInBytes()
+            while cls._tiles_memory > TILE_MEMORY_LIMIT and len(cls._tiles) > 1:
+                _, evicted = cls._tiles.popitem(last=False)
+                cls._tiles_memory -= evicted.sizeInBytes()
+        return image
+
+    def draw(self, painter, rect, exposed=None):
+        # Рисует изображение в прямоугольник rect (координаты painter). Уровень подбирается по масштабу
+        # painter так, чтобы пиксель уровня был не мельче пикселя устройства; рисуются только тайлы,
+        # попадающие в exposed, а если он пуст - в область устройства и отсечения
+        if not self.ready:
+            painter.fillRect(rect, MISSING_COLOR if self.failed else PLACEHOLDER_COLOR)
+            if self.failed:
+                painter.save()
+                painter.setPen(QPen(Qt.white, 0))
+                painter.drawLine(rect.topLeft(), rect.bottomRight())
+                painter.drawLine(rect.topRight(), rect.bottomLeft())
+                painter.restore()
+            return
+        transform = painter.worldTransform()
+        if exposed is None or exposed.isEmpty():
+            device = painter.device()
+            exposed = transform.inverted()[0].mapRect(QRectF(0, 0, device.width(), device.height()))
+            if painter.hasClipping():
+                exposed = exposed.intersected(painter.clipBoundingRect())
+        level = self.level_for(rect, math.hypot(transform.m11(), transform.m12()))
+        painter.save()
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for tx, ty, target, source in self.tiles_in(rect, exposed, level):
+            painter.drawImage(target, self.tile(level, tx, ty), source)
+        painter.restore()
+
+    def level_for(self, rect, scale):
+        # Уровень, пиксель которого не мельче пикселя устройства, если на единицу rect приходится scale пикселей
+        device_scale = scale * rect.width() / self.size[0]
+        if device_scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / device_scale))), len(self.levels) - 1)
+
+    def tiles_in(self, rect, visible, level):
+        # Тайлы уровня, задевающие visible: (tx, ty, место тайла в координатах rect, часть тайла
+        # с изображением в пикселях) - у крайних тайлов изображение занимает только часть
+        visible = visible.intersected(rect)
+        if visible.isEmpty():
+            return
+        width, height = self.size
+        tiles = self.levels[level]
+        tile_size = IMAGE_TILE * 2 ** level * rect.width() / width  # Размер тайла уровня в единицах rect
+        level_width, level_height = math.ceil(width / 2 ** level), math.ceil(height / 2 ** level)
+        x0 = max(0, int((visible.left() - rect.left()) // tile_size))
+        y0 = max(0, int((visible.top() - rect.top()) // tile_size))
+        x1 = min(tiles.shape[1] - 1, int((visible.right() - rect.left()) // tile_size))
+        y1 = min(tiles.shape[0] - 1, int((visible.bottom() - rect.top()) // tile_size))
+        for ty in range(y0, y1 + 1):
+            for tx in range(x0, x1 + 1):
+                pixels_x = min(IMAGE_TILE, level_width - tx * IMAGE_TILE)
+                pixels_y = min(IMAGE_TILE, level_height - ty * IMAGE_TILE)
+                target = QRectF(rect.left() + tx * tile_size, rect.top() + ty * tile_size,
+                                tile_size * pixels_x / IMAGE_TILE, tile_size * pixels_y / IMAGE_TILE)
+                yield tx, ty, target, QRectF(0, 0, pixels_x, pixels_y)
+
+
+_pyramids = {}
+
+
+def image_pyramid(source):
+    # Одна пирамида на файл: ее тайлы и кэш общие для всех элементов с этим изображением
+    pyramid = _pyramids.get(source)
+    if pyramid is None:
+        pyramid = _pyramids[source] = ImagePyramid(source)
+    return pyramid
+
+
+# Изображение на холсте: прямоугольник в координатах документа и путь к исходнику.
+# Пока пирамида собирается, вместо изображения рисуется заглушка
+class ImageItem(QGraphicsItem):
+    def __init__(self, source, rect):
+        super().__init__()
+        self.source = source
+        self.rect = QRectF(rect)
+        self.pyramid = image_pyramid(source)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)  # exposedRect - только видимая часть
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        self.pyramid.request_build()
+        self.pyramid.draw(painter, self.rect, option.exposedRect if option is not None else None)
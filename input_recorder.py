@@ -0,0 +1,356 @@
+# input_recorder.py
+
+import json
+import time
+import zlib
+import struct
+import hashlib
+import logging
+from PyQt5.QtGui import QColor, QMouseEvent, QWheelEvent, QKeyEvent, QTransform
+from PyQt5.QtCore import Qt, QEvent, QPoint, QPointF
+from tools import BrushTool, LassoFillTool, LassoEraseTool, EyedropperTool
+from ess_format import item_to_record
+from chunks import ITEM_LAYER
+from journal import (RECORD_HEADER, OP_LAYERS, OP_BOOKMARKS, STATE_OPERATIONS, OP_ADD,
+                     encode_add, encode_state, decode_operation, apply_operations)
+from instrumentation import log, metrics
+
+# Запись ввода (.esr): заголовок, JSON с состоянием вида и настроек, снимок документа
+# в виде записей журнала и сжатый поток событий фиксированного размера до конца файла.
+# Поток сжимается по мере записи, поэтому оборванная запись читается до последнего целого события
+RECORDING_MAGIC = b'ESIR'
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct('<4sHII')  # сигнатура, версия, длина JSON, длина сжатого снимка документа
+# Время в мс от начала записи, вид события, кнопка, нажатые кнопки, модификаторы,
+# позиция в координатах вида и значение (отметка времени мыши, колесико, клавиша, инструмент, размер, цвет)
+EVENT = struct.Struct('<IBBBxIffq')
+COMPRESSION_LEVEL = 6
+
+EVENT_PRESS = 1
+EVENT_MOVE = 2
+EVENT_RELEASE = 3
+EVENT_WHEEL = 4
+EVENT_KEY = 5
+EVENT_TOOL = 6
+EVENT_BRUSH = 7
+EVENT_COLOR = 8
+EVENT_FLUSH = 9  # Кадр ввода по таймеру: накопленные движения переданы инструменту
+EVENT_FRAME = 10  # Перерисовка холста
+
+MOUSE_EVENTS = {
+    EVENT_PRESS: (QEvent.MouseButtonPress, 'mousePressEvent'),
+    EVENT_MOVE: (QEvent.MouseMove, 'mouseMoveEvent'),
+    EVENT_RELEASE: (QEvent.MouseButtonRelease, 'mouseReleaseEvent'),
+}
+TOOLS = (BrushTool, LassoFillTool, LassoEraseTool, EyedropperTool)  # Номер инструмента в записи - индекс здесь
+# Настройки, от которых зависит обработка ввода; цвет пишется отдельно
+RECORDED_SETTINGS = ('brush_size_percentage', 'simplify_tolerance', 'min_point_distance', 'smooth_strokes',
+                     'curve_tolerance', 'eyedropper_sample_size', 'input_frame_interval', 'input_samples_per_frame')
+# Клавиши, открывающие диалоги (клавиша, обязательные модификаторы): при воспроизведении диалог повис бы,
+# поэтому пишется только их результат, например событие смены цвета
+DIALOG_KEYS = ((Qt.Key_C, Qt.ControlModifier), (Qt.Key_S, Qt.ControlModifier | Qt.ShiftModifier),
+               (Qt.Key_F1, Qt.NoModifier))
+
+
+def opens_dialog(key, modifiers):
+    return any(key == dialog_key and int(modifiers) & int(required) == int(required)
+               for dialog_key, required in DIALOG_KEYS)
+
+
+def document_snapshot(store):
+    # Слои, закладки и все элементы с их uid, z и слоями - записи журнала подряд
+    add = encode_add(store.items())
+    return (encode_state(OP_LAYERS, store.layers.state()) + encode_state(OP_BOOKMARKS, store.bookmarks.state()) +
+            (add or b''))
+
+
+def decode_snapshot(data):
+    operations = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        op, size, checksum = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + size]
+        if len(payload) < size or zlib.crc32(payload) != checksum or op not in (OP_ADD,) + STATE_OPERATIONS:
+            raise ValueError("Снимок документа в записи поврежден")
+        operations.append(decode_operation(op, payload))
+        offset += RECORD_HEADER.size + size
+    return operations
+
+
+def read_recording(filename):
+    # Возвращает (заголовок, операции снимка документа, [(время, вид, кнопка, кнопки, модификаторы, x, y, значение)])
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < RECORDING_HEADER.size:
+        raise ValueError("Файл не является записью ввода EndlessSketch")
+    magic, version, header_size, snapshot_size = RECORDING_HEADER.unpack_from(data)
+    if magic != RECORDING_MAGIC:
+        raise ValueError("Файл не является записью ввода EndlessSketch")
+    if version > RECORDING_VERSION:
+        raise ValueError(f"Неподдерживаемая версия записи ввода: {version}")
+    offset = RECORDING_HEADER.size
+    header = json.loads(data[offset:offset + header_size].decode('utf-8'))
+    offset += header_size
+    operations = decode_snapshot(zlib.decompress(data[offset:offset + snapshot_size]))
+    offset += snapshot_size
+    # Поток мог оборваться при сбое - берем все, что удается распаковать, и только целые события
+    stream = zlib.decompressobj().decompress(data[offset:])
+    stream = stream[:len(stream) - len(stream) % EVENT.size]
+    return header, operations, list(EVENT.iter_unpack(stream))
+
+
+def document_digest(store):
+    # Отпечаток содержимого документа без uid: одинаковый у воспроизведений с одинаковым результатом
+    digest = hashlib.sha1()
+    for item in store.items():
+        record = item_to_record(item)
+        if record is None:
+            continue
+        digest.update(repr((record.kind, record.rgba, record.width, item.zValue(), item.data(ITEM_LAYER),
+                            record.source)).encode('utf-8'))
+        digest.update(record.coords.astype('<f8').tobytes())
+    return digest.hexdigest()
+
+
+# Пишет события, поступающие в CanvasView, и их результаты, которые нельзя воспроизвести
+# повторной подачей событий (выбор в диалогах и меню). Обработчики вида и окна зовут методы
+# записи, пока view.input_recorder не None
+class InputRecorder:
+    def __init__(self, filename, window):
+        view = window.view
+        store = view.chunk_store
+        settings = window.settings
+        origin = store.layers.origin
+        header = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'viewport': [view.viewport().width(), view.viewport().height()],
+            # Сдвиг вида задают полосы прокрутки; центр вида в документе не передал бы его точно до пикселя
+            'zoom_factor': view.zoom_factor,
+            'scroll': [view.horizontalScrollBar().value(), view.verticalScrollBar().value()],
+            'origin': [origin.x(), origin.y()],
+            'current_layer': store.layers.current,
+            'counters': store.counters(),
+            'tool': self.toolIndex(view.current_tool),
+            'color': settings.current_color.rgba(),
+            'settings': {name: getattr(settings, name) for name in RECORDED_SETTINGS},
+        }
+        header_data = json.dumps(header).encode('utf-8')
+        snapshot = zlib.compress(document_snapshot(store), COMPRESSION_LEVEL)
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, len(header_data), len(snapshot)))
+        self.file.write(header_data)
+        self.file.write(snapshot)
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self.started = time.perf_counter()
+        self.events = 0
+        self.error = None
+        log.debug("InputRecorder: Recording to %s", filename)
+
+    def toolIndex(self, tool):
+        return TOOLS.index(type(tool)) if type(tool) in TOOLS else 0
+
+    def write(self, kind, button=0, buttons=0, modifiers=0, x=0.0, y=0.0, value=0):
+        if self.file is None:
+            return
+        elapsed = int((time.perf_counter() - self.started) * 1000)
+        try:
+            self.file.write(self.compressor.compress(
+                EVENT.pack(elapsed, kind, button & 0xFF, buttons & 0xFF, modifiers, x, y, value)))
+            self.events += 1
+        except OSError as e:
+            # Обработчики ввода не должны падать из-за записи: запись просто прекращается
+            logging.exception("Exception in InputRecorder write:")
+            self.error = e
+            self.file.close()
+            self.file = None
+
+    def mouse(self, kind, event):
+        if kind == EVENT_PRESS and event.button() == Qt.RightButton:
+            # Контекстное меню модально; выбранные в нем инструмент и размер кисти пишутся отдельно
+            return
+        pos = event.localPos()
+        self.write(kind, int(event.button()), int(event.buttons()), int(event.modifiers()),
+                   pos.x(), pos.y(), event.timestamp())
+
+    def press(self, event):
+        self.mouse(EVENT_PRESS, event)
+
+    def move(self, event):
+        self.mouse(EVENT_MOVE, event)
+
+    def release(self, event):
+        self.mouse(EVENT_RELEASE, event)
+
+    def wheel(self, event):
+        pos = event.position()
+        self.write(EVENT_WHEEL, 0, int(event.buttons()), int(event.modifiers()),
+                   pos.x(), pos.y(), event.angleDelta().y())
+
+    def key(self, event):
+        if not opens_dialog(event.key(), event.modifiers()):
+            self.write(EVENT_KEY, modifiers=int(event.modifiers()), value=event.key())
+
+    def tool(self, tool):
+        self.write(EVENT_TOOL, value=self.toolIndex(tool))
+
+    def brush(self, size):
+        self.write(EVENT_BRUSH, value=size)
+
+    def color(self, color):
+        self.write(EVENT_COLOR, value=color.rgba())
+
+    def flush(self):
+        self.write(EVENT_FLUSH)
+
+    def frame(self):
+        self.write(EVENT_FRAME)
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.write(self.compressor.flush())
+            finally:
+                self.file.close()
+                self.file = None
+        log.debug("InputRecorder: Recorded %s events to %s", self.events, self.filename)
+        return self.events
+
+
+# Проигрывает запись через те же обработчики CanvasView и окна. Цикл событий между событиями
+# записи не запускается: движения передаются инструменту в отмеченных кадрах ввода, а холст
+# перерисовывается синхронно в отмеченных кадрах, поэтому таймеры, фоновые задачи и скорость
+# машины не меняют последовательность работы, и времена кадров двух версий можно сравнивать по номерам
+class InputReplayer:
+    def __init__(self, window, filename):
+        self.window = window
+        self.filename = filename
+        self.header, self.operations, self.events = read_recording(filename)
+
+    def viewportDelta(self):
+        # Насколько нужно изменить размер окна, чтобы вид совпал с записанным
+        viewport = self.window.view.viewport()
+        width, height = self.header['viewport']
+        return width - viewport.width(), height - viewport.height()
+
+    def prepare(self):
+        # Документ, вид, настройки и инструмент - как в начале записи.
+        # Размер вида подгоняется до prepare() через viewportDelta(), окну для этого нужен цикл событий
+        window = self.window
+        view = window.view
+        store = view.chunk_store
+        window.canvas_loader.cancel()
+        store.clear()
+        window.history.clear()
+        window.document.reset()
+        window.journal.rebase(None)
+        apply_operations(store, self.operations)
+        last_z, last_uid = self.header['counters']
+        store.reserve_z(last_z)
+        store.reserve_uid(last_uid)
+        store.layers.set_current(self.header['current_layer'])
+
+        settings = window.settings
+        for name, value in self.header['settings'].items():
+            setattr(settings, name, value)
+        settings.current_color = QColor.fromRgba(self.header['color'])
+        window.brush_slider.setValue(settings.brush_size_percentage)
+        view.input_timer.stop()
+        view.pending_samples = []
+        view.setTool(TOOLS[self.header['tool']](settings))
+
+        zoom = self.header['zoom_factor']
+        view.zoom_factor = zoom
+        view.setTransform(QTransform.fromScale(zoom, zoom))
+        store.layers.set_origin(QPointF(*self.header['origin']))
+        view.resetCachedContent()
+        view.horizontalScrollBar().setValue(self.header['scroll'][0])
+        view.verticalScrollBar().setValue(self.header['scroll'][1])
+        view.updateVisibleChunks()
+        view.updateBrushSize()
+        log.debug("InputReplayer: Prepared %s with %s items", self.filename, len(store))
+
+    def dispatch(self, kind, button, buttons, modifiers, x, y, value):
+        window = self.window
+        view = window.view
+        if kind in MOUSE_EVENTS:
+            event_type, handler = MOUSE_EVENTS[kind]
+            event = QMouseEvent(event_type, QPointF(x, y), Qt.MouseButton(button), Qt.MouseButtons(buttons),
+                                Qt.KeyboardModifiers(modifiers))
+            event.setTimestamp(value)
+            getattr(view, handler)(event)
+        elif kind == EVENT_FLUSH:
+            view.flushInput()
+        elif kind == EVENT_WHEEL:
+            pos = QPointF(x, y)
+            view.wheelEvent(QWheelEvent(pos, pos, QPoint(0, 0), QPoint(0, value), Qt.MouseButtons(buttons),
+                                        Qt.KeyboardModifiers(modifiers), Qt.NoScrollPhase, False))
+        elif kind == EVENT_KEY:
+            window.keyPressEvent(QKeyEvent(QEvent.KeyPress, value, Qt.KeyboardModifiers(modifiers)))
+        elif kind == EVENT_TOOL:
+            view.setTool(TOOLS[value](window.settings))
+        elif kind == EVENT_BRUSH:
+            window.brush_slider.setValue(value)
+        elif kind == EVENT_COLOR:
+            window.settings.current_color = QColor.fromRgba(value & 0xFFFFFFFF)
+            window.showColorPreview(window.settings.current_color)
+
+    def run(self, fast=True):
+        # Проигрывает события как можно быстрее (fast) или в записанном темпе и возвращает времена:
+        # для каждого кадра - работа над вводом с предыдущего кадра и перерисовка, плюс метрики обработчиков
+        view = self.window.view
+        history = self.window.history
+        enabled = metrics.enabled
+        clock = history.clock
+        metrics.setEnabled(True)
+        metrics.reset()
+        # Объединение действий в истории зависит от времени между ними - берем записанное
+        now = [0.0]
+        history.clock = lambda: now[0]
+        input_seconds = []
+        paint_seconds = []
+        pending = 0.0
+        started = time.perf_counter()
+        try:
+            for event in self.events:
+                now[0] = event[0] / 1000
+                if not fast:
+                    delay = started + event[0] / 1000 - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                tick = time.perf_counter()
+                if event[1] == EVENT_FRAME:
+                    view.viewport().repaint()
+                    paint_seconds.append(time.perf_counter() - tick)
+                    input_seconds.append(pending)
+                    pending = 0.0
+                else:
+                    self.dispatch(*event[1:])
+                    pending += time.perf_counter() - tick
+            wall_time = time.perf_counter() - started
+            snapshot = metrics.snapshot()
+        finally:
+            history.clock = clock
+            metrics.setEnabled(enabled)
+        histograms = snapshot['histograms']
+        frame_seconds = sorted(map(sum, zip(input_seconds, paint_seconds)))
+        return {
+            'recording': self.filename,
+            'mode': 'fast' if fast else 'realtime',
+            'events': len(self.events),
+            'recorded_seconds': self.events[-1][0] / 1000 if self.events else 0.0,
+            'wall_seconds': wall_time,
+            'viewport': [view.viewport().width(), view.viewport().height()],
+            'recorded_viewport': self.header['viewport'],
+            'frames': len(paint_seconds),
+            'frame_p50': frame_seconds[len(frame_seconds) // 2] if frame_seconds else 0.0,
+            'frame_p95': frame_seconds[int(len(frame_seconds) * 0.95)] if frame_seconds else 0.0,
+            'frame_input_seconds': input_seconds,
+            'frame_paint_seconds': paint_seconds,
+            'latency': {key[len('event.'):]: value for key, value in histograms.items() if key.startswith('event.')},
+            'paint': histograms.get('paint'),
+            'input_flush': histograms.get('input.flush'),
+            'counters': snapshot['counters'],
+            'items_after': len(view.chunk_store),
+            'document_digest': document_digest(view.chunk_store),
+        }
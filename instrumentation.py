@@ -0,0 +1,124 @@
+# instrumentation.py
+
+import os
+import json
+import math
+import time
+import logging
+
+# Логгер приложения для отладочных сообщений. По умолчанию уровень ERROR (см. main.py),
+# поэтому log.debug(...) с аргументами в стиле % не форматирует строку и почти ничего не стоит
+log = logging.getLogger('endless_sketch')
+
+HISTOGRAM_BUCKETS = 48  # Логарифмические корзины от 1 мкс до ~10 с
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_GROWTH = 1.4
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'last', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+        self.last = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        if value <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(HISTOGRAM_BUCKETS - 1,
+                        int(math.log(value / HISTOGRAM_MIN, HISTOGRAM_GROWTH)) + 1)
+        self.buckets[index] += 1
+
+    def percentile(self, fraction):
+        # Верхняя граница корзины, в которую попадает заданная доля значений
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min(self.maximum, HISTOGRAM_MIN * HISTOGRAM_GROWTH ** index)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.minimum if self.count else 0.0,
+            'max': self.maximum,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+
+# Счетчики и гистограммы времени. Места вызова проверяют metrics.enabled,
+# поэтому в выключенном состоянии стоимость — одна проверка атрибута
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.overlay = False
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.perf_counter()
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        log.info("Metrics %s", "enabled" if enabled else "disabled")
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def histogram(self, name):
+        return self.histograms.get(name)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+        self.started = time.perf_counter()
+
+    def snapshot(self):
+        return {
+            'uptime': time.perf_counter() - self.started,
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=4)
+        log.info("Metrics dumped to %s", filename)
+
+
+def set_log_level(level):
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    log.setLevel(level)
+
+
+metrics = Metrics()
+
+# Включение из окружения: ENDLESS_SKETCH_METRICS=1, ENDLESS_SKETCH_LOG_LEVEL=DEBUG
+if os.environ.get('ENDLESS_SKETCH_METRICS') == '1':
+    metrics.enabled = True
+if os.environ.get('ENDLESS_SKETCH_LOG_LEVEL'):
+    set_log_level(os.environ['ENDLESS_SKETCH_LOG_LEVEL'])
@@ -0,0 +1,575 @@
+# journal.py
+
+import os
+import json
+import time
+import zlib
+import struct
+import shutil
+import logging
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, QTimer, QLockFile, QStandardPaths, pyqtSignal
+from chunks import ITEM_UID, ITEM_LAYER
+from ess_format import item_to_record, pack_records, unpack_records, record_to_item, read_ess, read_layers, \
+    read_bookmarks, record_uid, record_z, record_layer
+from instrumentation import log, metrics
+
+JOURNAL_MAGIC = b'ESSJ'
+JOURNAL_VERSION = 3  # Версия 2 добавила слои элементов и записи OP_LAYERS, версия 3 - записи OP_BOOKMARKS
+JOURNAL_HEADER = struct.Struct('<4sHII')  # magic, version, длина пути к основе, длина таблицы uid/z/слоев
+RECORD_HEADER = struct.Struct('<BII')  # операция, длина данных, crc32 данных
+COUNT = struct.Struct('<I')
+
+OP_ADD = 1  # Добавленные или измененные элементы: uid, z, слои и записи
+OP_REMOVE = 2  # Удаленные элементы: uid
+OP_LAYERS = 3  # Новое состояние слоев (JSON)
+OP_BOOKMARKS = 4  # Новый список закладок (JSON)
+STATE_OPERATIONS = (OP_LAYERS, OP_BOOKMARKS)  # Операции, хранящие состояние документа целиком в JSON
+
+FSYNC_INTERVAL = 1000  # Записи сбрасываются на диск пачкой не чаще раза в столько мс
+CHECKPOINT_IDLE = 5000  # Сколько мс без изменений ждать перед контрольной точкой
+CHECKPOINT_OPERATIONS = 200  # Контрольная точка делается после стольких записей в журнале...
+CHECKPOINT_BYTES = 8 * 1024 * 1024  # ...или после стольких байт
+GATHER_BUDGET = 0.008  # Время (с) на сбор записей для контрольной точки за один шаг таймера
+
+AUTOSAVE_DIR_ENV = 'ENDLESS_SKETCH_AUTOSAVE_DIR'
+LOCK_NAME = 'session.lock'
+
+
+def autosave_directory():
+    directory = os.environ.get(AUTOSAVE_DIR_ENV)
+    if not directory:
+        location = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+        directory = os.path.join(location, 'autosave')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def journal_path(session_dir, seq):
+    return os.path.join(session_dir, f'journal-{seq:06d}.esj')
+
+
+def snapshot_path(session_dir, seq):
+    return os.path.join(session_dir, f'snapshot-{seq:06d}.ess')
+
+
+def session_files(session_dir):
+    # Номера журналов сессии по возрастанию
+    result = []
+    for name in os.listdir(session_dir):
+        if name.startswith('journal-') and name.endswith('.esj'):
+            result.append(int(name[len('journal-'):-len('.esj')]))
+    return sorted(result)
+
+
+def encode_header(base, table):
+    # base - путь к файлу, с которого начинается журнал (пустая строка - пустой холст);
+    # table - (uid, z, слой) элементов основы в порядке файла, None - значения по умолчанию
+    path = (base or '').encode('utf-8')
+    table_data = b''
+    if table is not None:
+        uids, zs, layers = table
+        table_data = zlib.compress(np.asarray(uids, dtype='<i8').tobytes() +
+                                   np.asarray(zs, dtype='<f8').tobytes() +
+                                   np.asarray(layers, dtype='<i8').tobytes())
+    return JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, len(path), len(table_data)) + path + table_data
+
+
+def frame(op, payload):
+    return RECORD_HEADER.pack(op, len(payload), zlib.crc32(payload)) + payload
+
+
+def encode_add(items):
+    uids = []
+    zs = []
+    layers = []
+    records = []
+    for item in items:
+        record = item_to_record(item)
+        if record is not None:
+            uids.append(item.data(ITEM_UID))
+            zs.append(item.zValue())
+            layers.append(item.data(ITEM_LAYER))
+            records.append(record)
+    if not records:
+        return None
+    return frame(OP_ADD, COUNT.pack(len(records)) + np.asarray(uids, dtype='<i8').tobytes() +
+                 np.asarray(zs, dtype='<f8').tobytes() + np.asarray(layers, dtype='<i8').tobytes() +
+                 pack_records(records))
+
+
+def encode_remove(uids):
+    if not uids:
+        return None
+    return frame(OP_REMOVE, COUNT.pack(len(uids)) + np.asarray(uids, dtype='<i8').tobytes())
+
+
+def encode_state(op, state):
+    return frame(op, json.dumps(state).encode('utf-8'))
+
+
+def decode_operation(op, payload, version=JOURNAL_VERSION):
+    # (операция, uid, z, слои, записи или состояние слоев и закладок); слоев нет в журналах версии 1
+    if op in STATE_OPERATIONS:
+        return op, None, None, None, json.loads(bytes(payload).decode('utf-8'))
+    (count,) = COUNT.unpack_from(payload)
+    offset = COUNT.size
+    uids = np.frombuffer(payload, dtype='<i8', count=count, offset=offset)
+    offset += count * 8
+    if op == OP_REMOVE:
+        return op, uids, None, None, None
+    zs = np.frombuffer(payload, dtype='<f8', count=count, offset=offset)
+    offset += count * 8
+    layers = None
+    if version >= 2:
+        layers = np.frombuffer(payload, dtype='<i8', count=count, offset=offset)
+        offset += count * 8
+    return op, uids, zs, layers, unpack_records(payload[offset:])
+
+
+def read_journal(filename):
+    # Возвращает (основа, таблица, операции, конец последней целой записи).
+    # Оборванная при сбое запись в конце файла отбрасывается
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, path_size, table_size = JOURNAL_HEADER.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError("Файл не является журналом EndlessSketch")
+    if version > JOURNAL_VERSION:
+        raise ValueError(f"Неподдерживаемая версия журнала: {version}")
+    offset = JOURNAL_HEADER.size
+    base = data[offset:offset + path_size].decode('utf-8')
+    offset += path_size
+    table = None
+    if table_size:
+        raw = zlib.decompress(data[offset:offset + table_size])
+        if version >= 2:
+            count = len(raw) // 24
+            layers = np.frombuffer(raw, dtype='<i8', count=count, offset=count * 16)
+        else:
+            count = len(raw) // 16
+            layers = None
+        table = (np.frombuffer(raw, dtype='<i8', count=count),
+                 np.frombuffer(raw, dtype='<f8', count=count, offset=count * 8), layers)
+    offset += table_size
+
+    operations = []
+    while offset + RECORD_HEADER.size <= len(data):
+        op, size, checksum = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + size]
+        if len(payload) < size or zlib.crc32(payload) != checksum or op not in (OP_ADD, OP_REMOVE) + STATE_OPERATIONS:
+            log.warning("Journal: Discarding damaged tail of %s at %s", filename, offset)
+            break
+        operations.append(decode_operation(op, payload, version))
+        offset += RECORD_HEADER.size + size
+    return base, table, operations, offset
+
+
+def load_base(store, base, table):
+    # Синхронная загрузка основы журнала с теми же uid, z и слоями, что были в сессии
+    if not base:
+        return
+    layers = read_layers(base)
+    if layers is not None:
+        store.layers.set_state(layers)
+    bookmarks = read_bookmarks(base)
+    if bookmarks is not None:
+        store.bookmarks.set_state(bookmarks)
+    for index, record in enumerate(read_ess(base)):
+        item = record_to_item(record)
+        if item is None:
+            continue
+        if table is not None:
+            uid, z = int(table[0][index]), float(table[1][index])
+        else:
+            uid, z = record_uid(record, index), record_z(record, index)
+        if table is not None and table[2] is not None:
+            layer = int(table[2][index])
+        else:
+            layer = record_layer(record)
+        item.setData(ITEM_UID, uid)
+        store.add_item(item, z, layer)
+
+
+def apply_operations(store, operations):
+    for op, uids, zs, layers, data in operations:
+        if op == OP_LAYERS:
+            store.layers.set_state(data)
+            continue
+        if op == OP_BOOKMARKS:
+            store.bookmarks.set_state(data)
+            continue
+        for index, uid in enumerate(uids):
+            existing = store.item_by_uid(int(uid))
+            if existing is not None:
+                store.remove_item(existing)
+            if op == OP_ADD:
+                item = record_to_item(data[index])
+                if item is not None:
+                    item.setData(ITEM_UID, int(uid))
+                    layer = int(layers[index]) if layers is not None else record_layer(data[index])
+                    store.add_item(item, float(zs[index]), layer)
+
+
+def restore_session(store, session_dir):
+    # Восстанавливает холст из журналов сессии. Начинаем с самого нового журнала,
+    # чья основа существует, и применяем его и все последующие журналы.
+    # Возвращает (номер последнего журнала, размер его целой части)
+    journals = {}
+    for seq in session_files(session_dir):
+        try:
+            journals[seq] = read_journal(journal_path(session_dir, seq))
+        except (ValueError, struct.error, zlib.error) as e:
+            # Журнал, созданный прямо перед сбоем, может не иметь даже заголовка
+            log.warning("Journal: Skipping unreadable journal %s: %s", seq, e)
+    if not journals:
+        return None, 0
+    sequence = sorted(journals)
+    start = sequence[0]
+    for seq in reversed(sequence):
+        base = journals[seq][0]
+        if not base or os.path.exists(base):
+            start = seq
+            break
+    base, table, _, _ = journals[start]
+    if base and os.path.exists(base):
+        load_base(store, base, table)
+    for seq in sequence:
+        if seq >= start:
+            apply_operations(store, journals[seq][2])
+    last = sequence[-1]
+    return last, journals[last][3]
+
+
+def orphan_sessions(directory):
+    # Сессии, чьи процессы завершились, не закрыв журнал (сбой), — новые первыми
+    result = []
+    for name in os.listdir(directory):
+        session_dir = os.path.join(directory, name)
+        if not os.path.isdir(session_dir):
+            continue
+        lock = QLockFile(os.path.join(session_dir, LOCK_NAME))
+        lock.setStaleLockTime(0)  # Брошенной считается только блокировка завершившегося процесса
+        if not lock.tryLock(0):
+            continue
+        lock.unlock()
+        if session_files(session_dir):
+            result.append(session_dir)
+        else:
+            shutil.rmtree(session_dir, ignore_errors=True)
+    result.sort(key=os.path.getmtime, reverse=True)
+    return result
+
+
+def discard_session(session_dir):
+    shutil.rmtree(session_dir, ignore_errors=True)
+
+
+# Запись журнала в отдельном потоке: append только копирует данные в буфер файла,
+# fsync выполняется пачкой по таймеру, поэтому рисование не ждет диска
+class JournalWriter(QObject):
+    failed = pyqtSignal(str)
+    snapshotWritten = pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.file = None
+        self.sync_timer = None
+
+    def setup(self):
+        # Таймер создается уже в потоке записи
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(FSYNC_INTERVAL)
+        self.sync_timer.timeout.connect(self.sync)
+
+    def createJournal(self, filename, header):
+        try:
+            self._closeFile()
+            self.file = open(filename, 'wb')
+            self.file.write(header)
+            self.sync()
+        except Exception as e:
+            logging.exception("Exception in JournalWriter createJournal:")
+            self.failed.emit(str(e))
+
+    def resumeJournal(self, filename, size):
+        try:
+            self._closeFile()
+            self.file = open(filename, 'r+b')
+            self.file.truncate(size)
+            self.file.seek(size)
+        except Exception as e:
+            logging.exception("Exception in JournalWriter resumeJournal:")
+            self.failed.emit(str(e))
+
+    def append(self, data):
+        if self.file is None:
+            return
+        try:
+            self.file.write(data)
+            if not self.sync_timer.isActive():
+                self.sync_timer.start()
+        except Exception as e:
+            logging.exception("Exception in JournalWriter append:")
+            self.failed.emit(str(e))
+
+    def sync(self):
+        if self.file is None:
+            return
+        started = time.perf_counter()
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except Exception as e:
+            logging.exception("Exception in JournalWriter sync:")
+            self.failed.emit(str(e))
+        if metrics.enabled:
+            metrics.observe('journal.fsync', time.perf_counter() - started)
+
+    def writeSnapshot(self, filename, records):
+        # Снимок пишется во временный файл и подменяет старый только целиком
+        try:
+            temporary = filename + '.tmp'
+            with open(temporary, 'wb') as f:
+                f.write(pack_records(records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, filename)
+            self.snapshotWritten.emit(filename)
+        except Exception as e:
+            logging.exception("Exception in JournalWriter writeSnapshot:")
+            self.failed.emit(str(e))
+
+    def removeFiles(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.exception("Exception in JournalWriter removeFiles:")
+
+    def finish(self):
+        try:
+            self._closeFile()
+        except Exception as e:
+            logging.exception("Exception in JournalWriter finish:")
+        QThread.currentThread().quit()
+
+    def _closeFile(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        if self.sync_timer is not None:
+            self.sync_timer.stop()
+
+
+# Журнал операций для восстановления после сбоя. Каждое действие истории (штрих, заливка,
+# стирание, отмена, повтор) дописывается в конец журнала компактной записью. Журнал начинается
+# с основы — открытого или сохраненного файла либо снимка контрольной точки, которая
+# в простое собирает весь холст в снимок и начинает новый журнал
+class Journal(QObject):
+    createRequested = pyqtSignal(str, bytes)
+    resumeRequested = pyqtSignal(str, int)
+    appendRequested = pyqtSignal(bytes)
+    snapshotRequested = pyqtSignal(str, object)
+    removeRequested = pyqtSignal(object)
+    finishRequested = pyqtSignal()
+
+    def __init__(self, store, history, directory=None, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.history = history
+        self.directory = directory or autosave_directory()
+        self.session_dir = None
+        self.lock = None
+        self.seq = 0
+        self.first_seq = 0  # Самый старый журнал сессии, который еще не удален
+        self.operations = 0  # Записей в текущем журнале
+        self.journal_bytes = 0
+        self.gather = None  # (элементы, позиция, записи, uid, z, слои) во время сбора контрольной точки
+
+        self.thread = QThread()
+        self.worker = JournalWriter()
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.setup)
+        self.createRequested.connect(self.worker.createJournal)
+        self.resumeRequested.connect(self.worker.resumeJournal)
+        self.appendRequested.connect(self.worker.append)
+        self.snapshotRequested.connect(self.worker.writeSnapshot)
+        self.removeRequested.connect(self.worker.removeFiles)
+        self.finishRequested.connect(self.worker.finish)
+        self.worker.failed.connect(self.onFailed)
+        self.thread.start()
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(CHECKPOINT_IDLE)
+        self.idle_timer.timeout.connect(self.maybeCheckpoint)
+        self.gather_timer = QTimer(self)
+        self.gather_timer.setInterval(0)
+        self.gather_timer.timeout.connect(self.gatherBatch)
+
+        history.listeners.append(self.onCommand)
+        store.listeners.append(self.onStoreChanged)
+        store.layers.listeners.append(self.onLayersChanged)
+        store.bookmarks.listeners.append(self.onBookmarksChanged)
+
+    def start(self):
+        name = time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}'
+        self._lockSession(os.path.join(self.directory, name))
+        self.seq = self.first_seq = 1
+        self._create(None, None)
+        log.debug("Journal: Started session %s", self.session_dir)
+
+    def adopt(self, session_dir):
+        # Восстанавливает холст из брошенной сессии и продолжает ее журнал вместо start()
+        self._lockSession(session_dir)
+        last, size = restore_session(self.store, session_dir)
+        if last is None:
+            self._unlockSession(remove=True)
+            self.start()
+            return
+        self.first_seq = session_files(session_dir)[0]
+        self.seq = last
+        self.operations = 0
+        self.journal_bytes = size
+        self.resumeRequested.emit(journal_path(session_dir, last), size)
+        log.debug("Journal: Adopted session %s", session_dir)
+
+    def rebase(self, base, table=None):
+        # Документ теперь совпадает с файлом base: начинаем новый журнал от него
+        if self.session_dir is None:
+            return
+        self._cancelGather()
+        self.seq += 1
+        self._create(os.path.abspath(base) if base else None, table)
+
+    def onCommand(self, command, undone):
+        if self.session_dir is None:
+            return
+        started = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            removed, added = command.changes(undone)
+            items = [item for item in map(self.store.item_by_uid, added) if item is not None]
+            # Измененные элементы переписываются целиком: при воспроизведении старая версия удаляется
+            added = set(added)
+            for data in (encode_remove([uid for uid in removed if uid not in added]), encode_add(items)):
+                if data is not None:
+                    self._append(data)
+        except Exception as e:
+            logging.exception("Exception in Journal onCommand:")
+        self.idle_timer.start()
+        if started:
+            metrics.observe('journal.append', time.perf_counter() - started)
+
+    def onStoreChanged(self, rect, layer):
+        # Холст изменился во время сбора контрольной точки — снимок был бы несогласованным
+        if self.gather is not None:
+            self._cancelGather()
+            self.idle_timer.start()
+
+    def onLayersChanged(self):
+        # Слои не входят в снимок контрольной точки, поэтому сбор не прерывается
+        if self.session_dir is None:
+            return
+        self._append(encode_state(OP_LAYERS, self.store.layers.state()))
+        self.idle_timer.start()
+
+    def onBookmarksChanged(self):
+        if self.session_dir is None:
+            return
+        self._append(encode_state(OP_BOOKMARKS, self.store.bookmarks.state()))
+        self.idle_timer.start()
+
+    def maybeCheckpoint(self):
+        if self.gather is not None or self.session_dir is None:
+            return
+        if self.operations < CHECKPOINT_OPERATIONS and self.journal_bytes < CHECKPOINT_BYTES:
+            return
+        log.debug("Journal: Gathering checkpoint after %s operations", self.operations)
+        self.gather = (self.store.items(), 0, [], [], [], [])
+        self.gather_timer.start()
+
+    def gatherBatch(self):
+        try:
+            items, position, records, uids, zs, layers = self.gather
+            deadline = time.perf_counter() + GATHER_BUDGET
+            while position < len(items) and time.perf_counter() < deadline:
+                item = items[position]
+                position += 1
+                record = item_to_record(item)
+                if record is not None:
+                    records.append(record)
+                    uids.append(item.data(ITEM_UID))
+                    zs.append(item.zValue())
+                    layers.append(item.data(ITEM_LAYER))
+            if position < len(items):
+                self.gather = (items, position, records, uids, zs, layers)
+                return
+            self._cancelGather()
+            self.seq += 1
+            filename = snapshot_path(self.session_dir, self.seq)
+            # Снимок, затем новый журнал от него, затем удаление старого: поток записи
+            # выполняет запросы по порядку, так что при сбое всегда остается целая цепочка
+            self.snapshotRequested.emit(filename, records)
+            self._create(filename, (uids, zs, layers))
+            log.debug("Journal: Checkpoint %s with %s items", filename, len(records))
+        except Exception as e:
+            logging.exception("Exception in Journal gatherBatch:")
+            self._cancelGather()
+
+    def close(self, discard=True):
+        self._cancelGather()
+        self.idle_timer.stop()
+        if self.thread.isRunning():
+            self.finishRequested.emit()
+            self.thread.wait()
+        # discard - сеанс завершен штатно, журнал больше не нужен
+        self._unlockSession(remove=discard)
+
+    def onFailed(self, message):
+        log.warning("Journal: Write failed, autosave disabled: %s", message)
+        self.session_dir = None
+
+    def _append(self, data):
+        self.appendRequested.emit(data)
+        self.operations += 1
+        self.journal_bytes += len(data)
+
+    def _create(self, base, table):
+        self.createRequested.emit(journal_path(self.session_dir, self.seq), encode_header(base, table))
+        obsolete = []
+        for seq in range(self.first_seq, self.seq):
+            obsolete.append(journal_path(self.session_dir, seq))
+            obsolete.append(snapshot_path(self.session_dir, seq))
+        if obsolete:
+            self.removeRequested.emit(obsolete)
+        self.first_seq = self.seq
+        self.operations = 0
+        self.journal_bytes = 0
+        # Основа (снимок или файл без слоев) может не хранить слои и закладки: новый журнал начинается с них
+        self._append(encode_state(OP_LAYERS, self.store.layers.state()))
+        self._append(encode_state(OP_BOOKMARKS, self.store.bookmarks.state()))
+
+    def _cancelGather(self):
+        self.gather = None
+        self.gather_timer.stop()
+
+    def _lockSession(self, session_dir):
+        os.makedirs(session_dir, exist_ok=True)
+        self.lock = QLockFile(os.path.join(session_dir, LOCK_NAME))
+        self.lock.setStaleLockTime(0)
+        if not self.lock.tryLock(0):
+            raise RuntimeError(f"Сессия автосохранения уже используется: {session_dir}")
+        self.session_dir = session_dir
+
+    def _unlockSession(self, remove):
+        if self.lock is not None:
+            self.lock.unlock()
+            self.lock = None
+        if remove and self.session_dir is not None:
+            shutil.rmtree(self.session_dir, ignore_errors=True)
+        self.session_dir = None
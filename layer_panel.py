@@ -0,0 +1,159 @@
+# layer_panel.py
+
+import logging
+from PyQt5.QtWidgets import (
+    QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QListWidgetItem,
+    QPushButton, QSlider, QLabel, QCheckBox, QMessageBox
+)
+from PyQt5.QtCore import Qt
+from history import LayerCommand
+
+
+# Панель слоев: список сверху вниз (верхний слой первым), флажок - видимость,
+# выделение - текущий слой, в который рисуют инструменты. Каждое изменение
+# записывается в историю как LayerCommand
+class LayerPanel(QDockWidget):
+    def __init__(self, store, history, parent=None):
+        super().__init__("Слои", parent)
+        self.store = store
+        self.history = history
+        self.updating = False  # Список перестраивается из LayerStack - сигналы виджетов не обрабатываются
+
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+
+        self.layer_list = QListWidget()
+        self.layer_list.currentItemChanged.connect(self.onCurrentChanged)
+        self.layer_list.itemChanged.connect(self.onItemChanged)
+        layout.addWidget(self.layer_list)
+
+        opacity_layout = QHBoxLayout()
+        opacity_layout.addWidget(QLabel("Непрозрачность:"))
+        self.opacity_slider = QSlider(Qt.Horizontal)
+        self.opacity_slider.setRange(0, 100)
+        self.opacity_slider.valueChanged.connect(self.changeOpacity)
+        opacity_layout.addWidget(self.opacity_slider)
+        layout.addLayout(opacity_layout)
+
+        self.lock_check = QCheckBox("Заблокирован")
+        self.lock_check.toggled.connect(self.changeLocked)
+        layout.addWidget(self.lock_check)
+
+        buttons_layout = QHBoxLayout()
+        for text, tip, slot in (("+", "Новый слой", self.addLayer),
+                                ("−", "Удалить слой", self.removeLayer),
+                                ("▲", "Поднять слой", self.raiseLayer),
+                                ("▼", "Опустить слой", self.lowerLayer)):
+            button = QPushButton(text)
+            button.setToolTip(tip)
+            button.clicked.connect(slot)
+            buttons_layout.addWidget(button)
+        layout.addLayout(buttons_layout)
+
+        self.setWidget(widget)
+        self.store.layers.listeners.append(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        layers = self.store.layers
+        self.updating = True
+        try:
+            # Строки пересоздаются только при смене набора или порядка слоев: refresh может
+            # вызываться из сигнала самой строки, удалять ее в этот момент нельзя
+            ordered = list(reversed(list(layers)))
+            rows = [self.layer_list.item(row).data(Qt.UserRole) for row in range(self.layer_list.count())]
+            if rows != [layer.id for layer in ordered]:
+                self.layer_list.clear()
+                for layer in ordered:
+                    item = QListWidgetItem(layer.name)
+                    item.setData(Qt.UserRole, layer.id)
+                    item.setFlags(item.flags() | Qt.ItemIsEditable | Qt.ItemIsUserCheckable)
+                    self.layer_list.addItem(item)
+            for row, layer in enumerate(ordered):
+                item = self.layer_list.item(row)
+                item.setText(layer.name)
+                item.setCheckState(Qt.Checked if layer.visible else Qt.Unchecked)
+                if layer.id == layers.current:
+                    self.layer_list.setCurrentItem(item)
+            current = layers.layers[layers.current]
+            self.opacity_slider.setValue(int(round(current.opacity * 100)))
+            self.lock_check.setChecked(current.locked)
+        finally:
+            self.updating = False
+
+    def change(self, action, removed=()):
+        # Выполняет изменение LayerStack и записывает его в историю
+        old_state = self.store.layers.state()
+        action()
+        new_state = self.store.layers.state()
+        if new_state != old_state or removed:
+            self.history.push(LayerCommand(old_state, new_state, removed))
+
+    def onCurrentChanged(self, item, previous):
+        if self.updating or item is None:
+            return
+        self.store.layers.set_current(item.data(Qt.UserRole))
+
+    def onItemChanged(self, item):
+        if self.updating:
+            return
+        try:
+            layers = self.store.layers
+            layer = layers.layers[item.data(Qt.UserRole)]
+            visible = item.checkState() == Qt.Checked
+            if visible != layer.visible:
+                self.change(lambda: layers.set_visible(layer.id, visible))
+            elif item.text() and item.text() != layer.name:
+                self.change(lambda: layers.rename(layer.id, item.text()))
+        except Exception as e:
+            logging.exception("Exception in LayerPanel onItemChanged:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при изменении слоя:\n{e}")
+
+    def changeOpacity(self, value):
+        if self.updating:
+            return
+        layers = self.store.layers
+        self.change(lambda: layers.set_opacity(layers.current, value / 100))
+
+    def changeLocked(self, locked):
+        if self.updating:
+            return
+        layers = self.store.layers
+        self.change(lambda: layers.set_locked(layers.current, locked))
+
+    def addLayer(self):
+        try:
+            layers = self.store.layers
+
+            def add():
+                layer = layers.add(position=layers.position(layers.current) + 1)
+                layers.set_current(layer.id)
+            self.change(add)
+        except Exception as e:
+            logging.exception("Exception in LayerPanel addLayer:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при добавлении слоя:\n{e}")
+
+    def removeLayer(self):
+        try:
+            layers = self.store.layers
+            if len(layers) <= 1:
+                return
+            layer_id = layers.current
+            # Элементы слоя уходят из документа вместе с ним и возвращаются при отмене
+            items = self.store.items_in_layer(layer_id)
+            old_state = layers.state()
+            for item in items:
+                self.store.remove_item(item)
+            layers.remove(layer_id)
+            self.history.push(LayerCommand(old_state, layers.state(), items))
+        except Exception as e:
+            logging.exception("Exception in LayerPanel removeLayer:")
+            QMessageBox.critical(self, "Ошибка", f"Произошла ошибка при удалении слоя:\n{e}")
+
+    def raiseLayer(self):
+        layers = self.store.layers
+        self.change(lambda: layers.move(layers.current, layers.position(layers.current) + 1))
+
+    def lowerLayer(self):
+        layers = self.store.layers
+        self.change(lambda: layers.move(layers.current, layers.position(layers.current) - 1))
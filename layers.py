@@ -0,0 +1,219 @@
+# layers.py
+
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsOpacityEffect
+from PyQt5.QtCore import QRectF, QPointF
+
+DEFAULT_LAYER = 0  # id нижнего слоя; элементы файлов без слоев попадают в него
+OVERLAY_Z = 1e12  # Z корня временных элементов инструментов (поверх всех слоев)
+
+
+def document_transform(item):
+    # Преобразование элемента в координаты документа. Элемент в сцене - дочерний элемент корня
+    # слоя, сдвинутого на плавающее начало координат, поэтому sceneTransform() тут не подходит
+    parent = item.parentItem()
+    if parent is None:
+        return item.sceneTransform()
+    return item.itemTransform(parent)[0]
+
+
+# Корень слоя в сцене: элементы слоя - его дочерние элементы. Порядок слоев - z корней,
+# поэтому перестановка слоев и скрытие не трогают сами элементы. Прозрачность слоя
+# накладывается на слой целиком (эффект рисует слой в отдельный буфер), а не на каждый штрих
+class LayerItem(QGraphicsItem):
+    def __init__(self):
+        super().__init__()
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
+
+    def boundingRect(self):
+        return QRectF()
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+
+class Layer:
+    __slots__ = ('id', 'name', 'visible', 'opacity', 'locked', 'root')
+
+    def __init__(self, layer_id, name):
+        self.id = layer_id
+        self.name = name
+        self.visible = True
+        self.opacity = 1.0
+        self.locked = False
+        self.root = LayerItem()
+
+    def state(self):
+        return {'id': self.id, 'name': self.name, 'visible': self.visible,
+                'opacity': self.opacity, 'locked': self.locked}
+
+
+# Слои документа снизу вверх. Изменения сообщаются слушателям listener(), а состояние
+# целиком (список словарей Layer.state()) используется для файла, журнала и отмены.
+# Плавающее начало координат: элементы хранят координаты документа, а корни слоев и
+# корень временных элементов сдвинуты на -origin, так что координаты сцены остаются
+# небольшими на любом удалении от начала документа
+class LayerStack:
+    def __init__(self, scene):
+        self.scene = scene
+        self.layers = {}  # id -> Layer
+        self.order = []  # id снизу вверх
+        self.current = DEFAULT_LAYER
+        self.listeners = []
+        self.origin = QPointF()  # Точка документа, которая находится в начале координат сцены
+        self.overlay = LayerItem()  # Корень временных элементов инструментов
+        self.overlay.setZValue(OVERLAY_Z)
+        scene.addItem(self.overlay)
+        self.reset()
+
+    def reset(self):
+        for layer in self.layers.values():
+            self._detach(layer)
+        self.layers.clear()
+        self.order = []
+        self._add(DEFAULT_LAYER, "Слой 1", 0)
+        self.current = DEFAULT_LAYER
+        self._notify()
+
+    def __iter__(self):
+        return (self.layers[layer_id] for layer_id in self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def layer(self, layer_id):
+        # Элементы могут ссылаться на слой, которого нет (например, в старом журнале) - он создается
+        layer = self.layers.get(layer_id)
+        if layer is None:
+            layer = self._add(layer_id, f"Слой {layer_id + 1}", len(self.order))
+            self._notify()
+        return layer
+
+    def position(self, layer_id):
+        return self.order.index(layer_id)
+
+    def visible_ids(self):
+        return [layer_id for layer_id in self.order if self.layers[layer_id].visible]
+
+    def editable(self, layer_id):
+        layer = self.layers.get(layer_id)
+        return layer is not None and layer.visible and not layer.locked
+
+    def add(self, name=None, position=None):
+        layer_id = max(self.layers, default=-1) + 1
+        position = len(self.order) if position is None else position
+        layer = self._add(layer_id, name or f"Слой {layer_id + 1}", position)
+        self._notify()
+        return layer
+
+    def remove(self, layer_id):
+        # Элементы слоя должны быть убраны из хранилища заранее
+        if len(self.order) <= 1 or layer_id not in self.layers:
+            return False
+        self._detach(self.layers.pop(layer_id))
+        position = self.order.index(layer_id)
+        self.order.remove(layer_id)
+        if self.current == layer_id:
+            self.current = self.order[max(0, position - 1)]
+        self._restack()
+        self._notify()
+        return True
+
+    def move(self, layer_id, position):
+        position = max(0, min(position, len(self.order) - 1))
+        self.order.remove(layer_id)
+        self.order.insert(position, layer_id)
+        self._restack()
+        self._notify()
+
+    def set_visible(self, layer_id, visible):
+        layer = self.layers[layer_id]
+        layer.visible = visible
+        layer.root.setVisible(visible)
+        self._notify()
+
+    def set_opacity(self, layer_id, opacity):
+        layer = self.layers[layer_id]
+        layer.opacity = opacity
+        self._apply_opacity(layer)
+        self._notify()
+
+    def set_locked(self, layer_id, locked):
+        self.layers[layer_id].locked = locked
+        self._notify()
+
+    def rename(self, layer_id, name):
+        self.layers[layer_id].name = name
+        self._notify()
+
+    def set_current(self, layer_id):
+        if layer_id in self.layers:
+            self.current = layer_id
+            self._notify()
+
+    def set_origin(self, origin):
+        # Сдвигает корни, а не элементы: элементы слоя переезжают вместе со своим корнем
+        self.origin = QPointF(origin)
+        for layer in self.layers.values():
+            layer.root.setPos(-self.origin)
+        self.overlay.setPos(-self.origin)
+
+    def state(self):
+        return [self.layers[layer_id].state() for layer_id in self.order]
+
+    def set_state(self, state):
+        # Применяет состояние из файла, журнала или истории. Корни существующих слоев сохраняются,
+        # чтобы их элементы остались на месте
+        ids = [entry['id'] for entry in state]
+        for layer_id in [layer_id for layer_id in self.layers if layer_id not in ids]:
+            self._detach(self.layers.pop(layer_id))
+        self.order = []
+        for entry in state:
+            layer = self.layers.get(entry['id'])
+            if layer is None:
+                layer = self.layers[entry['id']] = Layer(entry['id'], entry['name'])
+                layer.root.setPos(-self.origin)
+                self.scene.addItem(layer.root)
+            layer.name = entry['name']
+            layer.visible = entry.get('visible', True)
+            layer.opacity = entry.get('opacity', 1.0)
+            layer.locked = entry.get('locked', False)
+            layer.root.setVisible(layer.visible)
+            self._apply_opacity(layer)
+            self.order.append(layer.id)
+        if not self.order:
+            self._add(DEFAULT_LAYER, "Слой 1", 0)
+        if self.current not in self.layers:
+            self.current = self.order[-1]
+        self._restack()
+        self._notify()
+
+    def _add(self, layer_id, name, position):
+        layer = self.layers[layer_id] = Layer(layer_id, name)
+        self.order.insert(position, layer_id)
+        layer.root.setPos(-self.origin)
+        self.scene.addItem(layer.root)
+        self._restack()
+        return layer
+
+    def _detach(self, layer):
+        if layer.root.scene() is self.scene:
+            self.scene.removeItem(layer.root)
+
+    def _restack(self):
+        for position, layer_id in enumerate(self.order):
+            self.layers[layer_id].root.setZValue(position)
+
+    def _apply_opacity(self, layer):
+        # Непрозрачному слою эффект не нужен: без него слой рисуется напрямую
+        if layer.opacity >= 1.0:
+            layer.root.setGraphicsEffect(None)
+            return
+        effect = layer.root.graphicsEffect()
+        if effect is None:
+            effect = QGraphicsOpacityEffect()
+            layer.root.setGraphicsEffect(effect)
+        effect.setOpacity(layer.opacity)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener()
@@ -0,0 +1,186 @@
+# loader.py
+
+import time
+import logging
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+from chunks import ITEM_UID
+from ess_format import read_ess, read_layers, read_bookmarks, record_to_item, record_uid, record_z, record_layer
+from instrumentation import log, metrics
+
+BATCH_BUDGET = 0.008  # Время (с) на добавление элементов за один шаг таймера
+
+
+def viewport_first_order(records, focus):
+    # Порядок добавления: сначала элементы, пересекающие видимую область,
+    # затем остальные по удалению от ее центра
+    count = len(records)
+    if not count or focus is None:
+        return np.arange(count)
+    bounds = np.empty((count, 4))
+    for i, record in enumerate(records):
+        coords = record.coords
+        if len(coords):
+            half_width = record.width / 2
+            bounds[i, :2] = coords.min(axis=0) - half_width
+            bounds[i, 2:] = coords.max(axis=0) + half_width
+        else:
+            bounds[i] = np.inf
+    left, top, right, bottom = focus
+    center_x = (left + right) / 2
+    center_y = (top + bottom) / 2
+    # Расстояние от центра видимой области до рамки элемента
+    dx = np.maximum(np.maximum(bounds[:, 0] - center_x, center_x - bounds[:, 2]), 0)
+    dy = np.maximum(np.maximum(bounds[:, 1] - center_y, center_y - bounds[:, 3]), 0)
+    distance = np.hypot(dx, dy)
+    visible = ((bounds[:, 0] <= right) & (bounds[:, 2] >= left) &
+               (bounds[:, 1] <= bottom) & (bounds[:, 3] >= top))
+    return np.lexsort((distance, ~visible))
+
+
+class ParseWorker(QObject):
+    parsed = pyqtSignal(int, object)  # поколение загрузки, (records, order, слои, закладки)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, generation, filename, focus):
+        super().__init__()
+        self.generation = generation
+        self.filename = filename
+        self.focus = focus
+
+    def run(self):
+        try:
+            records = read_ess(self.filename)
+            order = viewport_first_order(records, self.focus)
+            self.parsed.emit(self.generation, (records, order, read_layers(self.filename),
+                                               read_bookmarks(self.filename)))
+        except Exception as e:
+            logging.exception("Exception in ParseWorker run:")
+            self.failed.emit(self.generation, str(e))
+
+
+# Загрузка холста без блокировки интерфейса: файл разбирается в отдельном потоке,
+# а элементы добавляются в сцену порциями по таймеру, начиная с видимых
+class CanvasLoader(QObject):
+    progress = pyqtSignal(int, int)  # добавлено, всего
+    finished = pyqtSignal(bool)  # True - загрузка завершена, False - отменена
+    failed = pyqtSignal(str)
+
+    def __init__(self, chunk_store, parent=None):
+        super().__init__(parent)
+        self.chunk_store = chunk_store
+        self.generation = 0
+        self.thread = None
+        self.worker = None
+        self.finished_threads = []  # Потоки отмененных загрузок, которые еще дорабатывают
+        self.records = None
+        self.order = None
+        self.position = 0
+        self.filename = None
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.addBatch)
+
+    def isRunning(self):
+        return self.worker is not None or self.records is not None
+
+    def start(self, filename, focus_rect):
+        self.cancel()
+        self.filename = filename
+        focus = None
+        if focus_rect is not None:
+            focus = (focus_rect.left(), focus_rect.top(), focus_rect.right(), focus_rect.bottom())
+
+        self.generation += 1
+        self.thread = QThread()
+        self.worker = ParseWorker(self.generation, filename, focus)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.parsed.connect(self.thread.quit)
+        self.worker.failed.connect(self.thread.quit)
+        self.worker.parsed.connect(self.onParsed)
+        self.worker.failed.connect(self.onFailed)
+        self.thread.start()
+        log.debug("CanvasLoader: Parsing %s in background", filename)
+
+    def cancel(self):
+        if not self.isRunning():
+            return
+        self.timer.stop()
+        self._stopThread()
+        self.records = None
+        self.order = None
+        log.debug("CanvasLoader: Loading cancelled")
+        self.finished.emit(False)
+
+    def onParsed(self, generation, result):
+        if generation != self.generation or self.worker is None:
+            return  # Результат отмененной загрузки
+        self._stopThread()
+        self.records, self.order, layers, bookmarks = result
+        self.position = 0
+        # Слои создаются до элементов, чтобы элементы сразу попадали в свои слои
+        if layers is not None:
+            self.chunk_store.layers.set_state(layers)
+        # Закладки доступны сразу, не дожидаясь загрузки элементов
+        if bookmarks is not None:
+            self.chunk_store.bookmarks.set_state(bookmarks)
+        # Резервируем порядок наложения и uid, чтобы новые штрихи оказались поверх загружаемых
+        # и не совпали с ними по uid
+        self.chunk_store.reserve_z(max((record_z(record, index) for index, record in enumerate(self.records)),
+                                       default=0))
+        self.chunk_store.reserve_uid(max((record.uid for record in self.records if record.uid is not None),
+                                         default=0))
+        log.debug("CanvasLoader: Parsed %s items", len(self.records))
+        self.progress.emit(0, len(self.records))
+        self.timer.start()
+
+    def onFailed(self, generation, message):
+        if generation != self.generation or self.worker is None:
+            return
+        self._stopThread()
+        self.failed.emit(message)
+
+    def addBatch(self):
+        try:
+            deadline = time.perf_counter() + BATCH_BUDGET
+            total = len(self.records)
+            while self.position < total:
+                index = int(self.order[self.position])
+                self.position += 1
+                record = self.records[index]
+                item = record_to_item(record)
+                if item is not None:
+                    # Z и uid берутся из файла или соответствуют порядку в нем, а не порядку добавления
+                    item.setData(ITEM_UID, record_uid(record, index))
+                    self.chunk_store.add_item(item, record_z(record, index), record_layer(record))
+                if time.perf_counter() >= deadline:
+                    break
+            if metrics.enabled:
+                metrics.observe('load.batch', time.perf_counter() - deadline + BATCH_BUDGET)
+            self.progress.emit(self.position, total)
+            if self.position >= total:
+                self.timer.stop()
+                self.records = None
+                self.order = None
+                log.debug("CanvasLoader: Canvas loaded from %s", self.filename)
+                self.finished.emit(True)
+        except Exception as e:
+            logging.exception("Exception in CanvasLoader addBatch:")
+            self.timer.stop()
+            self.records = None
+            self.order = None
+            self.failed.emit(str(e))
+
+    def _stopThread(self):
+        # Не ждем окончания разбора: поток завершится сам, а его результат будет проигнорирован
+        thread, worker = self.thread, self.worker
+        self.thread = None
+        self.worker = None
+        if thread is None:
+            return
+        if thread.isFinished():
+            return
+        entry = (thread, worker)
+        self.finished_threads.append(entry)
+        thread.finished.connect(lambda: self.finished_threads.remove(entry))
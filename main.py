@@ -15,6 +15,7 @@ def main():
     )
 
     app = QApplication(sys.argv)
+    app.setApplicationName("EndlessSketch")  # Каталог данных приложения для автосохранения
     window = CanvasWindow()
     window.show()
 
@@ -0,0 +1,55 @@
+# png_writer.py
+
+import zlib
+import struct
+
+# Общие для отрисовки без дисплея (render_cli) и экспорта из программы (export) параметры
+# и потоковая запись PNG: результат сжимается полосами и не собирается в памяти целиком
+TILE_PIXELS = 512  # Размер тайла по умолчанию
+BAND_MEMORY = 64 * 1024 * 1024  # Предел памяти (байт) на одну полосу
+MARGIN = 16  # Поля вокруг рисунка при отрисовке всего холста (в единицах холста)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IDAT_SIZE = 1024 * 1024  # Максимальный размер одного чанка IDAT
+COMPRESS_LEVEL = 6
+
+
+class PngWriter:
+    # Потоковая запись RGBA PNG: строки сжимаются по мере поступления
+    def __init__(self, f, width, height):
+        self.f = f
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+        self.pending = []
+        self.pending_size = 0
+        f.write(PNG_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def write_rows(self, rows):
+        # rows: непрерывный массив uint8 (высота, ширина * 4); каждой строке предшествует байт фильтра 0.
+        # Строки сжимаются по одной, без копии всей полосы
+        for row in rows:
+            self._feed(self.compressor.compress(b'\x00'))
+            self._feed(self.compressor.compress(row))
+
+    def finish(self):
+        self._feed(self.compressor.flush())
+        self._flush()
+        self._chunk(b'IEND', b'')
+
+    def _feed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self._chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def _chunk(self, tag, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
@@ -0,0 +1,124 @@
+# prefetch.py
+
+import math
+import time
+import logging
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QObject, QTimer, QRectF
+from chunks import chunk_range
+from tile_cache import LOD_ZOOM_THRESHOLD
+from instrumentation import log, metrics
+
+PREFETCH_IDLE = 300  # Сколько мс без смены вида ждать перед предзагрузкой
+PREFETCH_INTERVAL = 30  # Период (мс) шагов предзагрузки, пока работа не закончена
+PREFETCH_BUDGET = 0.006  # Время (с) на предзагрузку за один шаг
+PAN_MEMORY = 10.0  # Сколько секунд помнить направление последнего сдвига вида
+MAX_PINNED_CHUNKS = 64  # Больше чанков заранее в сцене не держится
+MAX_PREFETCH_PLACES = 9  # Столько первых закладок (с горячими клавишами) готовится заранее
+
+
+# Предзагрузка в простое: для закладок и для места, куда вид, судя по последнему сдвигу,
+# сдвинется дальше, заранее запрашиваются тайлы (если место смотрят отдаленно) или
+# в сцену подгружаются чанки с готовой геометрией штрихов. Переход к такому месту
+# показывает готовую картинку без долгого первого кадра
+class PlacePrefetcher(QObject):
+    def __init__(self, view, parent=None):
+        super().__init__(parent)
+        self.view = view
+        self.enabled = True
+        self.last_center = None  # (центр вида, масштаб) при прошлой смене вида
+        self.direction = None  # Единичный вектор последнего сдвига вида
+        self.direction_time = 0.0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.prefetchIdle)
+        view.chunk_store.bookmarks.listeners.append(self.schedule)
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.timer.stop()
+            self.view.chunk_store.set_pinned(())
+
+    def schedule(self):
+        if self.enabled:
+            self.timer.start(PREFETCH_IDLE)
+
+    def onViewChanged(self, rect, zoom_factor):
+        # Запоминает направление сдвига и откладывает предзагрузку до простоя
+        center = rect.center()
+        if self.last_center is not None and self.last_center[1] == zoom_factor:
+            dx = center.x() - self.last_center[0].x()
+            dy = center.y() - self.last_center[0].y()
+            length = math.hypot(dx, dy)
+            if length > 2 * math.hypot(rect.width(), rect.height()):
+                self.direction = None  # Переход к далекому месту, а не сдвиг
+            elif length > 0:
+                self.direction = (dx / length, dy / length)
+                self.direction_time = time.monotonic()
+        self.last_center = (center, zoom_factor)
+        self.schedule()
+
+    def targets(self):
+        # Места для предзагрузки: (прямоугольник документа, масштаб), самые вероятные первыми
+        view = self.view
+        viewport = view.viewport().rect()
+        visible = view.visibleDocumentRect()
+        targets = []
+        if self.direction is not None and time.monotonic() - self.direction_time < PAN_MEMORY:
+            # Следующий экран в направлении сдвига
+            dx, dy = self.direction
+            targets.append((visible.translated(dx * visible.width(), dy * visible.height()), view.zoom_factor))
+        for place in list(view.chunk_store.bookmarks)[:MAX_PREFETCH_PLACES]:
+            zoom = place.get('zoom_factor', 1.0)
+            if zoom <= 0:
+                continue
+            width, height = viewport.width() / zoom, viewport.height() / zoom
+            # Место закладки, на которой стоит вид, тоже держится: иначе переход с нее выгрузит ее чанки
+            targets.append((QRectF(place['x'] - width / 2, place['y'] - height / 2, width, height), zoom))
+        return targets
+
+    def prefetchIdle(self):
+        if not self.enabled:
+            return
+        if QApplication.mouseButtons() != Qt.NoButton:
+            # Пользователь рисует или тащит холст - не отнимаем у него время кадра
+            self.timer.start(PREFETCH_IDLE)
+            return
+        started = time.perf_counter()
+        try:
+            view = self.view
+            store = view.chunk_store
+            targets = self.targets()
+            pinned = []
+            for rect, zoom in targets:
+                if zoom >= LOD_ZOOM_THRESHOLD:
+                    x0, y0, x1, y1 = chunk_range(rect)
+                    pinned.extend((cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)
+                                  if (cx, cy) in store.chunks)
+            pinned = pinned[:MAX_PINNED_CHUNKS]
+            if set(pinned) != store.pinned_keys:
+                store.set_pinned(pinned)
+
+            deadline = started + PREFETCH_BUDGET
+            complete = True
+            loaded = 0
+            for rect, zoom in targets:
+                if zoom < LOD_ZOOM_THRESHOLD:
+                    complete = view.tile_cache.prefetch(rect, zoom, deadline)
+                if not complete:
+                    break
+            for key in pinned:
+                if not complete:
+                    break
+                if store.preload(key):
+                    loaded += 1
+                    complete = time.perf_counter() < deadline
+            if loaded:
+                log.debug("PlacePrefetcher: Preloaded %s chunks", loaded)
+            if not complete:
+                self.timer.start(PREFETCH_INTERVAL)
+        except Exception as e:
+            logging.exception("Exception in PlacePrefetcher prefetchIdle:")
+        if metrics.enabled:
+            metrics.observe('prefetch', time.perf_counter() - started)
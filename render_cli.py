@@ -0,0 +1,229 @@
+# render_cli.py
+
+import os
+import sys
+import json
+import math
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+from png_writer import PngWriter, TILE_PIXELS, BAND_MEMORY, MARGIN
+
+# Отрисовка холста .ess в PNG без дисплея и без CanvasWindow.
+# Область делится на тайлы, которые рисуются пулом процессов; тайлы собираются в полосы
+# по всей ширине результата, и каждая полоса сразу сжимается и дописывается в PNG. В памяти
+# одновременно находятся не больше двух полос, а высота полосы подбирается под BAND_MEMORY,
+# поэтому размер результата не ограничен памятью
+PLACE_SIZE = (1920, 1080)  # Размер кадра вокруг места .esp по умолчанию
+
+
+class RenderError(Exception):
+    pass
+
+
+def record_bounds(records):
+    # Рамки записей (left, top, right, bottom) с учетом толщины пера
+    bounds = np.full((len(records), 4), np.nan)
+    for i, record in enumerate(records):
+        if len(record.coords):
+            half_width = record.width / 2
+            bounds[i, :2] = record.coords.min(axis=0) - half_width
+            bounds[i, 2:] = record.coords.max(axis=0) + half_width
+    return bounds
+
+
+def visible_records(records, layers):
+    # Записи без скрытых слоев: скрытые не рисуются и не должны расширять холст
+    from ess_format import record_layer
+    hidden = {entry['id'] for entry in layers or [] if not entry.get('visible', True)}
+    return [record for record in records if record_layer(record) not in hidden]
+
+
+def canvas_rect(bounds):
+    present = bounds[~np.isnan(bounds[:, 0])]
+    if not len(present):
+        raise RenderError("Холст пуст")
+    left, top = present[:, :2].min(axis=0) - MARGIN
+    right, bottom = present[:, 2:].max(axis=0) + MARGIN
+    return left, top, right - left, bottom - top
+
+
+def place_rect(place, size, zoom):
+    width, height = size[0] / zoom, size[1] / zoom
+    return place['x'] - width / 2, place['y'] - height / 2, width, height
+
+
+# Состояние процесса отрисовки: записи холста и их рамки читаются один раз при запуске процесса
+_worker = {}
+
+
+def init_worker(filename, background):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    from ess_format import read_ess, read_layers, record_layer, record_z
+    _worker['app'] = QApplication.instance() or QApplication([])
+    records = read_ess(filename)
+    # Записи скрытых слоев не рисуются, остальные идут в порядке наложения: слой, затем z
+    layers = read_layers(filename) or []
+    positions = {entry['id']: position for position, entry in enumerate(layers)}
+    records = visible_records(records, layers)
+    order = sorted(range(len(records)), key=lambda index: (positions.get(record_layer(records[index]), len(layers)),
+                                                           record_z(records[index], index)))
+    records = [records[index] for index in order]
+    # Пирамиды изображений собираются заранее: без окна их некому достроить в фоне.
+    # Кэш пишется во временный каталог и переименовывается, поэтому процессы не мешают друг другу
+    from image_item import image_pyramid
+    for source in {record.source for record in records if record.source is not None}:
+        image_pyramid(source).build()
+    _worker['records'] = records
+    _worker['opacity'] = {entry['id']: entry.get('opacity', 1.0) for entry in layers}
+    _worker['bounds'] = record_bounds(records)
+    _worker['background'] = background
+
+
+def render_tile(task):
+    # task: (x, y, ширина, высота) тайла в пикселях результата, origin и zoom
+    from PyQt5.QtGui import QImage, QPainter, QColor
+    from ess_format import record_to_item, record_layer
+    from tile_cache import render_layers
+    (x, y, width, height), (origin_x, origin_y), zoom = task
+    left, top = origin_x + x / zoom, origin_y + y / zoom
+    right, bottom = left + width / zoom, top + height / zoom
+    bounds = _worker['bounds']
+    with np.errstate(invalid='ignore'):
+        visible = np.flatnonzero((bounds[:, 0] <= right) & (bounds[:, 2] >= left) &
+                                 (bounds[:, 1] <= bottom) & (bounds[:, 3] >= top))
+    image = QImage(width, height, QImage.Format_RGBA8888)
+    image.fill(QColor(_worker['background']))
+    if len(visible):
+        records = _worker['records']
+        # Записи упорядочены по слоям, поэтому слои - подряд идущие группы
+        layers = []
+        last_layer = None
+        for i in visible:
+            item = record_to_item(records[i])
+            if item is None:
+                continue
+            layer = record_layer(records[i])
+            if layer != last_layer:
+                layers.append((_worker['opacity'].get(layer, 1.0), []))
+                last_layer = layer
+            layers[-1][1].append(item)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.scale(zoom, zoom)
+        painter.translate(-left, -top)
+        render_layers(painter, layers)
+        painter.end()
+    pointer = image.constBits()
+    pointer.setsize(image.sizeInBytes())
+    return np.frombuffer(pointer, dtype=np.uint8).reshape(height, image.bytesPerLine())[:, :width * 4].copy()
+
+
+def band_tasks(y, band_height, width, height, tile, origin, zoom):
+    band_height = min(band_height, height - y)
+    return [((x, y, min(tile, width - x), band_height), origin, zoom) for x in range(0, width, tile)]
+
+
+def render(source, target, rect, zoom, tile=TILE_PIXELS, workers=None, background='#ffffff'):
+    left, top, world_width, world_height = rect
+    width = max(1, math.ceil(world_width * zoom))
+    height = max(1, math.ceil(world_height * zoom))
+    origin = (left, top)
+    # Очень широкий результат рисуется более низкими полосами
+    band_height = max(1, min(tile, BAND_MEMORY // (width * 4)))
+    bands = list(range(0, height, band_height))
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1:
+        # spawn: процессы не наследуют состояние Qt родителя и ведут себя одинаково на всех платформах
+        pool = multiprocessing.get_context('spawn').Pool(workers, init_worker, (source, background))
+    else:
+        init_worker(source, background)
+    try:
+        with open(target, 'wb') as f:
+            writer = PngWriter(f, width, height)
+            pending = None
+            if pool is not None:
+                pending = pool.map_async(render_tile, band_tasks(0, band_height, width, height, tile, origin, zoom))
+            for index, y in enumerate(bands):
+                if pool is not None:
+                    tiles = pending.get()
+                    # Следующая полоса рисуется, пока текущая сжимается и пишется
+                    if index + 1 < len(bands):
+                        pending = pool.map_async(render_tile, band_tasks(bands[index + 1], band_height, width, height,
+                                                                         tile, origin, zoom))
+                else:
+                    tiles = [render_tile(task) for task in band_tasks(y, band_height, width, height, tile, origin, zoom)]
+                band = np.concatenate(tiles, axis=1)
+                del tiles
+                writer.write_rows(band)
+                print(f"render_cli: Band {index + 1}/{len(bands)}", file=sys.stderr)
+            writer.finish()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return width, height
+
+
+def parse_pair(text, kind=float):
+    values = [kind(value) for value in text.lower().replace('x', ',').split(',')]
+    if len(values) != 2:
+        raise argparse.ArgumentTypeError(f"Ожидалось два числа: {text}")
+    return values
+
+
+def parse_rect(text):
+    values = [float(value) for value in text.split(',')]
+    if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+        raise argparse.ArgumentTypeError(f"Ожидалось x,y,ширина,высота: {text}")
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Отрисовка холста EndlessSketch в PNG без дисплея")
+    parser.add_argument('source', help="Файл холста .ess")
+    parser.add_argument('target', help="Файл результата .png")
+    parser.add_argument('--rect', type=parse_rect, help="Область холста x,y,ширина,высота (по умолчанию весь рисунок)")
+    parser.add_argument('--place', help="Файл места .esp: кадр вокруг сохраненного центра в его масштабе")
+    parser.add_argument('--size', type=lambda text: parse_pair(text, int), default=list(PLACE_SIZE),
+                        help="Размер кадра вокруг места в пикселях, например 1920x1080")
+    parser.add_argument('--zoom', type=float, help="Пикселей результата на единицу холста (по умолчанию 1)")
+    parser.add_argument('--max-size', type=int, help="Уменьшить масштаб, чтобы большая сторона не превышала это число")
+    parser.add_argument('--tile', type=int, default=TILE_PIXELS, help="Размер тайла в пикселях")
+    parser.add_argument('--workers', type=int, help="Число процессов отрисовки (по умолчанию по числу ядер)")
+    parser.add_argument('--background', default='#ffffff', help="Цвет фона (например, #ffffff или transparent)")
+    args = parser.parse_args(argv)
+    try:
+        zoom = args.zoom
+        if args.place:
+            from ess_format import decode_place
+            with open(args.place, 'r') as f:
+                place = decode_place(json.load(f))
+            if zoom is None:
+                zoom = place.get('zoom_factor', 1.0)
+            rect = args.rect or place_rect(place, args.size, zoom)
+        elif args.rect:
+            rect = args.rect
+        else:
+            from ess_format import read_ess, read_layers
+            rect = canvas_rect(record_bounds(visible_records(read_ess(args.source), read_layers(args.source))))
+        zoom = zoom or 1.0
+        if zoom <= 0:
+            raise RenderError(f"Неверный масштаб: {zoom}")
+        if args.max_size:
+            zoom = min(zoom, args.max_size / max(rect[2], rect[3]))
+        width, height = render(args.source, args.target, rect, zoom, tile=args.tile, workers=args.workers,
+                               background=args.background)
+        print(f"render_cli: Rendered {width}x{height} to {args.target}")
+    except Exception as e:
+        logging.exception("Exception in render:")
+        print(f"render_cli: Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
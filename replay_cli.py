@@ -0,0 +1,130 @@
+# replay_cli.py
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+# Без дисплея окно рисуется в память
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication, QMessageBox
+from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+from canvas_view import CanvasWindow
+from input_recorder import InputReplayer
+from journal import AUTOSAVE_DIR_ENV
+from benchmark import git_revision
+
+TOP_FRAMES = 10  # Сколько самых замедлившихся кадров показывает сравнение
+
+
+class ReplayError(Exception):
+    pass
+
+
+def replay(app, filename, fast):
+    window = CanvasWindow()
+    try:
+        replayer = InputReplayer(window, filename)
+        window.resize(*replayer.header['viewport'])
+        window.show()
+        app.processEvents()
+        # Окно больше вида на меню и панели - добираем разницу
+        dx, dy = replayer.viewportDelta()
+        window.resize(window.width() + dx, window.height() + dy)
+        app.processEvents()
+        replayer.prepare()
+        return replayer.run(fast)
+    finally:
+        window.close()
+        window.deleteLater()
+        app.processEvents()
+
+
+def frame_times(result):
+    return [input_time + paint_time
+            for input_time, paint_time in zip(result['frame_input_seconds'], result['frame_paint_seconds'])]
+
+
+def compare(before, after, top=TOP_FRAMES):
+    # Сравнение двух воспроизведений одной записи, например до и после изменения: кадры
+    # детерминированного воспроизведения совпадают по номерам, поэтому сравниваются попарно
+    def pair(key):
+        return [before.get(key), after.get(key)]
+
+    before_frames = frame_times(before)
+    after_frames = frame_times(after)
+    changes = sorted(((after_time - before_time, index, before_time, after_time)
+                      for index, (before_time, after_time) in enumerate(zip(before_frames, after_frames))),
+                     reverse=True)
+    latency = {name: [(before['latency'].get(name) or {}).get('p95'), (after['latency'].get(name) or {}).get('p95')]
+               for name in sorted(set(before['latency']) | set(after['latency']))}
+    return {
+        'same_document': before['document_digest'] == after['document_digest'],
+        'same_frames': before['frames'] == after['frames'],
+        'wall_seconds': pair('wall_seconds'),
+        'frame_p50': pair('frame_p50'),
+        'frame_p95': pair('frame_p95'),
+        'frame_total_seconds': [sum(before_frames), sum(after_frames)],
+        'paint_p95': [(before['paint'] or {}).get('p95'), (after['paint'] or {}).get('p95')],
+        'latency_p95': latency,
+        'slowest_frames': [{'frame': index, 'before': before_time, 'after': after_time}
+                           for _, index, before_time, after_time in changes[:top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записей ввода EndlessSketch без дисплея")
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help="воспроизвести запись .esr и замерить кадры")
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('--fast', action='store_true', help="без пауз между событиями")
+    replay_parser.add_argument('--output', help="файл для результатов в JSON (по умолчанию stdout)")
+    compare_parser = commands.add_parser('compare', help="сравнить два результата replay одной записи")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--top', type=int, default=TOP_FRAMES)
+    compare_parser.add_argument('--output', help="файл для сравнения в JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        report = compare(before, after, args.top)
+    else:
+        app = QApplication(sys.argv)
+        # Журнал автосохранения пишется во временный каталог, чтобы не трогать сеансы пользователя
+        autosave = tempfile.TemporaryDirectory(prefix='endless_sketch_replay_autosave_')
+        os.environ[AUTOSAVE_DIR_ENV] = autosave.name
+
+        # Модальный диалог без дисплея повис бы навсегда — ошибка должна прервать воспроизведение
+        def critical(parent, title, text, *args, **kwargs):
+            raise ReplayError(text)
+        QMessageBox.critical = staticmethod(critical)
+
+        report = replay(app, args.recording, args.fast)
+        report['meta'] = {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'pyqt': PYQT_VERSION_STR,
+            'platform': platform.platform(),
+            'qpa': app.platformName(),
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,23 @@
 # settings.py
 
 from PyQt5.QtGui import QColor
+from instrumentation import log
 
 
 class Settings:
     def __init__(self):
         self.current_color = QColor(0, 0, 0)  # Черный по умолчанию
         self.brush_size_percentage = 5  # Размер кисти в процентах (1-100)
+        self.simplify_tolerance = 0.5  # Допуск упрощения линий в пикселях экрана
+        self.min_point_distance = 1.5  # Минимальное расстояние между точками в пикселях экрана
+        self.smooth_strokes = True  # Сглаживать штрих кисти и хранить его кривыми Безье
+        self.curve_tolerance = 1.0  # Допуск аппроксимации кривыми в пикселях экрана
+        self.history_memory_limit_mb = 64  # Сколько истории держать в памяти, остальное уходит на диск
+        self.bake_strokes = True  # Запекать давно не менявшиеся чанки в один статичный элемент
+        self.prefetch_places = True  # Готовить в простое содержимое вокруг закладок и по направлению сдвига
+        self.eyedropper_sample_size = 1  # Сторона квадрата усреднения пипетки в пикселях экрана
+        self.input_frame_interval = 16  # Период (мс) применения накопленных движений мыши к инструменту
+        self.input_samples_per_frame = 512  # Сколько сэмплов движения инструмент обрабатывает за кадр
 
     def get_brush_size(self, view_width, view_height, zoom_factor):
         # Ограничиваем brush_size_percentage до диапазона 1-100
@@ -17,10 +28,26 @@ class Settings:
         base_size = min_dim * (self.brush_size_percentage / 100)
 
         if zoom_factor <= 0:
-            print("Settings: Invalid zoom_factor <= 0, resetting to 1")
+            log.warning("Settings: Invalid zoom_factor <= 0, resetting to 1")
             zoom_factor = 1.0
 
         actual_size = base_size / zoom_factor
         brush_size = max(1, actual_size)  # Минимальный размер кисти - 1 пиксель
-        print(f"Settings: Calculated brush size: {brush_size}")
+        log.debug("Settings: Calculated brush size: %s", brush_size)
         return brush_size
+
+    def get_simplify_tolerance(self, zoom_factor):
+        # Допуск задается в пикселях экрана, поэтому переводим его в единицы сцены
+        if zoom_factor <= 0:
+            zoom_factor = 1.0
+        return max(0.0, self.simplify_tolerance) / zoom_factor
+
+    def get_curve_tolerance(self, zoom_factor):
+        if zoom_factor <= 0:
+            zoom_factor = 1.0
+        return max(0.01, self.curve_tolerance) / zoom_factor
+
+    def get_min_point_distance(self, zoom_factor):
+        if zoom_factor <= 0:
+            zoom_factor = 1.0
+        return max(0.0, self.min_point_distance) / zoom_factor
@@ -0,0 +1,56 @@
+# simplify.py
+
+import math
+
+
+def far_enough(last_point, point, min_distance):
+    # Фильтр по минимальному расстоянию во время рисования
+    if last_point is None:
+        return True
+    return math.hypot(point[0] - last_point[0], point[1] - last_point[1]) >= min_distance
+
+
+def simplify_rdp(points, tolerance):
+    # Упрощение ломаной алгоритмом Рамера — Дугласа — Пекера (без рекурсии)
+    count = len(points)
+    if count < 3 or tolerance <= 0:
+        return list(points)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        ax, ay = points[start]
+        bx, by = points[end]
+        dx = bx - ax
+        dy = by - ay
+        segment2 = dx * dx + dy * dy
+
+        max_distance2 = -1.0
+        index = start
+        for i in range(start + 1, end):
+            px, py = points[i]
+            if segment2 > 0:
+                # Расстояние до отрезка, а не до бесконечной прямой
+                t = ((px - ax) * dx + (py - ay) * dy) / segment2
+                t = max(0.0, min(1.0, t))
+                ex = ax + t * dx - px
+                ey = ay + t * dy - py
+            else:
+                ex = px - ax
+                ey = py - ay
+            distance2 = ex * ex + ey * ey
+            if distance2 > max_distance2:
+                max_distance2 = distance2
+                index = i
+
+        if max_distance2 > tolerance2:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [point for point, kept in zip(points, keep) if kept]
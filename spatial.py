@@ -0,0 +1,250 @@
+# spatial.py
+
+import math
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem
+from PyQt5.QtCore import Qt, QRectF
+from curves import flatten_curve
+from stroke_item import StrokeItem, map_array, polygon_to_array
+from layers import document_transform
+
+GRID_CELL = 256.0  # Ячейка нижнего уровня сетки; на уровне L ячейка в 2**L раз больше
+EPSILON = 1e-9
+POLYGON_BLOCK = 1 << 16  # Предел размера матрицы точки x ребра в points_in_polygon
+
+
+def points_in_polygon(points, polygon):
+    # Проверка точек на попадание в многоугольник (правило четности), векторно по точкам и ребрам;
+    # точки берутся блоками, чтобы матрица точки x ребра не превышала POLYGON_BLOCK
+    inside = np.zeros(len(points), dtype=bool)
+    if len(points) == 0 or len(polygon) < 3:
+        return inside
+    x1 = polygon[:, 0][None, :]
+    y1 = polygon[:, 1][None, :]
+    x2 = np.roll(polygon[:, 0], 1)[None, :]
+    y2 = np.roll(polygon[:, 1], 1)[None, :]
+    dy = y2 - y1
+    dy[dy == 0] = EPSILON
+    step = max(1, POLYGON_BLOCK // len(polygon))
+    for start in range(0, len(points), step):
+        x = points[start:start + step, 0:1]
+        y = points[start:start + step, 1:2]
+        crosses = (y1 > y) != (y2 > y)
+        x_cross = x1 + (y - y1) * (x2 - x1) / dy
+        inside[start:start + step] = np.count_nonzero(crosses & (x < x_cross), axis=1) % 2 == 1
+    return inside
+
+
+def rect_to_polygon(rect):
+    return np.array([(rect.left(), rect.top()), (rect.right(), rect.top()),
+                     (rect.right(), rect.bottom()), (rect.left(), rect.bottom())], dtype=np.float64)
+
+
+def item_outlines(item):
+    # Геометрия элемента в координатах документа для точных проверок:
+    # ([(точки (n, 2), замкнут ли контур)], половина толщины пера). Кривые заменяются ломаными
+    transform = document_transform(item)
+    if isinstance(item, StrokeItem):
+        coords = item.coords()
+        if item.curve:
+            coords = flatten_curve(coords)
+        return [(map_array(transform, coords), False)], item.width / 2
+    if isinstance(item, QGraphicsPathItem):
+        pen = item.pen()
+        half_width = pen.widthF() / 2 if pen.style() != Qt.NoPen else 0.0
+        return [(polygon_to_array(polygon), False) for polygon in item.path().toSubpathPolygons(transform)], half_width
+    if isinstance(item, QGraphicsPolygonItem):
+        return [(map_array(transform, polygon_to_array(item.polygon())), True)], 0.0
+    # Прочие элементы проверяются по рамке
+    return [(rect_to_polygon(transform.mapRect(item.boundingRect())), True)], 0.0
+
+
+def _segments(points, closed):
+    if len(points) == 1:
+        return points, points
+    if closed:
+        return points, np.roll(points, -1, axis=0)
+    return points[:-1], points[1:]
+
+
+def _near(starts, ends, low, high):
+    # Отрезки, рамка которых пересекает прямоугольник [low, high]
+    return ((np.minimum(starts, ends) <= high) & (np.maximum(starts, ends) >= low)).all(axis=1)
+
+
+def _point_distances(points, starts, ends):
+    # Расстояние от каждой точки до ближайшего из отрезков; точки берутся блоками,
+    # чтобы матрица точки x отрезки не превышала POLYGON_BLOCK
+    d = ends - starts
+    lengths = np.maximum((d * d).sum(axis=1), EPSILON)
+    distances = np.empty(len(points))
+    step = max(1, POLYGON_BLOCK // max(1, len(starts)))
+    for start in range(0, len(points), step):
+        w = points[start:start + step, None, :] - starts[None, :, :]
+        t = np.clip((w * d[None, :, :]).sum(axis=2) / lengths[None, :], 0.0, 1.0)
+        offset = w - t[..., None] * d[None, :, :]
+        distances[start:start + step] = np.hypot(offset[..., 0], offset[..., 1]).min(axis=1)
+    return distances
+
+
+def _points_near(points, starts, ends, limit):
+    # Есть ли точка не дальше limit от отрезков; блоки как в _point_distances, выход на первом найденном
+    step = max(1, POLYGON_BLOCK // max(1, len(starts)))
+    for start in range(0, len(points), step):
+        if _point_distances(points[start:start + step], starts, ends).min() <= limit:
+            return True
+    return False
+
+
+def _segments_cross(a_starts, a_ends, b_starts, b_ends):
+    # Пересекается ли хоть один отрезок a с хоть одним отрезком b (касание считается).
+    # Отрезки a берутся блоками, чтобы матрица a x b не превышала POLYGON_BLOCK
+    def orientation(p, q, r):
+        return (q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0])
+    b0, b1 = b_starts[None, :, :], b_ends[None, :, :]
+    step = max(1, POLYGON_BLOCK // max(1, len(b_starts)))
+    for start in range(0, len(a_starts), step):
+        a0, a1 = a_starts[start:start + step, None, :], a_ends[start:start + step, None, :]
+        if ((orientation(b0, b1, a0) * orientation(b0, b1, a1) <= 0) &
+                (orientation(a0, a1, b0) * orientation(a0, a1, b1) <= 0)).any():
+            return True
+    return False
+
+
+def distance_to_item(item, x, y):
+    # Расстояние от точки до закрашенной части элемента (с учетом толщины пера); 0 внутри
+    outlines, half_width = item_outlines(item)
+    point = np.array([(x, y)], dtype=np.float64)
+    best = math.inf
+    for points, closed in outlines:
+        if not len(points):
+            continue
+        if closed and len(points) >= 3 and points_in_polygon(point, points)[0]:
+            return 0.0
+        best = min(best, float(_point_distances(point, *_segments(points, closed))[0]))
+    return max(0.0, best - half_width)
+
+
+def item_touches_polygon(item, polygon):
+    # Задевает ли закрашенная часть элемента многоугольник polygon (n, 2)
+    outlines, half_width = item_outlines(item)
+    polygon_starts, polygon_ends = _segments(polygon, True)
+    polygon_low = polygon.min(axis=0) - half_width
+    polygon_high = polygon.max(axis=0) + half_width
+    for points, closed in outlines:
+        if not len(points):
+            continue
+        if points_in_polygon(points, polygon).any():
+            return True
+        if closed and len(points) >= 3 and points_in_polygon(polygon, points).any():
+            return True
+        # Дальше сравниваются только отрезки рядом с рамкой другой фигуры
+        starts, ends = _segments(points, closed)
+        near = _near(starts, ends, polygon_low, polygon_high)
+        if not near.any():
+            continue
+        starts, ends = starts[near], ends[near]
+        low = np.minimum(starts, ends).min(axis=0) - half_width
+        high = np.maximum(starts, ends).max(axis=0) + half_width
+        edges = _near(polygon_starts, polygon_ends, low, high)
+        if not edges.any():
+            continue
+        edge_starts, edge_ends = polygon_starts[edges], polygon_ends[edges]
+        if _segments_cross(starts, ends, edge_starts, edge_ends):
+            return True
+        if half_width > 0:
+            # Без пересечений расстояние между ломаными достигается в одном из концов отрезков
+            vertices = np.concatenate((starts, ends))
+            edge_vertices = np.concatenate((edge_starts, edge_ends))
+            if (_points_near(vertices, edge_starts, edge_ends, half_width) or
+                    _points_near(edge_vertices, starts, ends, half_width)):
+                return True
+    return False
+
+
+# Иерархическая сетка рамок элементов. Элемент хранится на уровне, где ячейка не меньше его рамки,
+# в ячейке с ее левым верхним углом - одна запись на элемент, поэтому вставка и удаление стоят
+# O(log размера) на выбор уровня и O(1) операций со словарями. Запрос по прямоугольнику на каждом
+# занятом уровне смотрит только ячейки, из которых рамка размером с ячейку может его задеть
+class SpatialIndex:
+    def __init__(self):
+        self.levels = {}  # уровень -> {(cx, cy): множество элементов}
+        self.entries = {}  # элемент -> (x0, y0, x1, y1, уровень, ячейка)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def bounds(self, item):
+        x0, y0, x1, y1 = self.entries[item][:4]
+        return QRectF(x0, y0, x1 - x0, y1 - y0)
+
+    def insert(self, item, rect):
+        if item in self.entries:
+            self.remove(item)
+        x0, y0, x1, y1 = rect.left(), rect.top(), rect.right(), rect.bottom()
+        level = math.ceil(math.log2(max(x1 - x0, y1 - y0, GRID_CELL) / GRID_CELL))
+        cell_size = GRID_CELL * 2.0 ** level
+        cell = (math.floor(x0 / cell_size), math.floor(y0 / cell_size))
+        self.levels.setdefault(level, {}).setdefault(cell, set()).add(item)
+        self.entries[item] = (x0, y0, x1, y1, level, cell)
+
+    def remove(self, item):
+        # Возвращает рамку убранного элемента или None, если его не было
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return None
+        x0, y0, x1, y1, level, cell = entry
+        cells = self.levels[level]
+        cells[cell].discard(item)
+        if not cells[cell]:
+            del cells[cell]
+            if not cells:
+                del self.levels[level]
+        return QRectF(x0, y0, x1 - x0, y1 - y0)
+
+    def clear(self):
+        self.levels.clear()
+        self.entries.clear()
+
+    def query(self, rect):
+        # Элементы, рамка которых пересекает rect (касание краем тоже считается)
+        x0, y0, x1, y1 = rect.left(), rect.top(), rect.right(), rect.bottom()
+        found = []
+        for level, cells in self.levels.items():
+            cell_size = GRID_CELL * 2.0 ** level
+            # Рамка не больше ячейки, поэтому rect задевают только ячейки не дальше одной левее и выше
+            cx0, cy0 = math.floor(x0 / cell_size) - 1, math.floor(y0 / cell_size) - 1
+            cx1, cy1 = math.floor(x1 / cell_size), math.floor(y1 / cell_size)
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+                # Диапазон больше числа занятых ячеек (сильное отдаление) - перебираем занятые
+                groups = [members for (cx, cy), members in cells.items()
+                          if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+            else:
+                groups = [cells[(cx, cy)] for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+                          if (cx, cy) in cells]
+            for members in groups:
+                for item in members:
+                    ex0, ey0, ex1, ey1 = self.entries[item][:4]
+                    if ex0 <= x1 and x0 <= ex1 and ey0 <= y1 and y0 <= ey1:
+                        found.append(item)
+        return found
+
+    def nearest(self, x, y, k, distance, accept=None, max_distance=math.inf):
+        # k ближайших элементов [(расстояние, элемент)] по точному расстоянию distance(item).
+        # Квадрат поиска удваивается, пока k-й найденный элемент не окажется ближе края квадрата:
+        # все элементы ближе этого расстояния задевают квадрат и уже проверены
+        distances = {}
+        radius = GRID_CELL
+        while True:
+            candidates = self.query(QRectF(x - radius, y - radius, 2 * radius, 2 * radius))
+            for item in candidates:
+                if item not in distances and (accept is None or accept(item)):
+                    distances[item] = distance(item)
+            ranked = sorted(distances.items(), key=lambda entry: entry[1])[:k]
+            if ((len(ranked) == k and ranked[-1][1] <= radius) or radius >= max_distance
+                    or len(candidates) == len(self.entries)):
+                return [(value, item) for item, value in ranked if value <= max_distance]
+            radius *= 2
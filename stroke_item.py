@@ -0,0 +1,134 @@
+# stroke_item.py
+
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsItem
+from PyQt5.QtGui import QPainterPath, QPainterPathStroker, QPen, QColor, QBrush, QPolygonF
+from PyQt5.QtCore import Qt, QPointF, QRectF
+
+
+def array_to_polygon(coords):
+    # Копируем массив напрямую в память QPolygonF, без объекта Python на точку
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    polygon = QPolygonF(len(coords))
+    if len(coords):
+        buffer = polygon.data()
+        buffer.setsize(coords.nbytes)
+        np.frombuffer(buffer, dtype=np.float64)[:] = coords.ravel()
+    return polygon
+
+
+def polygon_to_array(polygon):
+    count = polygon.count()
+    if not count:
+        return np.empty((0, 2), dtype=np.float64)
+    buffer = polygon.data()
+    buffer.setsize(count * 16)
+    return np.frombuffer(buffer, dtype=np.float64).reshape(count, 2).copy()
+
+
+def map_array(transform, coords):
+    # Применяет QTransform (аффинную часть) к массиву точек
+    if transform.isIdentity():
+        return coords
+    x = coords[:, 0]
+    y = coords[:, 1]
+    return np.column_stack((transform.m11() * x + transform.m21() * y + transform.dx(),
+                            transform.m12() * x + transform.m22() * y + transform.dy()))
+
+
+def curve_to_path(coords):
+    # Путь из кривой (1 + 3k, 2): moveTo и по cubicTo на сегмент
+    path = QPainterPath()
+    if len(coords):
+        path.moveTo(*coords[0])
+        for c1x, c1y, c2x, c2y, x, y in coords[1:].reshape(-1, 6).tolist():
+            path.cubicTo(c1x, c1y, c2x, c2y, x, y)
+    return path
+
+
+# Штрих кисти без QPainterPath: точки хранятся плоским буфером float32 относительно первой
+# точки (как в блоках .ess), рамка считается один раз при создании. Ломаная или путь для
+# отрисовки строятся при первом paint() и отбрасываются, когда элемент убирают из сцены.
+# Штрих с curve=True - кривая (1 + 3k, 2) в порядке элементов cubicTo
+class StrokeItem(QGraphicsItem):
+    __slots__ = ('curve', 'origin', 'buffer', 'rgba', 'width', 'bounds', 'geometry')
+
+    def __init__(self, coords, rgba, width, curve=False):
+        super().__init__()
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.curve = curve
+        self.origin = coords[0].copy() if len(coords) else np.zeros(2)
+        self.buffer = (coords - self.origin).astype(np.float32)
+        self.rgba = rgba
+        self.width = float(width)
+        self.geometry = None
+        self.bounds = self._bounds()
+
+    def coords(self):
+        return self.buffer.astype(np.float64) + self.origin
+
+    def pen(self):
+        pen = QPen(QColor.fromRgba(self.rgba), self.width)
+        pen.setCapStyle(Qt.RoundCap)
+        pen.setJoinStyle(Qt.RoundJoin)
+        return pen
+
+    def setPen(self, pen):
+        self.prepareGeometryChange()
+        self.rgba = pen.color().rgba()
+        self.width = pen.widthF()
+        self.bounds = self._bounds()
+        self.update()
+
+    def brush(self):
+        return QBrush()
+
+    def path(self):
+        if self.curve:
+            return curve_to_path(self.coords())
+        path = QPainterPath()
+        if len(self.buffer) == 1:
+            path.moveTo(*self.origin)
+        elif len(self.buffer):
+            path.addPolygon(array_to_polygon(self.coords()))
+        return path
+
+    def prepareGeometry(self):
+        # Строит ломаную или путь заранее, чтобы первый paint() не тратил на это время
+        if self.geometry is None and len(self.buffer) > 1:
+            self.geometry = self.path() if self.curve else array_to_polygon(self.coords())
+
+    def releaseGeometry(self):
+        self.geometry = None
+
+    def boundingRect(self):
+        return self.bounds
+
+    def shape(self):
+        stroker = QPainterPathStroker()
+        stroker.setWidth(self.width)
+        stroker.setCapStyle(Qt.RoundCap)
+        stroker.setJoinStyle(Qt.RoundJoin)
+        return stroker.createStroke(self.path())
+
+    def paint(self, painter, option, widget=None):
+        if not len(self.buffer):
+            return
+        painter.setPen(self.pen())
+        painter.setBrush(Qt.NoBrush)
+        if len(self.buffer) == 1:
+            painter.drawPoint(QPointF(*self.origin))
+        else:
+            self.prepareGeometry()
+            if self.curve:
+                painter.drawPath(self.geometry)
+            else:
+                painter.drawPolyline(self.geometry)
+
+    def _bounds(self):
+        # Рамка контрольных точек плюс половина толщины пера: кривая не выходит за свои контрольные точки
+        if not len(self.buffer):
+            return QRectF()
+        low = self.buffer.min(axis=0) + self.origin - self.width / 2
+        high = self.buffer.max(axis=0) + self.origin + self.width / 2
+        return QRectF(low[0], low[1], high[0] - low[0], high[1] - low[1])
@@ -0,0 +1,63 @@
+# test_ess_format.py
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import ess_format
+from ess_format import (ItemRecord, KIND_PATH, convert_ess, group_pages, is_paged_ess, read_bookmarks, read_ess,
+                        read_layers, write_ess, write_paged_ess)
+
+LAYERS = [{'id': 0, 'name': 'Слой 1', 'visible': True, 'opacity': 1.0, 'locked': False},
+          {'id': 3, 'name': 'Эскиз', 'visible': False, 'opacity': 0.5, 'locked': False}]
+BOOKMARKS = [{'x': 10.0, 'y': 20.0, 'zoom_factor': 2.0, 'name': 'A'}]
+
+
+def records(count=20):
+    result = []
+    for index in range(count):
+        coords = np.column_stack((np.arange(10, dtype=np.float64) + index * 50, np.zeros(10)))
+        result.append(ItemRecord(KIND_PATH, 0xff000000 | index, 2.0, coords, layer=3 if index % 2 else 0))
+    return result
+
+
+@pytest.fixture
+def paged(tmp_path):
+    filename = str(tmp_path / 'doc.ess')
+    write_paged_ess(filename, group_pages(records()), LAYERS, BOOKMARKS)
+    return filename
+
+
+def test_convert_keeps_paged_source_paged(paged, tmp_path):
+    target = str(tmp_path / 'copy.ess')
+    assert convert_ess(paged, target) == 20
+    assert is_paged_ess(target)
+    assert [layer['id'] for layer in read_layers(target)] == [0, 3]
+    assert read_bookmarks(target) == read_bookmarks(paged)
+
+
+def test_convert_refuses_flat_over_paged_source(paged):
+    with pytest.raises(ValueError):
+        convert_ess(paged, paged, paged=False)
+    assert read_layers(paged) is not None
+
+
+def test_cli_requires_target(paged):
+    with pytest.raises(SystemExit):
+        ess_format.main([paged])
+    assert is_paged_ess(paged)
+
+
+def test_write_ess_keeps_old_file_on_error(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'flat.ess')
+    write_ess(filename, records())
+
+    def failing(*args, **kwargs):
+        raise RuntimeError("pack failed")
+    monkeypatch.setattr(ess_format, 'pack_records', failing)
+    with pytest.raises(RuntimeError):
+        write_ess(filename, records(5))
+    assert len(read_ess(filename)) == 20
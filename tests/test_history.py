@@ -0,0 +1,207 @@
+# test_history.py
+
+import os
+import sys
+import itertools
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+from PyQt5.QtWidgets import QApplication, QGraphicsScene
+from PyQt5.QtGui import QTransform
+from PyQt5.QtCore import QRectF
+from chunks import ChunkStore, ITEM_UID
+from ess_format import ItemRecord, KIND_PATH, KIND_POLYGON, record_to_item, item_to_record
+from history import (History, AddItemsCommand, RemoveItemsCommand, TransformCommand, StyleCommand,
+                     MERGE_INTERVAL, apply_style, item_style)
+
+app = QApplication.instance() or QApplication([])
+
+
+def stroke(index, points=200):
+    coords = np.column_stack((np.linspace(0, 100, points) + index * 10, np.sin(np.arange(points) / 5) * 20))
+    return record_to_item(ItemRecord(KIND_PATH, 0xff000000 | index, 2.0, coords))
+
+
+def square(x, y, size=10):
+    coords = np.array([(x, y), (x + size, y), (x + size, y + size), (x, y + size)], dtype=np.float64)
+    return record_to_item(ItemRecord(KIND_POLYGON, 0xff00ff00, 0.0, coords))
+
+
+@pytest.fixture
+def scene():
+    return QGraphicsScene()
+
+
+@pytest.fixture
+def store(scene):
+    return ChunkStore(scene)
+
+
+def make_history(store, limit):
+    history = History(store, memory_limit=limit)
+    # Каждое действие - отдельная запись: время идет шагами больше интервала объединения
+    ticks = itertools.count()
+    history.clock = lambda: next(ticks) * MERGE_INTERVAL * 2
+    return history
+
+
+def live_items(stack):
+    return sum(1 for command in stack for ref in command.refs() if ref.item is not None)
+
+
+def geometry(store):
+    return {item.data(ITEM_UID): item_to_record(item).coords for item in store.items()}
+
+
+def assert_same_geometry(before, after):
+    assert before.keys() == after.keys()
+    for uid, coords in before.items():
+        np.testing.assert_allclose(after[uid], coords, atol=1e-3)
+
+
+def test_undo_everything_stays_within_limit(store):
+    history = make_history(store, 20000)
+    for index in range(300):
+        item = stroke(index)
+        store.add_item(item)
+        history.push(AddItemsCommand([item]))
+    drawn = geometry(store)
+
+    while history.undo():
+        pass
+    assert len(store) == 0
+    assert history.memory_used <= history.memory_limit
+    # Снятые с холста штрихи лежат на диске, в памяти - не больше верхних записей повтора
+    assert live_items(history.redo_stack) < 10
+
+    while history.redo():
+        pass
+    assert_same_geometry(drawn, geometry(store))
+    assert history.memory_used == 0
+
+
+def test_push_drops_redo_memory(store):
+    history = make_history(store, 1 << 30)
+    items = [stroke(index) for index in range(5)]
+    for item in items:
+        store.add_item(item)
+        history.push(AddItemsCommand([item]))
+    history.undo()
+    history.undo()
+    assert history.memory_used > 0
+    item = stroke(10)
+    store.add_item(item)
+    history.push(AddItemsCommand([item]))
+    assert not history.canRedo()
+    assert history.memory_used == 0
+
+
+def test_spill_undo_redo_round_trip(store):
+    history = make_history(store, 20000)
+    items = [stroke(index) for index in range(50)]
+    for item in items:
+        store.add_item(item)
+    drawn = geometry(store)
+    for item in items:
+        store.remove_item(item)
+        history.push(RemoveItemsCommand([item]))
+    assert len(store) == 0
+    assert history.memory_used <= history.memory_limit
+    assert history.spill_file is not None
+
+    while history.undo():
+        pass
+    assert_same_geometry(drawn, geometry(store))
+    while history.redo():
+        pass
+    assert len(store) == 0
+    while history.undo():
+        pass
+    assert_same_geometry(drawn, geometry(store))
+
+
+def test_transform_command(store):
+    history = make_history(store, 1 << 30)
+    item = square(0, 0)
+    store.add_item(item)
+    old = item.transform()
+    moved = QTransform.fromTranslate(1000, 0)
+    item.setTransform(moved)
+    store.update_item(item)
+    history.push(TransformCommand([item], [old], [moved]))
+
+    history.undo()
+    assert item.transform() == old
+    assert store.items_in_rect(QRectF(-1, -1, 12, 12)) == [item]
+    assert store.items_in_rect(QRectF(999, -1, 12, 12)) == []
+    history.redo()
+    assert item.transform() == moved
+    assert store.items_in_rect(QRectF(999, -1, 12, 12)) == [item]
+    assert store.items_in_rect(QRectF(-1, -1, 12, 12)) == []
+
+
+def test_transform_commands_merge(store):
+    history = make_history(store, 1 << 30)
+    history.clock = lambda ticks=itertools.count(): next(ticks) * MERGE_INTERVAL / 4
+    item = square(0, 0)
+    store.add_item(item)
+    transforms = [QTransform.fromTranslate(step * 10, 0) for step in range(4)]
+    for old, new in zip(transforms, transforms[1:]):
+        item.setTransform(new)
+        history.push(TransformCommand([item], [old], [new]))
+    assert len(history) == 1
+    history.undo()
+    assert item.transform() == transforms[0]
+    history.redo()
+    assert item.transform() == transforms[-1]
+
+
+def test_style_command(store):
+    history = make_history(store, 1 << 30)
+    path = stroke(0)
+    polygon = square(0, 0)
+    store.add_item(path)
+    store.add_item(polygon)
+    items = [path, polygon]
+    old = [item_style(item) for item in items]
+    new = [(0xff123456, 7.0), (0xff654321, 0.0)]
+    for item, (rgba, width) in zip(items, new):
+        apply_style(item, rgba, width)
+    history.push(StyleCommand(items, old, new))
+
+    history.undo()
+    assert [item_style(item) for item in items] == old
+    history.redo()
+    assert [item_style(item) for item in items] == new
+
+
+def test_style_commands_merge(store):
+    history = make_history(store, 1 << 30)
+    history.clock = lambda ticks=itertools.count(): next(ticks) * MERGE_INTERVAL / 4
+    item = stroke(0)
+    store.add_item(item)
+    original = item_style(item)
+    styles = [original, (0xff0000ff, 3.0), (0xff00ff00, 5.0)]
+    for old, new in zip(styles, styles[1:]):
+        apply_style(item, *new)
+        history.push(StyleCommand([item], [old], [new]))
+    assert len(history) == 1
+    history.undo()
+    assert item_style(item) == original
+    history.redo()
+    assert item_style(item) == styles[-1]
+
+
+def test_remove_command(store):
+    history = make_history(store, 1 << 30)
+    item = stroke(0)
+    store.add_item(item)
+    store.remove_item(item)
+    history.push(RemoveItemsCommand([item]))
+    history.undo()
+    assert item in store
+    history.redo()
+    assert item not in store
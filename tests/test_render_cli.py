@@ -0,0 +1,35 @@
+# test_render_cli.py
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PyQt5.QtGui import QImage
+import render_cli
+from ess_format import ItemRecord, KIND_PATH, group_pages, write_paged_ess
+
+LAYERS = [{'id': 0, 'name': 'Слой 1', 'visible': True, 'opacity': 1.0, 'locked': False},
+          {'id': 3, 'name': 'Эскиз', 'visible': False, 'opacity': 1.0, 'locked': False}]
+
+
+def line(x, y, layer):
+    coords = np.column_stack((np.arange(10, dtype=np.float64) + x, np.full(10, float(y))))
+    return ItemRecord(KIND_PATH, 0xff000000, 2.0, coords, layer=layer)
+
+
+def test_full_canvas_skips_hidden_layers(tmp_path):
+    source = str(tmp_path / 'doc.ess')
+    target = str(tmp_path / 'out.png')
+    # Скрытый слой далеко от видимого рисунка не должен раздувать результат
+    write_paged_ess(source, group_pages([line(0, 0, 0), line(5000, 5000, 3)]), LAYERS)
+    assert render_cli.main([source, target, '--workers', '1']) == 0
+    image = QImage(target)
+    assert image.width() < 100 and image.height() < 100
+
+
+def test_visible_records_without_layers():
+    records = [line(0, 0, 0), line(10, 10, 3)]
+    assert render_cli.visible_records(records, None) == records
+    assert render_cli.visible_records(records, LAYERS) == records[:1]
@@ -0,0 +1,233 @@
+# tile_cache.py
+
+import math
+import time
+from collections import OrderedDict
+from PyQt5.QtWidgets import QStyleOptionGraphicsItem
+from PyQt5.QtGui import QPainter, QColor, QImage
+from PyQt5.QtCore import QRectF
+from tile_renderer import TileRenderer, snapshot_item
+from layers import document_transform
+
+TILE_PIXELS = 256  # Размер тайла в пикселях
+LOD_ZOOM_THRESHOLD = 0.25  # Ниже этого масштаба холст рисуется тайлами
+MEMORY_LIMIT = 128 * 1024 * 1024  # Предел памяти кэша тайлов в байтах
+SNAPSHOT_BUDGET = 0.006  # Время (с) на снимки элементов для новых тайлов за один кадр
+PLACEHOLDER_COLOR = QColor(235, 235, 235)  # Заглушка тайла, для которого еще нет даже грубой замены
+MAX_FALLBACK_LEVELS = 4  # На сколько уровней вверх искать замену отсутствующему тайлу
+PREFETCH_PRIORITY = -1 << 30  # Приоритет заранее запрошенных тайлов: ниже любого видимого
+PREFETCH_MEMORY_SHARE = 0.5  # Предзагрузка не запрашивает тайлы, когда кэш заполнен больше этой доли
+EMPTY_TILE = QImage()  # Тайл слоя, в котором нет элементов: не рисуется и не занимает памяти
+
+
+def level_for_zoom(zoom_factor):
+    # Уровень пирамиды: тайлы рисуются в масштабе 2**level, не меньше текущего
+    return math.ceil(math.log2(zoom_factor))
+
+
+def tile_world_size(level):
+    return TILE_PIXELS / (2.0 ** level)
+
+
+def tile_rect(level, tx, ty):
+    size = tile_world_size(level)
+    return QRectF(tx * size, ty * size, size, size)
+
+
+def render_items(painter, items):
+    option = QStyleOptionGraphicsItem()
+    for item in items:
+        painter.save()
+        painter.setTransform(document_transform(item), True)
+        item.paint(painter, option, None)
+        painter.restore()
+
+
+def render_layers(painter, layers):
+    # layers - [(прозрачность, элементы)] снизу вверх. Полупрозрачный слой рисуется целиком
+    # в отдельный буфер размером с устройство и накладывается с прозрачностью, чтобы
+    # перекрывающиеся штрихи слоя не просвечивали друг через друга
+    for opacity, items in layers:
+        if opacity >= 1.0:
+            render_items(painter, items)
+            continue
+        device = painter.device()
+        image = QImage(device.width(), device.height(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(0)
+        layer_painter = QPainter(image)
+        layer_painter.setRenderHints(painter.renderHints())
+        layer_painter.setTransform(painter.transform())
+        render_items(layer_painter, items)
+        layer_painter.end()
+        painter.save()
+        painter.resetTransform()
+        painter.setOpacity(painter.opacity() * opacity)
+        painter.drawImage(0, 0, image)
+        painter.restore()
+
+
+# Многоуровневый кэш растровых тайлов для отрисовки холста при сильном отдалении.
+# Тайлы хранятся в LRU с ограничением по памяти и сбрасываются при изменении элементов в них.
+# У каждого слоя свои тайлы: правка слоя сбрасывает только его тайлы, а скрытие, прозрачность
+# и порядок слоев применяются при наложении готовых тайлов.
+# Сами тайлы рисует пул потоков TileRenderer по снимку элементов; пока тайл не готов,
+# на его месте растягивается более грубый уровень или рисуется заглушка
+class TileCache:
+    def __init__(self, chunk_store, memory_limit=MEMORY_LIMIT):
+        self.chunk_store = chunk_store
+        self.memory_limit = memory_limit
+        self.tiles = OrderedDict()  # (слой, level, tx, ty) -> QImage
+        self.memory_used = 0
+        self.listeners = []  # Функции listener(rect), вызываемые, когда готов новый тайл
+        self.renderer = TileRenderer()
+        self.renderer.finished.connect(self.onTileFinished)
+        chunk_store.listeners.append(self.invalidate)
+        chunk_store.layers.listeners.append(self.onLayersChanged)
+
+    def invalidate(self, rect, layer=None):
+        if rect is None and layer is None:
+            self.tiles.clear()
+            self.memory_used = 0
+            for key in self.renderer.pendingKeys():
+                self.renderer.cancel(key)
+            return
+
+        def affected(key):
+            return (layer is None or key[0] == layer) and (rect is None or tile_rect(*key[1:]).intersects(rect))
+
+        for key in [key for key in self.tiles if affected(key)]:
+            self._drop(key)
+        # Задания по старому снимку отменяются, тайлы будут запрошены заново
+        for key in self.renderer.pendingKeys():
+            if affected(key):
+                self.renderer.cancel(key)
+
+    def onLayersChanged(self):
+        # Тайлы удаленных слоев больше не нужны; остальные изменения слоев тайлы не сбрасывают
+        layers = self.chunk_store.layers.layers
+        for key in [key for key in self.tiles if key[0] not in layers]:
+            self._drop(key)
+        for key in self.renderer.pendingKeys():
+            if key[0] not in layers:
+                self.renderer.cancel(key)
+
+    def draw(self, painter, rect, zoom_factor):
+        # Рисует тайлы видимых слоев, покрывающие rect (в координатах документа); возвращает False,
+        # если часть тайлов не успела уйти в отрисовку и нужен повторный кадр
+        level = level_for_zoom(zoom_factor)
+        x0, y0, x1, y1 = self._tileRange(rect, level)
+        center_x, center_y = (x0 + x1) / 2, (y0 + y1) / 2
+        layers = self.chunk_store.layers
+
+        painter.save()
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        deadline = time.perf_counter() + SNAPSHOT_BUDGET
+        complete = True
+        for index, layer_id in enumerate(layers.visible_ids()):
+            painter.setOpacity(layers.layers[layer_id].opacity)
+            for tx in range(x0, x1 + 1):
+                for ty in range(y0, y1 + 1):
+                    key = (layer_id, level, tx, ty)
+                    image = self.tiles.get(key)
+                    if image is not None:
+                        self.tiles.move_to_end(key)
+                        if not image.isNull():
+                            painter.drawImage(tile_rect(level, tx, ty), image)
+                        continue
+                    if not self.renderer.isPending(key):
+                        if time.perf_counter() < deadline:
+                            # Ближние к центру тайлы рисуются первыми
+                            priority = -int(abs(tx - center_x) + abs(ty - center_y))
+                            self.request(key, priority)
+                            if key in self.tiles:
+                                continue  # Пустой тайл известен сразу
+                        else:
+                            complete = False
+                    # Заглушка только под нижним слоем, чтобы не закрывать готовые тайлы других слоев
+                    if not self._drawFallback(painter, key) and index == 0:
+                        painter.fillRect(tile_rect(level, tx, ty), PLACEHOLDER_COLOR)
+        painter.restore()
+        return complete
+
+    def retainVisible(self, rect, zoom_factor):
+        # Отменяет еще не начатые задания для тайлов, ушедших из вида, с другого уровня или скрытых слоев
+        level = level_for_zoom(zoom_factor)
+        x0, y0, x1, y1 = self._tileRange(rect, level)
+        self.renderer.retain(set((layer_id, level, tx, ty) for layer_id in self.chunk_store.layers.visible_ids()
+                                 for tx in range(x0 - 1, x1 + 2) for ty in range(y0 - 1, y1 + 2)))
+
+    def prefetch(self, rect, zoom_factor, deadline):
+        # Заранее запрашивает недостающие тайлы видимых слоев в rect для масштаба zoom_factor.
+        # Возвращает False, если до deadline (perf_counter) не все тайлы успели уйти в отрисовку
+        level = level_for_zoom(zoom_factor)
+        x0, y0, x1, y1 = self._tileRange(rect, level)
+        for layer_id in self.chunk_store.layers.visible_ids():
+            for tx in range(x0, x1 + 1):
+                for ty in range(y0, y1 + 1):
+                    key = (layer_id, level, tx, ty)
+                    if key in self.tiles or self.renderer.isPending(key):
+                        continue
+                    if self.memory_used >= self.memory_limit * PREFETCH_MEMORY_SHARE:
+                        return True  # Предзагрузка не должна вытеснять уже нужные тайлы
+                    if time.perf_counter() >= deadline:
+                        return False
+                    self.request(key, PREFETCH_PRIORITY)
+        return True
+
+    def request(self, key, priority=0):
+        layer_id, level, tx, ty = key
+        rect = tile_rect(level, tx, ty)
+        items = self.chunk_store.items_in_rect(rect, (layer_id,))
+        if not items:
+            self._store(key, EMPTY_TILE)
+            return
+        snapshot = [snapshot_item(item) for item in items]
+        self.renderer.submit(key, rect, 2.0 ** level, TILE_PIXELS, snapshot, priority)
+
+    def onTileFinished(self, key, image):
+        if image is None:
+            return
+        self._store(key, image)
+        rect = tile_rect(*key[1:])
+        for listener in self.listeners:
+            listener(rect)
+
+    def shutdown(self):
+        self.renderer.shutdown()
+
+    def _tileRange(self, rect, level):
+        size = tile_world_size(level)
+        return (math.floor(rect.left() / size), math.floor(rect.top() / size),
+                math.floor(rect.right() / size), math.floor(rect.bottom() / size))
+
+    def _drawFallback(self, painter, key):
+        # Пока тайл не готов, растягиваем подходящий кусок более грубого уровня
+        layer_id, level, tx, ty = key
+        target = tile_rect(level, tx, ty)
+        for up in range(1, MAX_FALLBACK_LEVELS + 1):
+            parent_key = (layer_id, level - up, tx >> up, ty >> up)
+            image = self.tiles.get(parent_key)
+            if image is None:
+                continue
+            if image.isNull():
+                return True
+            parent = tile_rect(*parent_key[1:])
+            scale = TILE_PIXELS / parent.width()
+            source = QRectF((target.left() - parent.left()) * scale,
+                            (target.top() - parent.top()) * scale,
+                            target.width() * scale, target.height() * scale)
+            painter.drawImage(target, image, source)
+            return True
+        return False
+
+    def _store(self, key, image):
+        self._drop(key)
+        self.tiles[key] = image
+        self.memory_used += image.sizeInBytes()
+        while self.memory_used > self.memory_limit and len(self.tiles) > 1:
+            self._drop(next(iter(self.tiles)))
+
+    def _drop(self, key):
+        image = self.tiles.pop(key, None)
+        if image is not None:
+            self.memory_used -= image.sizeInBytes()
@@ -0,0 +1,164 @@
+# tile_renderer.py
+
+import logging
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem, QStyleOptionGraphicsItem
+from PyQt5.QtGui import QImage, QPainter, QPainterPath, QPen, QBrush, QPicture, QPolygonF, QTransform
+from PyQt5.QtCore import Qt, QObject, QRectF, QRunnable, QThread, QThreadPool, pyqtSignal
+from stroke_item import StrokeItem, array_to_polygon
+from layers import document_transform
+from image_item import ImageItem
+from instrumentation import log
+
+# Отрисовка тайлов в пуле потоков. Элементы сцены трогать вне потока интерфейса нельзя,
+# поэтому перед постановкой в очередь с них снимается снимок: копии пути или полигона,
+# пера и кисти. Это неявно разделяемые типы Qt, их копирование дешево, а чтение из
+# другого потока безопасно
+SNAPSHOT_PATH = 0
+SNAPSHOT_POLYGON = 1
+SNAPSHOT_PICTURE = 2
+SNAPSHOT_POLYLINE = 3
+SNAPSHOT_IMAGE = 4
+
+
+def snapshot_item(item):
+    transform = document_transform(item)
+    transform = None if transform.isIdentity() else QTransform(transform)
+    if isinstance(item, StrokeItem):
+        # Ломаная штриха берется из буфера точек, путь строится только для кривых
+        if item.curve:
+            return SNAPSHOT_PATH, item.path(), item.pen(), item.brush(), transform
+        return SNAPSHOT_POLYLINE, array_to_polygon(item.coords()), item.pen(), None, transform
+    if isinstance(item, QGraphicsPathItem):
+        return SNAPSHOT_PATH, QPainterPath(item.path()), QPen(item.pen()), QBrush(item.brush()), transform
+    if isinstance(item, QGraphicsPolygonItem):
+        return (SNAPSHOT_POLYGON, (QPolygonF(item.polygon()), item.fillRule()), QPen(item.pen()),
+                QBrush(item.brush()), transform)
+    if isinstance(item, ImageItem):
+        # Пирамида изображения сама безопасна для потоков; тайлы читаются при отрисовке
+        item.pyramid.request_build()
+        return SNAPSHOT_IMAGE, (item.pyramid, QRectF(item.rect)), None, None, transform
+    # Прочие элементы записываются в QPicture на потоке интерфейса
+    picture = QPicture()
+    painter = QPainter(picture)
+    item.paint(painter, QStyleOptionGraphicsItem(), None)
+    painter.end()
+    return SNAPSHOT_PICTURE, picture, None, None, transform
+
+
+def paint_snapshot(painter, snapshot):
+    for kind, shape, pen, brush, transform in snapshot:
+        if transform is not None:
+            painter.save()
+            painter.setTransform(transform, True)
+        if kind == SNAPSHOT_PATH:
+            painter.setPen(pen)
+            painter.setBrush(brush)
+            painter.drawPath(shape)
+        elif kind == SNAPSHOT_POLYGON:
+            painter.setPen(pen)
+            painter.setBrush(brush)
+            painter.drawPolygon(*shape)
+        elif kind == SNAPSHOT_IMAGE:
+            pyramid, rect = shape
+            pyramid.draw(painter, rect)
+        elif kind == SNAPSHOT_POLYLINE:
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            if shape.count() > 1:
+                painter.drawPolyline(shape)
+            else:
+                painter.drawPoints(shape)
+        else:
+            painter.drawPicture(0, 0, shape)
+        if transform is not None:
+            painter.restore()
+
+
+class TileSignals(QObject):
+    finished = pyqtSignal(object, int, object)  # ключ тайла, номер задания, QImage
+
+
+class TileJob(QRunnable):
+    def __init__(self, signals, key, token, rect, scale, pixels, snapshot):
+        super().__init__()
+        self.setAutoDelete(False)  # Задание живет, пока на него ссылается TileRenderer
+        self.signals = signals
+        self.key = key
+        self.token = token
+        self.rect = rect
+        self.scale = scale
+        self.pixels = pixels
+        self.snapshot = snapshot
+
+    def run(self):
+        image = None
+        try:
+            image = QImage(self.pixels, self.pixels, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            if self.snapshot:
+                painter = QPainter(image)
+                painter.setRenderHint(QPainter.Antialiasing)
+                painter.scale(self.scale, self.scale)
+                painter.translate(-self.rect.left(), -self.rect.top())
+                paint_snapshot(painter, self.snapshot)
+                painter.end()
+        except Exception as e:
+            logging.exception("Exception in TileJob run:")
+        self.snapshot = None
+        # Сигнал доставляется в поток интерфейса через очередь событий
+        self.signals.finished.emit(self.key, self.token, image)
+
+
+# Пул потоков для отрисовки тайлов. Готовые тайлы возвращаются сигналом finished по мере готовности;
+# задания, которые еще не начались и больше не нужны, снимаются с очереди. Результат отмененного
+# или устаревшего задания отбрасывается
+class TileRenderer(QObject):
+    finished = pyqtSignal(object, object)  # ключ тайла, QImage (None при ошибке)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(1, QThread.idealThreadCount()))
+        self.signals = TileSignals()
+        self.signals.finished.connect(self.onFinished)
+        self.jobs = {}  # номер -> TileJob; ссылка держится, пока задание в пуле
+        self.latest = {}  # ключ тайла -> номер последнего задания для него
+        self.next_token = 0
+
+    def submit(self, key, rect, scale, pixels, snapshot, priority=0):
+        self.cancel(key)
+        self.next_token += 1
+        job = TileJob(self.signals, key, self.next_token, rect, scale, pixels, snapshot)
+        self.jobs[job.token] = job
+        self.latest[key] = job.token
+        self.pool.start(job, priority)
+
+    def isPending(self, key):
+        return key in self.latest
+
+    def pendingKeys(self):
+        return list(self.latest)
+
+    def cancel(self, key):
+        token = self.latest.pop(key, None)
+        if token is not None and self.pool.tryTake(self.jobs[token]):
+            del self.jobs[token]
+
+    def retain(self, keys):
+        # Отменяет задания для тайлов, которых нет в keys
+        for key in [key for key in self.latest if key not in keys]:
+            self.cancel(key)
+
+    def onFinished(self, key, token, image):
+        self.jobs.pop(token, None)
+        if self.latest.get(key) != token:
+            return
+        del self.latest[key]
+        self.finished.emit(key, image)
+
+    def shutdown(self):
+        for key in list(self.latest):
+            self.cancel(key)
+        self.pool.waitForDone()
+        self.jobs.clear()
+        log.debug("TileRenderer: Pool stopped")
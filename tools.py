@@ -1,133 +1,291 @@
 # tools.py
 
+import time
 import logging
-from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem, QApplication
-from PyQt5.QtGui import QPen, QPainterPath, QColor, QPolygonF, QBrush, QScreen
-from PyQt5.QtCore import Qt, QPointF
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPathItem, QGraphicsPolygonItem
+from PyQt5.QtGui import QPen, QPainterPath, QColor, QPolygonF, QBrush, QImage, QPainter
+from PyQt5.QtCore import Qt, QPointF, QRectF, QTimer
+from layers import OVERLAY_Z
+from simplify import far_enough, simplify_rdp
+from curves import fit_cubic_beziers
+from stroke_item import StrokeItem
+from erase import erase_region
+from tile_cache import render_layers
+from history import AddItemsCommand, EraseClipCommand
+from instrumentation import log, metrics
+
+
+def sample_canvas_color(view, pos, size=1):
+    # Средний цвет холста в квадрате size x size пикселей вида с центром в pos.
+    # Рисуются элементы хранилища, а не экран: не попадают панели и оверлеи, не нужен дисплей
+    started = time.perf_counter() if metrics.enabled else 0.0
+    left = pos.x() - size // 2
+    top = pos.y() - size // 2
+    origin = view.chunk_store.layers.origin
+    scene_rect = view.viewportTransform().inverted()[0].mapRect(QRectF(left, top, size, size))
+    document_rect = scene_rect.translated(origin)
+
+    viewport = view.viewport()
+    image = QImage(size, size, QImage.Format_RGBA8888)
+    image.fill(viewport.palette().color(viewport.backgroundRole()))
+    # Скрытые слои не видны и пипетке, полупрозрачные смешиваются как на экране
+    # Рисуются только элементы, которые действительно закрывают квадрат пробы, а не задевают его рамкой
+    layers = view.chunk_store.visible_layers_in_rect(document_rect, exact=True)
+    if layers:
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(-left, -top)
+        painter.setTransform(view.viewportTransform(), True)
+        painter.translate(-origin)
+        render_layers(painter, layers)
+        painter.end()
+
+    pixels = np.frombuffer(image.constBits().asstring(image.sizeInBytes()), dtype=np.uint8)
+    pixels = pixels.reshape(size, image.bytesPerLine())[:, :size * 4].reshape(-1, 4)
+    red, green, blue, alpha = (int(round(value)) for value in pixels.mean(axis=0))
+    if started:
+        metrics.observe('eyedropper.sample', time.perf_counter() - started)
+    return QColor(red, green, blue, alpha)
+
+
+def editable_layer(view):
+    # Текущий слой, если в него можно рисовать, иначе None с подсказкой в статус-баре
+    layers = view.chunk_store.layers
+    if layers.editable(layers.current):
+        return layers.current
+    log.debug("Layer %s is hidden or locked", layers.current)
+    window = view.window()
+    if hasattr(window, 'statusBar'):
+        window.statusBar().showMessage("Текущий слой скрыт или заблокирован", 3000)
+    return None
+
+
+# Предпросмотр растущей линии. Перестраивается только хвост из последних SEGMENT_POINTS точек,
+# а заполненные куски остаются в сцене отдельными элементами, поэтому работа за кадр
+# не зависит от длины штриха
+SEGMENT_POINTS = 64
+
+
+class LivePath:
+    def __init__(self, scene, pen, z, start, parent=None):
+        self.scene = scene
+        self.pen = pen
+        self.z = z
+        self.parent = parent  # Корень слоя: предпросмотр штриха ложится между штрихами слоев
+        self.segments = []
+        self.item = self._new_item()
+        self.path = QPainterPath()
+        self.path.moveTo(*start)
+        self.count = 0
+
+    def extend(self, points):
+        if not points:
+            return
+        for x, y in points:
+            self.path.lineTo(x, y)
+        self.count += len(points)
+        self.item.setPath(self.path)
+        if self.count >= SEGMENT_POINTS:
+            # Замораживаем кусок; следующий начинается с его последней точки
+            self.segments.append(self.item)
+            self.item = self._new_item()
+            self.path = QPainterPath()
+            self.path.moveTo(*points[-1])
+            self.count = 0
+
+    def set_pen(self, pen):
+        self.pen = pen
+        for item in self.segments + [self.item]:
+            item.setPen(pen)
+
+    def remove(self):
+        for item in self.segments + [self.item]:
+            self.scene.removeItem(item)
+        self.segments = []
+
+    def _new_item(self):
+        item = QGraphicsPathItem()
+        item.setPen(self.pen)
+        item.setZValue(self.z)
+        self.scene.addItem(item)
+        if self.parent is not None:
+            item.setParentItem(self.parent)
+        return item
+
+
+def filter_points(points, samples, min_distance):
+    # Добавляет в points сэмплы (x, y, время), которые не ближе min_distance к предыдущей точке
+    added = []
+    last = points[-1]
+    for x, y, _ in samples:
+        point = (x, y)
+        if far_enough(last, point, min_distance):
+            added.append(point)
+            last = point
+    points.extend(added)
+    return added
+
 
 class BrushTool:
     def __init__(self, settings):
         self.settings = settings
-        self.path_item = None
+        self.live_path = None
+        self.points = []
+        self.samples = []  # Все сэмплы ввода штриха (x, y, время в мс) до фильтрации и упрощения
+        self.last_raw_point = None
+        self.layer = None
 
     def on_press(self, event, view):
-        print("BrushTool: on_press")
+        log.debug("BrushTool: on_press")
         try:
-            scene_pos = view.mapToScene(event.pos())
-            self.path = QPainterPath()
-            self.path.moveTo(scene_pos)
-
-            self.path_item = QGraphicsPathItem()
-            brush_size = self.settings.get_brush_size(
-                view.viewport().width(),
-                view.viewport().height(),
-                view.zoom_factor)
-            pen = QPen(self.settings.current_color, brush_size)
-            pen.setCapStyle(Qt.RoundCap)
-            pen.setJoinStyle(Qt.RoundJoin)
-            self.path_item.setPen(pen)
-            view.scene().addItem(self.path_item)
-            print(f"BrushTool: Created path_item with brush size {pen.width()}")
+            self.layer = editable_layer(view)
+            if self.layer is None:
+                return
+            document_pos = view.mapToDocument(event.pos())
+            self.points = [(document_pos.x(), document_pos.y())]
+            self.samples = [(document_pos.x(), document_pos.y(), event.timestamp())]
+            self.last_raw_point = None
+            root = view.chunk_store.layers.layer(self.layer).root
+            self.live_path = LivePath(view.scene(), self.createPen(view), view.chunk_store.next_z(), self.points[0], root)
+            log.debug("BrushTool: Created live path with brush size %s", self.live_path.pen.widthF())
         except Exception as e:
             logging.exception("Exception in BrushTool on_press:")
 
-    def on_move(self, event, view):
-        if self.path_item:
-            print("BrushTool: on_move")
+    def on_move(self, samples, view):
+        # samples - накопленные за кадр сэмплы (x, y, время) в координатах документа
+        if self.live_path:
             try:
-                scene_pos = view.mapToScene(event.pos())
-                self.path.lineTo(scene_pos)
-                self.path_item.setPath(self.path)
+                self.samples.extend(samples)
+                self.last_raw_point = samples[-1][:2]
+                # Отбрасываем точки, которые ближе минимального расстояния к предыдущей
+                min_distance = self.settings.get_min_point_distance(view.zoom_factor)
+                added = filter_points(self.points, samples, min_distance)
+                self.live_path.extend(added)
+                if metrics.enabled and added:
+                    metrics.count('path_elements', len(added))
             except Exception as e:
                 logging.exception("Exception in BrushTool on_move:")
 
     def on_release(self, event, view):
-        print("BrushTool: on_release")
-        if self.path_item:
-            # Добавляем действие в стек отмены
-            view.window().undo_stack.append([self.path_item])
-            self.path_item = None
+        log.debug("BrushTool: on_release")
+        if self.live_path:
+            self.live_path.remove()
+            pen = self.live_path.pen
+            try:
+                # Не теряем конец штриха, отброшенный фильтром расстояния
+                if self.last_raw_point is not None and self.last_raw_point != self.points[-1]:
+                    self.points.append(self.last_raw_point)
+                if self.settings.smooth_strokes and len(self.samples) > 2:
+                    # Кривые подбираются по всем сэмплам, а не по отфильтрованным точкам
+                    tolerance = self.settings.get_curve_tolerance(view.zoom_factor)
+                    curve = fit_cubic_beziers(self.samples, tolerance)
+                    stroke = StrokeItem(curve, pen.color().rgba(), pen.widthF(), curve=True)
+                    log.debug("BrushTool: Fitted %s samples with %s curve segments",
+                              len(self.samples), (len(curve) - 1) // 3)
+                else:
+                    tolerance = self.settings.get_simplify_tolerance(view.zoom_factor)
+                    points = simplify_rdp(self.points, tolerance)
+                    stroke = StrokeItem(points, pen.color().rgba(), pen.widthF())
+                    log.debug("BrushTool: Simplified stroke from %s samples and %s points to %s points",
+                              len(self.samples), len(self.points), len(points))
+            except Exception as e:
+                logging.exception("Exception in BrushTool on_release:")
+                stroke = StrokeItem(self.points, pen.color().rgba(), pen.widthF())
+            z = self.live_path.z
+            self.points = []
+            self.samples = []
+            self.live_path = None
+            # Передаем готовый штрих в хранилище чанков
+            view.chunk_store.add_item(stroke, z, self.layer)
+            # Добавляем действие в историю
+            view.window().history.push(AddItemsCommand([stroke]))
+
+    def createPen(self, view):
+        brush_size = self.settings.get_brush_size(
+            view.viewport().width(),
+            view.viewport().height(),
+            view.zoom_factor)
+        pen = QPen(self.settings.current_color, brush_size)
+        pen.setCapStyle(Qt.RoundCap)
+        pen.setJoinStyle(Qt.RoundJoin)
+        return pen
 
     def updatePen(self, view):
-        print("BrushTool: updatePen")
-        if self.path_item:
+        log.debug("BrushTool: updatePen")
+        if self.live_path:
             try:
-                brush_size = self.settings.get_brush_size(
-                    view.viewport().width(),
-                    view.viewport().height(),
-                    view.zoom_factor)
-                pen = QPen(self.settings.current_color, brush_size)
-                pen.setCapStyle(Qt.RoundCap)
-                pen.setJoinStyle(Qt.RoundJoin)
-                self.path_item.setPen(pen)
-                print(f"BrushTool: Updated pen with new brush size {brush_size}")
+                pen = self.createPen(view)
+                self.live_path.set_pen(pen)
+                log.debug("BrushTool: Updated pen with new brush size %s", pen.widthF())
             except Exception as e:
                 logging.exception("Exception in BrushTool updatePen:")
 
 class LassoFillTool:
     def __init__(self, settings):
         self.settings = settings
-        self.path_item = None
+        self.live_path = None
         self.selection_polygon = []
-        self.path = None
+        self.layer = None
 
     def on_press(self, event, view):
-        print("LassoFillTool: on_press")
+        log.debug("LassoFillTool: on_press")
         try:
-            scene_pos = view.mapToScene(event.pos())
-            self.path = QPainterPath()
-            self.path.moveTo(scene_pos)
-            self.selection_polygon = [scene_pos]
+            self.layer = editable_layer(view)
+            if self.layer is None:
+                return
+            document_pos = view.mapToDocument(event.pos())
+            self.selection_polygon = [(document_pos.x(), document_pos.y())]
 
-            self.path_item = QGraphicsPathItem()
             pen = QPen(Qt.DotLine)
             pen.setWidthF(2 / view.zoom_factor)
-            self.path_item.setPen(pen)
-            view.scene().addItem(self.path_item)
+            self.live_path = LivePath(view.scene(), pen, OVERLAY_Z, self.selection_polygon[0],
+                                      view.chunk_store.layers.overlay)
         except Exception as e:
             logging.exception("Exception in LassoFillTool on_press:")
 
-    def on_move(self, event, view):
-        if self.path_item:
-            print("LassoFillTool: on_move")
+    def on_move(self, samples, view):
+        if self.live_path:
             try:
-                scene_pos = view.mapToScene(event.pos())
-                self.path.lineTo(scene_pos)
-                self.selection_polygon.append(scene_pos)
-                self.path_item.setPath(self.path)
+                min_distance = self.settings.get_min_point_distance(view.zoom_factor)
+                added = filter_points(self.selection_polygon, samples, min_distance)
+                self.live_path.extend(added)
+                if metrics.enabled and added:
+                    metrics.count('path_elements', len(added))
             except Exception as e:
                 logging.exception("Exception in LassoFillTool on_move:")
 
     def on_release(self, event, view):
-        print("LassoFillTool: on_release")
+        log.debug("LassoFillTool: on_release")
         try:
-            if self.path_item:
-                view.scene().removeItem(self.path_item)
-                self.path_item = None
+            if self.live_path:
+                self.live_path.remove()
+                self.live_path = None
 
             if not self.selection_polygon:
-                print("LassoFillTool: No selection polygon")
+                log.debug("LassoFillTool: No selection polygon")
                 return
 
             # Замыкаем полигон, если необходимо
             if self.selection_polygon[0] != self.selection_polygon[-1]:
                 self.selection_polygon.append(self.selection_polygon[0])
 
-            polygon = QPolygonF(self.selection_polygon)
+            tolerance = self.settings.get_simplify_tolerance(view.zoom_factor)
+            points = simplify_rdp(self.selection_polygon, tolerance)
+            polygon = QPolygonF([QPointF(x, y) for x, y in points])
             pen = QPen(Qt.NoPen)
             brush = QBrush(self.settings.current_color)
             fill_item = QGraphicsPolygonItem()
             fill_item.setPolygon(polygon)
             fill_item.setPen(pen)
             fill_item.setBrush(brush)
-            view.scene().addItem(fill_item)
-            print(f"LassoFillTool: Filled polygon with color {self.settings.current_color.name()}")
+            view.chunk_store.add_item(fill_item, layer=self.layer)
+            log.debug("LassoFillTool: Filled polygon with color %s", self.settings.current_color.name())
 
-            # Добавляем действие в стек отмены
-            view.window().undo_stack.append([fill_item])
+            # Добавляем действие в историю
+            view.window().history.push(AddItemsCommand([fill_item]))
 
             self.selection_polygon = []
-            self.path = None
         except Exception as e:
             logging.exception("Exception in LassoFillTool on_release:")
 
@@ -136,108 +294,104 @@ class LassoFillTool:
 class LassoEraseTool:
     def __init__(self, settings):
         self.settings = settings
-        self.path_item = None
+        self.live_path = None
         self.selection_polygon = []
-        self.path = None
+        self.layer = None
 
     def on_press(self, event, view):
-        print("LassoEraseTool: on_press")
+        log.debug("LassoEraseTool: on_press")
         try:
-            scene_pos = view.mapToScene(event.pos())
-            self.path = QPainterPath()
-            self.path.moveTo(scene_pos)
-            self.selection_polygon = [scene_pos]
+            self.layer = editable_layer(view)
+            if self.layer is None:
+                return
+            document_pos = view.mapToDocument(event.pos())
+            self.selection_polygon = [(document_pos.x(), document_pos.y())]
 
-            self.path_item = QGraphicsPathItem()
             pen = QPen(Qt.DotLine)
             pen.setWidthF(2 / view.zoom_factor)
-            self.path_item.setPen(pen)
-            view.scene().addItem(self.path_item)
+            self.live_path = LivePath(view.scene(), pen, OVERLAY_Z, self.selection_polygon[0],
+                                      view.chunk_store.layers.overlay)
         except Exception as e:
             logging.exception("Exception in LassoEraseTool on_press:")
 
-    def on_move(self, event, view):
-        if self.path_item:
-            print("LassoEraseTool: on_move")
+    def on_move(self, samples, view):
+        if self.live_path:
             try:
-                scene_pos = view.mapToScene(event.pos())
-                self.path.lineTo(scene_pos)
-                self.selection_polygon.append(scene_pos)
-                self.path_item.setPath(self.path)
+                min_distance = self.settings.get_min_point_distance(view.zoom_factor)
+                added = filter_points(self.selection_polygon, samples, min_distance)
+                self.live_path.extend(added)
+                if metrics.enabled and added:
+                    metrics.count('path_elements', len(added))
             except Exception as e:
                 logging.exception("Exception in LassoEraseTool on_move:")
 
     def on_release(self, event, view):
-        print("LassoEraseTool: on_release")
+        log.debug("LassoEraseTool: on_release")
         try:
-            if self.path_item:
-                view.scene().removeItem(self.path_item)
-                self.path_item = None
+            if self.live_path:
+                self.live_path.remove()
+                self.live_path = None
 
             if not self.selection_polygon:
-                print("LassoEraseTool: No selection polygon")
+                log.debug("LassoEraseTool: No selection polygon")
                 return
 
             # Замыкаем полигон, если необходимо
             if self.selection_polygon[0] != self.selection_polygon[-1]:
                 self.selection_polygon.append(self.selection_polygon[0])
 
-            polygon = QPolygonF(self.selection_polygon)
-            pen = QPen(Qt.NoPen)
-            brush = QBrush(QColor(255, 255, 255))  # Белый цвет для стирания
-            fill_item = QGraphicsPolygonItem()
-            fill_item.setPolygon(polygon)
-            fill_item.setPen(pen)
-            fill_item.setBrush(brush)
-            view.scene().addItem(fill_item)
-            print("LassoEraseTool: Erased polygon area")
+            tolerance = self.settings.get_simplify_tolerance(view.zoom_factor)
+            points = simplify_rdp(self.selection_polygon, tolerance)
+            # Вырезаем область из задетых элементов вместо наложения белой заливки
+            removed, added = erase_region(view.chunk_store, points, self.layer)
+            log.debug("LassoEraseTool: Erased area, removed %s items, added %s pieces", len(removed), len(added))
 
-            # Добавляем действие в стек отмены
-            view.window().undo_stack.append([fill_item])
+            # Все изменения стирания - одно действие в истории
+            if removed:
+                view.window().history.push(EraseClipCommand(removed, added))
 
             self.selection_polygon = []
-            self.path = None
         except Exception as e:
             logging.exception("Exception in LassoEraseTool on_release:")
 
 class EyedropperTool:
     def __init__(self, settings):
         self.settings = settings
+        self.hover_pos = None
+        self.hover_scheduled = False
+        self.last_sample = None  # (позиция, трансформация вида, размер) последней пробы при наведении
 
     def on_press(self, event, view):
-        print("EyedropperTool: on_press")
+        log.debug("EyedropperTool: on_press")
         try:
-            # Получаем глобальные координаты курсора
-            global_pos = view.viewport().mapToGlobal(event.pos())
-
-            # Получаем экран, на котором находится курсор
-            screen = QApplication.screenAt(global_pos)
-            if not screen:
-                print("EyedropperTool: No screen found at cursor position")
-                return
-
-            # Учитываем коэффициент масштабирования экрана
-            scale_factor = screen.devicePixelRatio()
+            color = sample_canvas_color(view, event.pos(), self.settings.eyedropper_sample_size)
+            self.settings.current_color = color
+            view.window().showColorPreview(color)
+            log.debug("EyedropperTool: Color picked %s", color.name())
+        except Exception as e:
+            logging.exception("Exception in EyedropperTool on_press:")
 
-            # Захватываем цвет пикселя под курсором
-            x = int(global_pos.x() * scale_factor)
-            y = int(global_pos.y() * scale_factor)
-            screenshot = screen.grabWindow(0, x, y, 1, 1)
+    def on_hover(self, event, view):
+        # Проба при наведении откладывается до конца обработки событий,
+        # поэтому серия движений мыши за один кадр дает одну пробу
+        self.hover_pos = event.pos()
+        if not self.hover_scheduled:
+            self.hover_scheduled = True
+            QTimer.singleShot(0, lambda: self.updatePreview(view))
 
-            if not screenshot.isNull():
-                image = screenshot.toImage()
-                if not image.isNull():
-                    color = image.pixelColor(0, 0)
-                    self.settings.current_color = color
-                    print(f"EyedropperTool: Color picked {color.name()}")
-                else:
-                    print("EyedropperTool: Failed to get image from screenshot")
-            else:
-                print("EyedropperTool: Failed to grab screenshot")
+    def updatePreview(self, view):
+        self.hover_scheduled = False
+        try:
+            size = self.settings.eyedropper_sample_size
+            sample = (self.hover_pos, view.viewportTransform(), size)
+            if sample == self.last_sample:
+                return
+            self.last_sample = sample
+            view.window().showColorPreview(sample_canvas_color(view, self.hover_pos, size))
         except Exception as e:
-            logging.exception("Exception in EyedropperTool on_press:")
+            logging.exception("Exception in EyedropperTool updatePreview:")
 
-    def on_move(self, event, view):
+    def on_move(self, samples, view):
         pass
 
     def on_release(self, event, view):